@@ -1,6 +1,5 @@
 import os
 import logging
-import json
 import random
 from flask import Flask, render_template, request, session, redirect, url_for, flash, make_response, jsonify
 from flask_bcrypt import Bcrypt
@@ -11,14 +10,21 @@ import datetime
 
 from config import (
     VERBOSE, SESSION_SECRET, TOGETHER_API_KEY, DEFAULT_IMAGE_FILE_PATH, 
-    DEFAULT_AUDIO_FILE_PATH, DB_PATH, MAX_SAVE
+    DEFAULT_AUDIO_FILE_PATH, DB_PATH, MAX_SAVE, HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE
 )
 from main_flask import (
     run_action, get_initial_game_state, save_temp_game_state,
-    format_chat_history, validate_game_state, last_saved_history,
-    clean_duplicate_history
+    format_chat_history, validate_game_state, load_game_state, load_game_head, last_saved_history,
+    migrate_history_index, sync_client_view, get_history_page,
+    start_speculation, take_speculation, get_metrics, schedule_puzzle_refill
 )
+from state_model import encode_game_state
+from state_store import init_state_store, store_game_state, store_game_head, copy_game_state
 from create_log import create_log, clean_old_logs
+from narrative_cache import init_narrative_cache
+from puzzle_library import init_puzzle_library
+from rate_limiter import init_rate_limiter
+from single_flight import init_single_flight
 from handle_db import (
     init_db, get_db_connection, upload_db_to_gcs, download_db_from_gcs,
     confirm_save, retrieve_game_list, retrieve_game, clean_temp_saves
@@ -48,6 +54,13 @@ bcrypt = Bcrypt(app)
 # Clean old logs and initialize database at startup
 clean_old_logs()
 init_db()
+init_state_store(int_verbose=VERBOSE)
+init_narrative_cache()
+init_puzzle_library()
+init_rate_limiter()
+init_single_flight()
+# Pre-generate puzzles so the first trick events do not wait for the model
+schedule_puzzle_refill()
 
 # Configure session settings
 app.config['SESSION_TYPE'] = 'filesystem'  # Can switch to 'redis' for production
@@ -173,8 +186,8 @@ def game():
         c.execute("SELECT game_state FROM game_states WHERE user_id = ? AND game_name = 'autosave'", (user_id,))
         row = c.fetchone()
         if row:
-            game_state = json.loads(row['game_state'])
-            if validate_game_state(game_state):
+            game_state = load_game_state(row['game_state'])
+            if game_state is not None:
                 if VERBOSE:
                     create_log("ROUTE /GAME: Loaded autosave game state from database")
             else:
@@ -186,25 +199,25 @@ def game():
             if VERBOSE:
                 create_log("ROUTE /GAME: No autosave found, initialized new")
 
-    # Ensure resources is initialized
-    if 'resources' not in game_state:
-        game_state['resources'] = {'wands': 2, 'potions': 2, 'energy': 5}
-        create_log(f"ROUTE /GAME: Initialized missing resources for user {username}")
-
     raw_image_path = game_state['output_image']
     image_filename = get_relative_image_path(raw_image_path)
     ambient_sound = get_relative_audio_path(game_state['ambient_sound'])
+    client_sync = sync_client_view(user_id, game_state)
     response = make_response(render_template("game.html",
                                             output="Esse é o mundo mágico de Arkonix!",
                                             output_image=image_filename,
                                             ambient_sound=ambient_sound,
                                             chat_history=format_chat_history([game_state['history'][-1]], game_state) if game_state['history'] else "",
+                                            history_cursor=max(0, len(game_state['history']) - 1),
+                                            history_page_size=HISTORY_PAGE_SIZE,
                                             game_state=game_state,
                                             health=game_state.get('health', 10),
                                             resources=game_state.get('resources', {'wands': 2, 'potions': 2, 'energy': 5}),
                                             current_state=game_state.get('current_state', 1),
                                             clues=game_state.get('clues', []),
-                                            npc_status=game_state.get('npc_status', {})))
+                                            npc_status=game_state.get('npc_status', {}),
+                                            state_version=client_sync['state_version'],
+                                            client_state=client_sync['state']))
     response.headers['Cache-Control'] = 'no-store'
     return response
 
@@ -219,6 +232,7 @@ def process_command():
     user_id = session['user_id']
     username = session.get('username', 'Unknown')
     command = request.form.get("command")
+    client_version = request.form.get("state_version", type=int)
 
     # Load game state (prefer autosave)
     with get_db_connection(int_verbose=False) as conn:
@@ -228,8 +242,8 @@ def process_command():
         if row:
             if VERBOSE:
                 create_log("ROUTE /COMMAND: autosave found")
-            game_state = json.loads(row['game_state'])
-            if not validate_game_state(game_state): #validate_game_state handles log in case of failure
+            game_state = load_game_state(row['game_state'])
+            if game_state is None: #load_game_state handles log in case of failure
                 game_state = get_initial_game_state()
                 if VERBOSE:
                     create_log("ROUTE /COMMAND: Invalid autosave, initialized new")
@@ -240,33 +254,36 @@ def process_command():
 
 
 
-    #TODO: for latter: check if this is needed
-    # Ensure resources is initialized
-    if 'resources' not in game_state:
-        game_state['resources'] = {'wands': 2, 'potions': 2, 'energy': 5}
-        create_log(f"ROUTE /COMMAND: Initialized missing resources for user {username}")
-    
-    # Clean history to remove duplicates
-    clean_duplicate_history(game_state, int_verbose=VERBOSE)
+    # Index the history of games saved before append-time dedup (no-op afterwards)
+    migrate_history_index(game_state, int_verbose=VERBOSE)
 
-    output = run_action(command, game_state, int_verbose=VERBOSE)
+    # Commit the speculative turn if the player followed the suggestion, otherwise run the turn now
+    speculation = take_speculation(user_id, command, game_state, int_verbose=VERBOSE)
+    if speculation:
+        output, game_state = speculation
+    else:
+        output = run_action(command, game_state, int_verbose=VERBOSE)
     timestamp = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
     gcs_path = f"{DEFAULT_IMAGE_FILE_PATH.split('.png')[0]}_{timestamp}.png"
     if not isinstance(output, str):
         create_log(f"\n\nROUTE /COMMAND: Error: run_action returned non-string: {type(output)}\n\n", force_log=True)
         output = "Error: Invalid response from run_action"
 
+    # Diff the client view before saving: it also drops the view older saves kept in the game state
+    is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+    client_sync = sync_client_view(user_id, game_state, client_version if is_ajax else None, int_verbose=VERBOSE)
+
     # Save updated game state as autosave
     with get_db_connection() as conn:
         c = conn.cursor()
-        c.execute("INSERT OR REPLACE INTO game_states (user_id, game_name, game_state, created_at) VALUES (?, ?, ?, ?)",
-                  (user_id, "autosave", json.dumps(game_state), time.strftime('%Y-%m-%d %H:%M:%S')))
+        store_game_state(c, user_id, "autosave", game_state)
         conn.commit()
         if VERBOSE:
             create_log(f"ROUTE /COMMAND: Overwrote autosave game state in database")
     
     upload_db_to_gcs(int_verbose=False)
     save_temp_game_state(game_state, int_verbose=False)
+    start_speculation(user_id, game_state, int_verbose=VERBOSE)
     ambient_sound = get_relative_audio_path(game_state['ambient_sound'])
     raw_image_path = game_state['output_image']
     image_filename = get_relative_image_path(raw_image_path)
@@ -276,7 +293,7 @@ def process_command():
     chat_history = format_chat_history(latest_interaction, game_state) if game_state['history'] else ""
 
     # Handle AJAX request
-    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+    if is_ajax:
         # Format chat history to include only the latest interaction
         latest_interaction = [{'role': 'user', 'content': command}, {'role': 'assistant', 'content': output}]
         chat_history = format_chat_history(latest_interaction, game_state)
@@ -286,11 +303,8 @@ def process_command():
             'output_image': url_for('static', filename=image_filename),
             'ambient_sound': url_for('static', filename=ambient_sound),
             'chat_history': chat_history,  # Latest interaction only
-            'health': game_state.get('health', 10),
-            'resources': game_state.get('resources', {}),
-            'current_state': game_state.get('current_state', 1),
-            'clues': game_state.get('clues', []),
-            'npc_status': game_state.get('npc_status', {}),
+            'history_cursor': max(0, len(game_state['history']) - 2),  # /history 'before' cursor for older turns
+            **client_sync,  # state_version plus either state_patch or the full state
             'sound_trigger': 'combat' if 'Combat' in output else 'puzzle' if 'Puzzle' in output else None
         }
         create_log(f"ROUTE /COMMAND-AJAX: User {username}\n\nQuestion: {command}", force_log=True)
@@ -304,18 +318,57 @@ def process_command():
                                             output_image=image_filename,
                                             ambient_sound=ambient_sound,
                                             chat_history=chat_history,
+                                            history_cursor=max(0, len(game_state['history']) - 2),
+                                            history_page_size=HISTORY_PAGE_SIZE,
                                             game_state=game_state,
                                             health=game_state.get('health', 10),
                                             resources=game_state.get('resources', {'wands': 2, 'potions': 2, 'energy': 5}),
                                             current_state=game_state.get('current_state', 1),
                                             clues=game_state.get('clues', []),
-                                            npc_status=game_state.get('npc_status', {})))
+                                            npc_status=game_state.get('npc_status', {}),
+                                            state_version=client_sync['state_version'],
+                                            client_state=client_sync['state']))
     response.headers['Cache-Control'] = 'no-store'
     create_log(f"\nROUTE /COMMAND: User {username}\n\nQuestion: {command}", force_log=True)
     create_log(f"ROUTE /COMMAND: Generated image: {gcs_path}", force_log=True)
     create_log(f"ROUTE /COMMAND: Completion: {chat_history}\n", force_log=True)
     return response
 
+@app.route("/history", methods=["GET"])
+def history():
+    if 'user_id' not in session:
+        if VERBOSE:
+            create_log("ROUTE /HISTORY: User not logged in, redirecting to login")
+        return redirect(url_for("login"))
+
+    user_id = session['user_id']
+    before = request.args.get("before", type=int)
+    limit = request.args.get("limit", default=HISTORY_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT game_state FROM game_states WHERE user_id = ? AND game_name = 'autosave'", (user_id,))
+        row = c.fetchone()
+    if not row:
+        return jsonify({'chat_history': "", 'before': 0, 'has_more': False})
+
+    game_state = load_game_state(row['game_state'])
+    if game_state is None:
+        return jsonify({'chat_history': "", 'before': 0, 'has_more': False})
+    page = get_history_page(game_state, before=before, limit=limit)
+    if VERBOSE:
+        create_log(f"ROUTE /HISTORY: User {user_id} fetched {limit} entries before {before}, next cursor {page['before']}")
+    return jsonify(page)
+
+@app.route("/metrics", methods=["GET"])
+def show_metrics():
+    if 'user_id' not in session:
+        if VERBOSE:
+            create_log("ROUTE /METRICS: User not logged in, redirecting to login")
+        return redirect(url_for("login"))
+    return jsonify(get_metrics())
+
 @app.route("/new_game", methods=["POST"])
 def new_game():
     if 'user_id' not in session:
@@ -332,15 +385,11 @@ def new_game():
     clean_temp_saves(int_verbose=VERBOSE)
     game_state = get_initial_game_state()
 
-    # Ensure resources is initialized
-    if 'resources' not in game_state:
-        game_state['resources'] = {'wands': 2, 'potions': 2, 'energy': 5}
-        create_log(f"ROUTE /NEW_GAME: Initialized missing resources for user {username}")
+    client_sync = sync_client_view(user_id, game_state)
 
     with get_db_connection() as conn:
         c = conn.cursor()
-        c.execute("INSERT OR REPLACE INTO game_states (user_id, game_name, game_state, created_at) VALUES (?, ?, ?, ?)",
-                  (user_id, "autosave", json.dumps(game_state), time.strftime('%Y-%m-%d %H:%M:%S')))
+        store_game_state(c, user_id, "autosave", game_state)
         conn.commit()
         if VERBOSE:
             create_log("ROUTE /NEW_GAME: Overwrote autosave with new game state in database")
@@ -354,12 +403,16 @@ def new_game():
                                             output_image=image_filename,
                                             ambient_sound=ambient_sound,
                                             chat_history=format_chat_history([game_state['history'][-1]], game_state) if game_state['history'] else "",
+                                            history_cursor=max(0, len(game_state['history']) - 1),
+                                            history_page_size=HISTORY_PAGE_SIZE,
                                             game_state=game_state,
                                             health=game_state.get('health', 10),
                                             resources=game_state.get('resources', {'wands': 2, 'potions': 2, 'energy': 5}),
                                             current_state=game_state.get('current_state', 1),
                                             clues=game_state.get('clues', []),
-                                            npc_status=game_state.get('npc_status', {})))
+                                            npc_status=game_state.get('npc_status', {}),
+                                            state_version=client_sync['state_version'],
+                                            client_state=client_sync['state']))
     response.headers['Cache-Control'] = 'no-store'
     return response
 
@@ -387,27 +440,25 @@ def save():
         c = conn.cursor()
         c.execute("SELECT game_state FROM game_states WHERE user_id = ? AND game_name = 'autosave'", (user_id,))
         row = c.fetchone()
+        # The slot gets a copy of the autosave head (history chunks are shared), so only the head is read
         if row:
-            game_state = json.loads(row['game_state'])
-            if not validate_game_state(game_state):
-                game_state = get_initial_game_state()
+            head = load_game_head(row['game_state'])
+            if head is None:
+                head = store_game_state(c, user_id, "autosave", get_initial_game_state())
+                conn.commit()
                 if VERBOSE:
                     create_log("ROUTE /SAVE_GAME: Invalid autosave, initialized new")
         else:
-            game_state = get_initial_game_state()
+            head = store_game_state(c, user_id, "autosave", get_initial_game_state())
+            conn.commit()
             if VERBOSE:
                 create_log("ROUTE /SAVE_GAME: No autosave found, initialized new")
 
-        # Ensure resources is initialized
-        if 'resources' not in game_state:
-            game_state['resources'] = {'wands': 2, 'potions': 2, 'energy': 5}
-            create_log(f"ROUTE /SAVE_GAME: Initialized missing resources for user {username}")
-
         try:
-            result = confirm_save(filename, game_state, user_id=user_id)
+            result = confirm_save(filename, user_id=user_id)
             if result["status"] == "max_saves_reached":
                 session['pending_save_filename'] = filename
-                session['pending_game_state'] = json.dumps(game_state)
+                session['pending_game_state'] = encode_game_state(head)
                 create_log(f"ROUTE /SAVE_GAME: Stored pending game state for user: {username}, filename: {filename}", force_log=True)
                 create_log(f"ROUTE /SAVE_GAME: Session contents after storing: {dict(session.items())}", force_log=True)
                 flash(result["message"], "info")
@@ -417,7 +468,6 @@ def save():
             flash(result["message"], "success")
             if VERBOSE:
                 create_log(f"ROUTE /SAVE_GAME: Game saved as {filename} for user: {username}")
-            save_temp_game_state(game_state)
             upload_db_to_gcs()
         except Exception as e:
             flash(f"Failed to save game: {str(e)}", "error")
@@ -452,12 +502,9 @@ def load():
                 create_log(f"\n\nROUTE /RETRIEVE_GAME: Loaded game state is invalid for user: {username}\n\n")
                 raise ValueError("Loaded game state is invalid")
 
-            # Ensure resources is initialized
-            if 'resources' not in game_state:
-                game_state['resources'] = {'wands': 2, 'potions': 2, 'energy': 5}
-                create_log(f"ROUTE /RETRIEVE_GAME: Initialized missing resources for user {username}")
-
-            clean_duplicate_history(game_state, int_verbose=VERBOSE)
+            migrate_history_index(game_state, int_verbose=VERBOSE)
+            client_sync = sync_client_view(user_id, game_state)
+            history_page = get_history_page(game_state, limit=HISTORY_PAGE_SIZE)
 
             flash("Game loaded successfully!", "success")
             if VERBOSE:
@@ -465,8 +512,8 @@ def load():
 
             with get_db_connection() as conn:
                 c = conn.cursor()
-                c.execute("INSERT OR REPLACE INTO game_states (user_id, game_name, game_state, created_at) VALUES (?, ?, ?, ?)",
-                          (user_id, "autosave", json.dumps(game_state), time.strftime('%Y-%m-%d %H:%M:%S')))
+                # Copy-on-write: the autosave gets the head of the slot, history chunks stay shared
+                copy_game_state(c, user_id, selected_file, "autosave")
                 conn.commit()
                 if VERBOSE:
                     create_log("ROUTE /RETRIEVE_GAME: Overwrote autosave with loaded game state")
@@ -479,13 +526,17 @@ def load():
                                                     output="Jogo Carregado!",
                                                     output_image=image_filename,
                                                     ambient_sound=ambient_sound,
-                                                    chat_history=format_chat_history(game_state['history'], game_state) if game_state['history'] else "",
+                                                    chat_history=history_page['chat_history'],
+                                                    history_cursor=history_page['before'],
+                                                    history_page_size=HISTORY_PAGE_SIZE,
                                                     game_state=game_state,
                                                     health=game_state.get('health', 10),
                                                     resources=game_state.get('resources', {'wands': 2, 'potions': 2, 'energy': 5}),
                                                     current_state=game_state.get('current_state', 1),
                                                     clues=game_state.get('clues', []),
-                                                    npc_status=game_state.get('npc_status', {})))
+                                                    npc_status=game_state.get('npc_status', {}),
+                                                    state_version=client_sync['state_version'],
+                                                    client_state=client_sync['state']))
             response.headers['Cache-Control'] = 'no-store'
             return response
         except ValueError as ve:
@@ -545,8 +596,8 @@ def overwrite_game():
                 create_log(f"\nROUTE /OVERWRITE_GAME: No pending game state for user: {username}\n", force_log=True)
                 return redirect(url_for("game"))
             
-            game_state = json.loads(pending_game_state)
-            if not validate_game_state(game_state):
+            head = load_game_head(pending_game_state)
+            if head is None:
                 flash("Invalid game state.", "error")
                 create_log(f"\nROUTE /OVERWRITE_GAME: Invalid pending game state for user: {username}\n")
                 return redirect(url_for("game"))
@@ -576,8 +627,7 @@ def overwrite_game():
                         create_log(f"ROUTE /OVERWRITE_GAME: Max saves reached, cannot save {new_name} for user: {username}")
                         return redirect(url_for("overwrite_game"))
                 
-                c.execute("INSERT OR REPLACE INTO game_states (user_id, game_name, game_state, created_at) VALUES (?, ?, ?, ?)",
-                          (user_id, new_name, json.dumps(game_state), time.strftime('%Y-%m-%d %H:%M:%S')))
+                store_game_head(c, user_id, new_name, head)
                 conn.commit()
             
             flash(f"Game saved as {new_name}!", "success")
@@ -587,13 +637,8 @@ def overwrite_game():
             # Clear pending session data
             session.pop('pending_save_filename', None)
             session.pop('pending_game_state', None)
-            save_temp_game_state(game_state)
             upload_db_to_gcs()
             return redirect(url_for("game"))
-        except json.JSONDecodeError as e:
-            flash("Invalid game state data.", "error")
-            create_log(f"\nROUTE /OVERWRITE_GAME: JSON decode error for user {username}: {str(e)}\n", force_log=True)
-            return redirect(url_for("game"))
         except Exception as e:
             flash(f"Failed to save game: {str(e)}", "error")
             create_log(f"\n\nROUTE /OVERWRITE_GAME: Error saving game for user {username}: {str(e)}\n\n", force_log=True)
@@ -0,0 +1,48 @@
+from config import CLUE_USE_YES_MATCHES
+
+# Local check of whether a combat action uses the hint shown to the player. Texts arrive already
+# normalized (accents folded, lowercase, no punctuation, see main_flask.normalize_command).
+
+STOPWORDS = {
+    "a", "ao", "aos", "as", "ate", "com", "como", "da", "das", "de", "dela", "dele", "do", "dos", "e", "ela", "ele",
+    "eles", "em", "entre", "era", "essa", "esse", "esta", "este", "eu", "foi", "ha", "isso", "isto", "ja", "lhe",
+    "mais", "mas", "me", "mesmo", "meu", "minha", "muito", "na", "nas", "no", "nos", "o", "os", "ou", "para", "pela",
+    "pelo", "por", "qual", "que", "quando", "se", "sem", "ser", "seu", "sua", "tem", "ter", "um", "uma", "voce", "vou",
+    "entao", "agora", "tento", "tentar", "tente", "usar", "uso", "use", "fazer", "faco", "vai", "sobre", "contra"
+}
+
+# Longest suffixes first; a light version of the RSLP steps (plural, feminine, adverb, augmentative, verb)
+SUFFIXES = (
+    "amentos", "imentos", "amento", "imento", "adoras", "adores", "adora", "ador", "mente", "idades", "idade",
+    "inhos", "inhas", "inho", "inha", "zinho", "zinha", "issimo", "issima", "ando", "endo", "indo", "aram", "eram",
+    "iram", "avam", "aria", "eria", "iria", "ados", "adas", "idos", "idas", "ado", "ada", "ido", "ida", "oes", "aes",
+    "ais", "eis", "ois", "ar", "er", "ir", "ou", "eu", "iu", "am", "em", "es", "as", "os", "a", "o", "e", "s"
+)
+MIN_STEM = 3
+
+def stem(word):
+    for suffix in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= MIN_STEM:
+            return word[:-len(suffix)]
+    return word
+
+def content_stems(normalized_text):
+    return {stem(word) for word in normalized_text.split() if word not in STOPWORDS and len(word) > 2}
+
+def evaluate_clue_use(normalized_action, normalized_clue):
+    """Return True/False when the action clearly uses / ignores the hint, or None for borderline cases
+    that should be left to the model.
+    """
+    action_stems = content_stems(normalized_action)
+    clue_stems = content_stems(normalized_clue)
+    if not action_stems or not clue_stems:
+        return False
+    matches = len(action_stems & clue_stems)
+    # Same root with a different ending the stemmer missed ("esquiva" / "esquivando")
+    partial = sum(1 for a in action_stems - clue_stems for c in clue_stems - action_stems
+                  if min(len(a), len(c)) >= 4 and (a.startswith(c) or c.startswith(a)))
+    if matches >= CLUE_USE_YES_MATCHES or (matches and matches + partial >= CLUE_USE_YES_MATCHES + 1):
+        return True
+    if matches + partial == 0:
+        return False
+    return None
@@ -13,6 +13,7 @@ WORLD_PATH = os.path.join('.', 'SeuMundo_L1.json')
 SAVE_GAMES_PATH = os.path.join('.', 'game_saves')
 TEMP_SAVES_PATH = os.path.join('temp_saves', 'last_session.json')
 DB_PATH = os.path.join('database', 'users.db')
+NARRATIVE_CACHE_PATH = os.path.join('database', 'narrative_cache.db')
 
 # Load environment variables if running locally
 load_dotenv()
@@ -73,8 +74,120 @@ load_config()
 # More configuration
 MODEL = "meta-llama/Llama-3-70b-chat-hf"
 IS_SAFE_MODEL = "Meta-Llama/LlamaGuard-2-8b"
+SMALL_MODEL = "meta-llama/Llama-3-8b-chat-hf"
+# Model tier per LLM call site (see main_flask.chat_completion). Unlisted call sites use the large tier.
+# Small-tier JSON calls are validated and retried on the large tier when the output does not fit the schema.
+MODEL_ROUTING_ENABLED = os.environ.get("MODEL_ROUTING_ENABLED", "True").lower() == "true"
+MODEL_TIERS = {"large": MODEL, "small": SMALL_MODEL}
+MODEL_ROUTES = {
+    "command_interpreter": "small",
+    "puzzle_judge": "small",
+    "inventory": "small",
+    "summarize": "small"
+}
 IMAGE_MODEL = "black-forest-labs/FLUX.1-schnell-Free"
 MAX_SAVE = 5  # Maximum number of saved games per user    
+HISTORY_PAGE_SIZE = 20  # History entries rendered on load and fetched per /history page
+HISTORY_MAX_PAGE_SIZE = 100  # Upper bound for the /history limit parameter
+CLIENT_VIEW_CACHE_SIZE = 4096  # Users whose last client view a worker keeps for patches
+
+# Turn mode: "two_step" (interpreter call, then an action-specific call) or "single" (one structured call)
+TURN_MODE = os.environ.get("TURN_MODE", "two_step")
+
+# Speculative execution of the suggested next command
+SPECULATION_ENABLED = os.environ.get("SPECULATION_ENABLED", "True").lower() == "true"
+SPECULATION_MAX_CALLS = 4  # LLM calls a speculative turn may make
+SPECULATION_MAX_TOKENS = 6000  # LLM tokens a speculative turn may spend
+SPECULATION_WAIT_SECONDS = 20  # How long a matching command waits for a speculation still running
+
+# Cross-user narrative cache for generic commands
+NARRATIVE_CACHE_ENABLED = os.environ.get("NARRATIVE_CACHE_ENABLED", "True").lower() == "true"
+NARRATIVE_CACHE_SIMILARITY = 0.6  # Minimum trigram Jaccard similarity between commands
+NARRATIVE_CACHE_TTL = 6 * 3600  # Seconds an entry stays fresh
+NARRATIVE_CACHE_MAX_SERVES = 25  # An entry is retired after this many hits
+NARRATIVE_CACHE_VARIANTS = 3  # Variants kept per command before entries are reused
+NARRATIVE_CACHE_NEW_VARIANT_CHANCE = 0.5  # Chance of generating a new variant while below NARRATIVE_CACHE_VARIANTS
+
+# Puzzle library and local solution judge
+PUZZLE_LIBRARY_PATH = os.path.join('database', 'puzzle_library.db')
+PUZZLE_LIBRARY_MIN = 10  # A background refill is started below this many puzzles
+PUZZLE_LIBRARY_BATCH = 5  # Puzzles generated per refill call
+PUZZLE_TYPO_MIN_CHARS = 5  # Shortest answer accepted with a typo (two swapped letters) without the model judge
+PUZZLE_FUZZY_REJECT = 0.5  # Similarity below which an answer sharing no word is rejected without the model judge
+
+# Local check of hint use in combat
+CLUE_USE_YES_MATCHES = 2  # Shared content words (stems) from which an action counts as using the hint
+
+# Tiered moderation (is_safe)
+MODERATION_CACHE_SIZE = 2048  # Model verdicts kept for flagged texts
+MODERATION_TIMEOUT = 20  # Seconds a turn waits for the model check of flagged input before refusing it
+
+# Together API client (llm_client.py)
+TOGETHER_API_URL = "https://api.together.xyz/v1"
+LLM_POOL_SIZE = 8  # Keep-alive connections per worker
+LLM_TIMEOUTS = {  # Seconds per request attempt, per call site
+    "default": 30,
+    "command_interpreter": 10,
+    "puzzle_judge": 8,
+    "inventory": 10,
+    "is_safe": 8,
+    "exploration": 40,
+    "puzzle_library": 60,
+    "game_objective": 60,
+    "image_generator": 30
+}
+LLM_MAX_RETRIES = 2  # Retries on 429/5xx/network errors, with jittered exponential backoff
+LLM_RETRY_BASE_DELAY = 0.5
+LLM_RETRY_MAX_DELAY = 4
+# Call sites on the player's critical path: a duplicate request is sent once the call site's p95 latency has passed
+LLM_LATENCY_CRITICAL = {"command_interpreter", "single_turn", "general_action", "npc_dialogue", "ally_confirmation", "combat_resolution", "puzzle_judge"}
+LLM_HEDGE_MIN_SAMPLES = 20  # Latency samples needed before hedging a call site
+LLM_HEDGE_THREADS = 32  # Threads per worker for hedged calls (their original request and the duplicate)
+LLM_BREAKER_THRESHOLD = 5  # Consecutive failed calls that open the circuit
+LLM_BREAKER_COOLDOWN = 30  # Seconds calls fail fast before a probe is let through
+
+# Rate limiter shared by the workers (rate_limiter.py)
+RATE_LIMIT_PATH = os.path.join('database', 'rate_limit.db')
+LLM_RATE_PER_SECOND = 8  # Sustained Together requests per second across workers
+LLM_BURST = 16  # Bucket capacity
+LLM_RATE_MAX_WAIT = 20  # Seconds a call waits for a slot before failing with LLMUnavailable
+LLM_BACKGROUND_CALL_SITES = {"puzzle_library", "summarize"}  # Always queued behind interactive calls
+LLM_FAIR_QUEUE_MEMORY = 300  # Seconds a worker remembers when it last served a user (fair queue order)
+
+# Single-flight coalescing of identical in-flight LLM requests (single_flight.py)
+SINGLE_FLIGHT_SHARED = os.environ.get("SINGLE_FLIGHT_SHARED", "False").lower() == "true"  # Also coalesce across workers
+SINGLE_FLIGHT_PATH = os.path.join('database', 'single_flight.db')
+SINGLE_FLIGHT_WAIT = 60  # Seconds a worker waits for another worker's result before sending its own request
+
+# Prompt context budgets (context_budget.py), in tokens per prompt
+PROMPT_TOKEN_BUDGETS = {
+    "default": 2000,
+    "command_interpreter": 1500,
+    "npc_dialogue": 1500,
+    "general_action": 1500,
+    "exploration": 1800,
+    "single_turn": 2200,
+    "true_clue": 1200,
+    "false_clue": 1200,
+    "game_objective": 1500
+}
+WORD_CHARS_PER_TOKEN = 4.5  # Starting point of the token estimator, calibrated against the provider's counts
+
+# Derived clue counters and NPC buckets (derived_state.py)
+DERIVED_STATE_CHECK = os.environ.get("DERIVED_STATE_CHECK", "False").lower() == "true"  # Rebuild and compare the index every turn
+
+# World digests for the game objective prompt (world_index.py)
+WORLD_DIGEST_WORDS = 20  # Words kept from the first sentence of each world, kingdom and town description
+WORLD_NPC_DIGEST_WORDS = 10  # Same for NPC descriptions
+WORLD_OBJECTIVE_NPCS = 6  # NPCs of the starting kingdom offered to the objective generator
+
+# Compressed game_state column (state_store.py)
+STATE_COMPRESSION = os.environ.get("STATE_COMPRESSION", "True").lower() == "true"  # Write saves compressed (reads handle both)
+STATE_ZSTD_LEVEL = 6
+STATE_DICT_SIZE = 32 * 1024  # Bytes of the trained dictionary
+STATE_DICT_SAMPLES = 200  # Most recent saves the dictionary is trained on
+STATE_DICT_MIN_SAMPLES = 20  # Below this, saves are compressed without a dictionary until the next start
+HISTORY_CHUNK_ENTRIES = 32  # History entries per shared chunk; the head of a save keeps fewer than this inline
 
 SOUND_MAP = {
     "dialogue": "static/audio/dialogue.mp3",
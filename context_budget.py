@@ -0,0 +1,96 @@
+import re
+import math
+import threading
+
+from config import VERBOSE, PROMPT_TOKEN_BUDGETS, WORD_CHARS_PER_TOKEN
+from create_log import create_log
+
+# Token budget for the variable sections of a prompt (history, objective, world...). Tokens are
+# estimated locally (Llama tokenizers split Portuguese words into ~1-3 pieces, punctuation into its
+# own) and the estimate is calibrated against the prompt_tokens reported by the provider.
+
+TOKEN_PIECES = re.compile(r"\w+|[^\w\s]")
+
+calibration = {'ratio': 1.0, 'samples': 0}
+usage = {}
+lock = threading.Lock()
+# Last prompt built by fit_prompt on this thread, the only kind calibrate learns from
+fitted = threading.local()
+
+def raw_estimate(text):
+    return sum(max(1, math.ceil(len(piece) / WORD_CHARS_PER_TOKEN)) if piece[0].isalnum() or piece[0] == "_" else 1
+               for piece in TOKEN_PIECES.findall(text or ""))
+
+def estimate_tokens(text):
+    return int(raw_estimate(text) * calibration['ratio'])
+
+def calibrate(prompt, prompt_tokens):
+    """Move the estimate towards the provider's count of a prompt that was actually sent.
+    Only prompts built by fit_prompt count: the estimate is for their sections, and other calls
+    (moderation, fixed templates) carry a different share of chat template tokens.
+    """
+    if getattr(fitted, 'prompt', None) is not prompt:
+        return
+    fitted.prompt = None
+    estimated = raw_estimate(prompt)
+    if not prompt_tokens or not estimated:
+        return
+    with lock:
+        weight = 1 / min(calibration['samples'] + 1, 50)
+        calibration['ratio'] += (prompt_tokens / estimated - calibration['ratio']) * weight
+        calibration['samples'] += 1
+
+def get_budget_usage():
+    with lock:
+        snapshot = {call_site: dict(stats) for call_site, stats in usage.items()}
+        snapshot['calibration_ratio'] = round(calibration['ratio'], 3)
+    return snapshot
+
+def trim_text(text, tokens, target, keep):
+    """Cut text to about target tokens on a word boundary, keeping its 'start' or its 'end'."""
+    if target <= 0:
+        return ""
+    chars = int(len(text) * target / tokens)
+    if keep == "end":
+        cut = text[len(text) - chars:]
+        return "…" + cut[cut.find(" ") + 1:] if " " in cut else cut
+    cut = text[:chars]
+    return cut[:cut.rfind(" ")] + "…" if " " in cut else cut
+
+def fit_prompt(call_site, render, sections):
+    """Render a prompt whose variable sections fit the call site's budget (PROMPT_TOKEN_BUDGETS).
+    Args:
+        render: function taking the section texts as keyword arguments and returning the prompt.
+        sections: list of dicts {'name', 'text', 'priority', 'keep'}. Lowest priority is trimmed first;
+            'keep' is "end" for history (the most recent part stays) or "start" for descriptions.
+    """
+    budget = PROMPT_TOKEN_BUDGETS.get(call_site, PROMPT_TOKEN_BUDGETS['default'])
+    texts = {section['name']: str(section['text'] or "") for section in sections}
+    available = budget - estimate_tokens(render(**{name: "" for name in texts}))
+    tokens = {name: estimate_tokens(text) for name, text in texts.items()}
+    excess = sum(tokens.values()) - available
+    trimmed = []
+    for section in sorted(sections, key=lambda s: s['priority']):
+        if excess <= 0:
+            break
+        name = section['name']
+        target = max(0, tokens[name] - excess)
+        if target < tokens[name]:
+            texts[name] = trim_text(texts[name], tokens[name], target, section.get('keep', "start"))
+            excess -= tokens[name] - target
+            tokens[name] = target
+            trimmed.append(name)
+    prompt = render(**texts)
+    used = estimate_tokens(prompt)
+    with lock:
+        stats = usage.setdefault(call_site, {'calls': 0, 'budget': budget, 'avg_tokens': 0.0, 'max_tokens': 0, 'trimmed': 0})
+        stats['calls'] += 1
+        stats['avg_tokens'] = round(stats['avg_tokens'] + (used - stats['avg_tokens']) / stats['calls'], 1)
+        stats['max_tokens'] = max(stats['max_tokens'], used)
+        stats['trimmed'] += bool(trimmed)
+    if trimmed:
+        create_log(f"CONTEXT_BUDGET: FIT_PROMPT: {call_site}: trimmed {', '.join(trimmed)} to fit {used}/{budget} tokens", force_log=True)
+    elif VERBOSE:
+        create_log(f"CONTEXT_BUDGET: FIT_PROMPT: {call_site}: {used}/{budget} tokens")
+    fitted.prompt = prompt
+    return prompt
@@ -0,0 +1,91 @@
+from create_log import create_log
+
+# Counters and buckets derived from game_state['awarded_clues'] and game_state['npc_status'], kept
+# in game_state['derived'] (saved with the game) so the checks made on every turn do not scan them:
+#     {'clues': {'false': n, 'true': n},
+#      'status': {status: [npc]}, 'supposed_status': {status: [npc]},
+#      'confirmed': {status: [npc]}}   # supposed_status == status
+# Clues and NPC statuses change only through add_clue and set_npc_status; check_derived compares the
+# index with a rebuild from the source lists.
+
+def is_false_clue(clue):
+    # Clues from false clue events were once saved with a 'false' key ('false_clue' is then the
+    # schema default, False)
+    return bool(clue.get('false_clue') or clue.get('false'))
+
+def clue_kind(clue):
+    """'false', 'true' (awarded true clue) or None (true clue not awarded yet)."""
+    if is_false_clue(clue):
+        return 'false'
+    return 'true' if clue.get('awarded', True) else None
+
+def build_derived(game_state):
+    derived = {'clues': {'false': 0, 'true': 0}, 'status': {}, 'supposed_status': {}, 'confirmed': {}}
+    for clue in game_state.get('awarded_clues', []):
+        kind = clue_kind(clue)
+        if kind:
+            derived['clues'][kind] += 1
+    for name, npc in game_state.get('npc_status', {}).items():
+        add_npc_to_buckets(derived, name, npc)
+    return derived
+
+def add_npc_to_buckets(derived, name, npc):
+    derived['status'].setdefault(npc['status'], []).append(name)
+    derived['supposed_status'].setdefault(npc['supposed_status'], []).append(name)
+    if npc['supposed_status'] == npc['status']:
+        derived['confirmed'].setdefault(npc['status'], []).append(name)
+
+def remove_npc_from_buckets(derived, name, npc):
+    for bucket, status in (('status', npc['status']), ('supposed_status', npc['supposed_status']), ('confirmed', npc['status'])):
+        names = derived[bucket].get(status, [])
+        if name in names:
+            names.remove(name)
+
+def ensure_derived(game_state):
+    """Build the index for new games and saves from before it existed."""
+    if 'derived' not in game_state:
+        game_state['derived'] = build_derived(game_state)
+    return game_state['derived']
+
+def add_clue(game_state, clue):
+    game_state['awarded_clues'].append(clue)
+    kind = clue_kind(clue)
+    if kind:
+        ensure_derived(game_state)['clues'][kind] += 1
+
+def set_npc_status(game_state, name, supposed_status=None, status=None):
+    derived = ensure_derived(game_state)
+    npc = game_state['npc_status'][name]
+    remove_npc_from_buckets(derived, name, npc)
+    if supposed_status is not None:
+        npc['supposed_status'] = supposed_status
+    if status is not None:
+        npc['status'] = status
+    add_npc_to_buckets(derived, name, npc)
+
+def clue_counts(game_state):
+    """(false_clue_count, true_clue_count, total_clue_count)"""
+    clues = ensure_derived(game_state)['clues']
+    return clues['false'], clues['true'], clues['false'] + clues['true']
+
+def npcs_with(game_state, bucket, status):
+    """NPCs whose 'status' or 'supposed_status' is status, or 'confirmed' ones (supposed_status == status)."""
+    return ensure_derived(game_state)[bucket].get(status, [])
+
+def comparable(derived):
+    buckets = {section: {status: sorted(names) for status, names in derived.get(section, {}).items() if names}
+               for section in ('status', 'supposed_status', 'confirmed')}
+    return {'clues': derived.get('clues'), **buckets}
+
+def check_derived(game_state, repair=True):
+    """Compare the index with a rebuild from awarded_clues and npc_status. Returns the differing
+    sections; with repair, the rebuilt index replaces the stored one.
+    """
+    rebuilt = build_derived(game_state)
+    stored, expected = comparable(game_state.get('derived', {})), comparable(rebuilt)
+    differences = [section for section in expected if stored[section] != expected[section]]
+    if differences:
+        create_log(f"DERIVED_STATE: CHECK_DERIVED: Index out of sync in {', '.join(differences)}", force_log=True)
+        if repair:
+            game_state['derived'] = rebuilt
+    return differences
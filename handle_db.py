@@ -1,5 +1,4 @@
 import os
-import json
 import time
 from google.cloud import storage
 import bcrypt
@@ -7,7 +6,8 @@ from config import bucket
 import sqlite3
 
 from config import DB_PATH, GCS_BUCKET_NAME, VERBOSE, MAX_SAVE, TEMP_SAVES_PATH
-from main_flask import validate_game_state
+from main_flask import load_game_state
+from state_store import copy_game_state
 from create_log import create_log
 
 def init_db():
@@ -71,7 +71,9 @@ def get_db_connection(int_verbose=False):
         create_log(f"HANDLE_DB: GET_DB_CONNECTION: Connected to database {DB_PATH}")
     return conn
 
-def confirm_save(filename, game_state, user_id):
+def confirm_save(filename, user_id, source_name='autosave'):
+    """Save the source game (the autosave) as filename. Copy-on-write: the slot gets the head
+    record of the source, its history chunks are shared (state_store.py)."""
     with get_db_connection() as conn:
         c = conn.cursor()
         c.execute("SELECT COUNT(*) FROM game_states WHERE user_id = ? AND game_name != 'autosave'", (user_id,))
@@ -82,8 +84,8 @@ def confirm_save(filename, game_state, user_id):
             # Instead of raising an error, return a signal to prompt overwrite
             return {"status": "max_saves_reached", "message": f"Maximum of {MAX_SAVE} saved games allowed."}
         
-        c.execute("INSERT OR REPLACE INTO game_states (user_id, game_name, game_state, created_at) VALUES (?, ?, ?, ?)",
-                  (user_id, filename, json.dumps(game_state), time.strftime('%Y-%m-%d %H:%M:%S')))
+        if not copy_game_state(c, user_id, source_name, filename):
+            raise ValueError(f"No game {source_name} to save")
         conn.commit()
     return {"status": "success", "message": f"Game saved as {filename}"}
 
@@ -114,8 +116,8 @@ def retrieve_game(selected_file, user_id, int_verbose=False):
                 create_log(f"\n\nHANDLE_DB: RETRIEVE_GAME: Error: Game {selected_file} not found for user {user_id}\n\n", force_log=True)
                 raise ValueError("Selected save file does not exist")
             
-            game_state = json.loads(row['game_state'])
-            if not validate_game_state(game_state):
+            game_state = load_game_state(row['game_state'])
+            if game_state is None:
                 create_log("\n\nHANDLE_DB: RETRIEVE_GAME: Error: Invalid game state\n\n", force_log=True)
                 raise ValueError("Invalid save file: No game state found")
             
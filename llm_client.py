@@ -0,0 +1,195 @@
+import time
+import json
+import random
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import (
+    TOGETHER_API_KEY, TOGETHER_API_URL, LLM_POOL_SIZE, LLM_TIMEOUTS, LLM_MAX_RETRIES, LLM_RETRY_BASE_DELAY,
+    LLM_RETRY_MAX_DELAY, LLM_LATENCY_CRITICAL, LLM_HEDGE_MIN_SAMPLES, LLM_HEDGE_THREADS, LLM_BREAKER_THRESHOLD,
+    LLM_BREAKER_COOLDOWN
+)
+from create_log import create_log
+import rate_limiter
+import single_flight
+
+# Thin HTTP client for the Together API, used instead of the SDK client so every call has a
+# timeout, retries, hedging and a circuit breaker. Calls fail with LLMUnavailable, which callers
+# turn into their usual fallback texts.
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+class LLMUnavailable(Exception):
+    pass
+
+class LLMRateLimited(LLMUnavailable):
+    """No request slot within LLM_RATE_MAX_WAIT (see rate_limiter)."""
+    pass
+
+class LLMRequestError(Exception):
+    """Non-retryable error response (bad request, auth...)."""
+    pass
+
+# Keep-alive connections shared by every thread of the worker
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=LLM_POOL_SIZE))
+session.headers.update({"Authorization": f"Bearer {TOGETHER_API_KEY}", "Content-Type": "application/json"})
+
+# Hedged calls run both the original and the duplicate request here, so the caller can take
+# whichever answers first
+hedge_executor = ThreadPoolExecutor(max_workers=LLM_HEDGE_THREADS, thread_name_prefix="llm")
+
+stats = {}
+latencies = {}
+breaker = {'failures': 0, 'open_until': 0.0, 'probing': False}
+lock = threading.Lock()
+
+def count(name, amount=1):
+    with lock:
+        stats[name] = stats.get(name, 0) + amount
+
+def get_client_stats():
+    with lock:
+        snapshot = dict(stats)
+        snapshot['breaker_open'] = breaker['open_until'] > time.time()
+    for scope, suppressed in single_flight.get_suppressed_counts().items():
+        snapshot[f'duplicates_suppressed.{scope}'] = suppressed
+    return snapshot
+
+def hedge_delay(call_site):
+    """p95 latency of the call site, once there are enough samples to trust it."""
+    with lock:
+        samples = sorted(latencies.get(call_site, ()))
+    if len(samples) < LLM_HEDGE_MIN_SAMPLES:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+def breaker_allows():
+    now = time.time()
+    with lock:
+        if breaker['failures'] < LLM_BREAKER_THRESHOLD:
+            return True
+        if now < breaker['open_until'] or breaker['probing']:
+            return False
+        # Half-open: after the cooldown a single probe goes through, its outcome closes or reopens the circuit
+        breaker['probing'] = True
+        return True
+
+def record_outcome(success):
+    with lock:
+        if success:
+            breaker.update(failures=0, open_until=0.0, probing=False)
+            return
+        breaker['failures'] += 1
+        breaker['probing'] = False
+        if breaker['failures'] >= LLM_BREAKER_THRESHOLD:
+            breaker['open_until'] = time.time() + LLM_BREAKER_COOLDOWN
+            stats['breaker_trips'] = stats.get('breaker_trips', 0) + 1
+            create_log(f"LLM_CLIENT: RECORD_OUTCOME: Circuit open for {LLM_BREAKER_COOLDOWN}s after {breaker['failures']} failures", force_log=True)
+
+def post_with_retry(path, payload, timeout, user=None, priority="interactive", stop=None):
+    """POST with jittered exponential backoff on 429/5xx and network errors. Every attempt
+    waits for a slot from the shared rate limiter first. Once the optional stop event is set
+    (the other attempt of a hedged call got the response), no further attempt is made.
+    """
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        waited = rate_limiter.acquire(user, priority)
+        if waited is None:
+            count('rate_limit_timeouts')
+            raise LLMRateLimited(f"{path}: no request slot for {priority} call")
+        if waited > 0.05:
+            count(f'rate_limit_waits.{priority}')
+        try:
+            response = session.post(f"{TOGETHER_API_URL}{path}", json=payload, timeout=timeout)
+            rate_limiter.observe_response(response.status_code, response.headers)
+            if response.status_code < 400:
+                return response.json()
+            if response.status_code not in RETRYABLE_STATUS:
+                raise LLMRequestError(f"{response.status_code}: {response.text[:200]}")
+            error = f"HTTP {response.status_code}"
+            retry_after = response.headers.get("Retry-After")
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error, retry_after = f"{type(e).__name__}", None
+        if attempt == LLM_MAX_RETRIES or (stop is not None and stop.is_set()):
+            raise LLMUnavailable(f"{path}: {error} after {attempt + 1} attempts")
+        count('retries')
+        delay = min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.5)
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(float(retry_after), LLM_RETRY_MAX_DELAY))
+        if stop is None:
+            time.sleep(delay)
+        elif stop.wait(delay):
+            raise LLMUnavailable(f"{path}: {error}, answered by the other attempt")
+
+def request(call_site, path, payload, user=None, priority="interactive"):
+    """Send one API request for a call site: circuit breaker, per-call-site timeout, retries and,
+    for latency-critical call sites, a hedged duplicate once the p95 latency has passed.
+    """
+    if not breaker_allows():
+        count('breaker_rejections')
+        raise LLMUnavailable(f"{call_site}: circuit open")
+    timeout = LLM_TIMEOUTS.get(call_site, LLM_TIMEOUTS['default'])
+    started = time.perf_counter()
+    try:
+        delay = hedge_delay(call_site) if call_site in LLM_LATENCY_CRITICAL else None
+        if delay is None:
+            result = post_with_retry(path, payload, timeout, user, priority)
+        else:
+            result = hedged_post(path, payload, timeout, delay, user, priority)
+    except (LLMRequestError, LLMRateLimited):
+        # The request itself is wrong, or never left the queue: says nothing about availability
+        record_outcome(True)
+        raise
+    except Exception:
+        record_outcome(False)
+        count('failures')
+        raise
+    record_outcome(True)
+    with lock:
+        latencies.setdefault(call_site, deque(maxlen=200)).append(time.perf_counter() - started)
+    return result
+
+def hedged_post(path, payload, timeout, delay, user=None, priority="interactive"):
+    """Send the request and, if no response arrived within delay, a duplicate. The first successful
+    response is returned; a failed attempt only counts once both have failed. The attempt still
+    running when the other answers makes no further retries.
+    """
+    answered = threading.Event()
+    primary = hedge_executor.submit(post_with_retry, path, payload, timeout, user, priority, answered)
+    done, _ = wait([primary], timeout=delay)
+    if done:
+        return primary.result()
+    count('hedges_sent')
+    hedge = hedge_executor.submit(post_with_retry, path, payload, timeout, user, priority, answered)
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                answered.set()
+                if future is hedge:
+                    count('hedges_won')
+                return future.result()
+            # A request error (bad payload) would fail the other attempt too
+            if isinstance(future.exception(), LLMRequestError):
+                answered.set()
+                raise future.exception()
+            error = error or future.exception()
+    raise error
+
+def coalesced_request(call_site, path, payload, user=None, priority="interactive"):
+    """request(), with identical concurrent payloads sent once and the response shared (single_flight)."""
+    key = hashlib.sha256(f"{path}:{json.dumps(payload, sort_keys=True, ensure_ascii=False)}".encode('utf-8')).hexdigest()
+    return single_flight.run(key, lambda: request(call_site, path, payload, user, priority))
+
+def chat(call_site, model, messages, user=None, priority="interactive", **params):
+    return coalesced_request(call_site, "/chat/completions", {"model": model, "messages": messages, **params}, user, priority)
+
+def generate_image(call_site, model, prompt, user=None, priority="interactive", **params):
+    return coalesced_request(call_site, "/images/generations", {"model": model, "prompt": prompt, **params}, user, priority)
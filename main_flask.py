@@ -9,35 +9,56 @@ import traceback
 import sqlite3
 import random
 import uuid
-from flask import session
-from together import Together
+import copy
+import hashlib
+import threading
+import unicodedata
+import jsonpatch
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from flask import session, has_request_context
 from create_log import create_log
 from dotenv import load_dotenv
 from google.cloud import storage
 
 from config import (
     VERBOSE, GCS_BUCKET_NAME, TOGETHER_API_KEY, MODEL, IS_SAFE_MODEL, IMAGE_MODEL, 
+    MODEL_ROUTING_ENABLED, MODEL_TIERS, MODEL_ROUTES, LLM_BACKGROUND_CALL_SITES,
     INITIAL_IMAGE_FILE_PATH, DEFAULT_IMAGE_FILE_PATH, DEFAULT_AUDIO_FILE_PATH, 
     IMAGE_FILE_PREFIX, WORLD_PATH, SAVE_GAMES_PATH, TEMP_SAVES_PATH, DB_PATH, MAX_SAVE,
-    ERROR_IMAGE_FILE_PATH, bucket, SOUND_MAP
+    ERROR_IMAGE_FILE_PATH, bucket, SOUND_MAP, HISTORY_PAGE_SIZE, MODERATION_TIMEOUT, CLIENT_VIEW_CACHE_SIZE,
+    SPECULATION_ENABLED, SPECULATION_MAX_CALLS, SPECULATION_MAX_TOKENS, SPECULATION_WAIT_SECONDS,
+    NARRATIVE_CACHE_ENABLED, TURN_MODE, PUZZLE_LIBRARY_MIN, PUZZLE_LIBRARY_BATCH, MODERATION_CACHE_SIZE,
+    DERIVED_STATE_CHECK
 )
 
 from prompts import (
-    everyone_content_policy, system_inventory_prompt, get_npc_dialogue_prompt,
-    command_interpreter_prompt, get_false_clue_prompt, get_trick_prompt, get_attack_prompt,
-    get_is_safe_prompt, get_combat_resolution_prompt, get_check_clue_prompt, 
+    get_inventory_prompt, get_npc_dialogue_prompt, get_false_clue_dialogue_prompt,
+    get_command_interpreter_prompt, get_false_clue_prompt, get_trick_prompt, get_attack_prompt,
+    get_is_safe_prompt, get_combat_resolution_prompt,
     get_exploration_prompt, get_game_objective_prompt,get_general_action_prompt,
-    get_true_clue_prompt, get_true_ally_confirmation_prompt
+    get_true_clue_prompt, get_true_ally_confirmation_prompt, get_single_turn_prompt,
+    get_puzzle_library_prompt, get_puzzle_judge_prompt
 )
 
-from world import world
+from world_index import get_objective_world, resolve_npc, resolve_location
+from map_graph import ensure_map_graph, get_exits, exits_text, answer_navigation
+from state_model import GameStateError, check_game_state, history_key
+from state_store import read_game_state, read_game_head
+from derived_state import build_derived, ensure_derived, check_derived, add_clue, set_npc_status, clue_counts, npcs_with
+from narrative_cache import lookup_narrative, store_narrative
+from puzzle_library import count_puzzles, store_puzzles, take_puzzle, mark_puzzle_served, judge_answer
+from clue_evaluator import evaluate_clue_use
+from moderation import screen_text
+import llm_client
+from context_budget import calibrate, get_budget_usage
+from llm_client import LLMUnavailable
 
-# Initialize Together API
+# Together API calls go through llm_client (pooling, timeouts, retries, hedging, circuit breaker)
 together_api_key = TOGETHER_API_KEY
 if not together_api_key:
     raise ValueError("TOGETHER_API_KEY not found")
     create_log("\n\nMAIN_FLASK: TOGETHER_API_KEY not found\n\n", force_log=True)
-client = Together(api_key=together_api_key)
 
 # Initialize last_saved_history
 last_saved_history = None
@@ -54,14 +75,222 @@ SKILL = 50  # Base skill level (0-100)
 INTELLIGENCE = 50  # Base intelligence level (0-100)
 STRENGTH = 50  # Base strength level (0-100)
 
+# Background work (speculative turns) runs here, outside the request thread
+background_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="background")
+# Set while a puzzle library refill is queued or running
+puzzle_refill_running = threading.Event()
+# Model checks of flagged player input run here, alongside the turn they belong to
+moderation_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="moderation")
+
+# Per-thread turn context. A 'budget' dict limits the LLM calls a background job may make,
+# 'speculative' marks a turn run ahead of the player (no temp saves), and 'deferred' collects
+# the side effects of a turn that may still be dropped (run_side_effect): a turn waiting for its
+# moderation verdict, or a speculative turn until the player commits it.
+turn_context = threading.local()
+
+# Process-wide counters, exposed by the /metrics route
+metrics = {}
+metrics_lock = threading.Lock()
+# Latency and LLM call count of recent turns, per turn mode
+turn_samples = {}
+# Latency of recent puzzle attempts and whether they were judged locally
+puzzle_samples = deque(maxlen=1000)
+# Latency and tokens of recent LLM calls, per route ("call_site:model")
+route_samples = {}
+
+class LLMBudgetExceeded(Exception):
+    pass
+
+def increment_metric(name, amount=1):
+    with metrics_lock:
+        metrics[name] = metrics.get(name, 0) + amount
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    return {
+        'p50_latency': round(latencies[len(latencies) // 2], 3),
+        'p95_latency': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3)
+    }
+
+def get_metrics():
+    with metrics_lock:
+        snapshot = dict(metrics)
+    settled = snapshot.get('speculation_hits', 0) + snapshot.get('speculation_misses', 0)
+    snapshot['speculation_hit_rate'] = round(snapshot.get('speculation_hits', 0) / settled, 3) if settled else None
+    with metrics_lock:
+        samples_by_mode = {mode: list(samples) for mode, samples in turn_samples.items()}
+        attempts = list(puzzle_samples)
+        samples_by_route = {route: list(samples) for route, samples in route_samples.items()}
+    snapshot['turns'] = {}
+    for mode, samples in samples_by_mode.items():
+        snapshot['turns'][mode] = {
+            'count': len(samples),
+            'calls_per_turn': round(sum(calls for _, calls in samples) / len(samples), 2),
+            **latency_summary(latency for latency, _ in samples)
+        }
+    if attempts:
+        snapshot['puzzle_attempts'] = {
+            'count': len(attempts),
+            'local_share': round(sum(1 for _, local in attempts if local) / len(attempts), 3),
+            **latency_summary(latency for latency, _ in attempts)
+        }
+    # Latency, tokens and schema failures of each call site on each model, to compare the tiers
+    snapshot['routes'] = {}
+    for route, samples in samples_by_route.items():
+        snapshot['routes'][route] = {
+            'count': len(samples),
+            'avg_tokens': round(sum(tokens for _, tokens in samples) / len(samples), 1),
+            'schema_failures': snapshot.get(f"route_schema_failures.{route}", 0),
+            **latency_summary(latency for latency, _ in samples)
+        }
+    snapshot['llm_client'] = llm_client.get_client_stats()
+    snapshot['prompt_budgets'] = get_budget_usage()
+    return snapshot
+
+def record_turn_sample(turn_mode, latency, calls):
+    with metrics_lock:
+        turn_samples.setdefault(turn_mode, deque(maxlen=1000)).append((latency, calls))
+
+def record_puzzle_sample(latency, local):
+    with metrics_lock:
+        puzzle_samples.append((latency, local))
+
+def record_route_sample(route, latency, tokens):
+    with metrics_lock:
+        route_samples.setdefault(route, deque(maxlen=1000)).append((latency, tokens))
+
+def route_model(call_site):
+    """Model for a call site according to MODEL_ROUTES (large tier when unlisted or routing is off)."""
+    if not MODEL_ROUTING_ENABLED:
+        return MODEL
+    return MODEL_TIERS.get(MODEL_ROUTES.get(call_site, "large"), MODEL)
+
+def llm_caller(call_site):
+    """(user, priority) of an LLM call, for the rate limiter's fair queue. Calls made while serving a
+    request are interactive; speculative turns, background jobs and LLM_BACKGROUND_CALL_SITES are not.
+    turn_context.user_id / turn_context.priority carry them into helper threads.
+    """
+    user = getattr(turn_context, 'user_id', None)
+    if user is None and has_request_context():
+        user = session.get('user_id')
+    priority = getattr(turn_context, 'priority', None) or ("interactive" if has_request_context() else "background")
+    if getattr(turn_context, 'speculative', False) or call_site in LLM_BACKGROUND_CALL_SITES:
+        priority = "background"
+    return user, priority
+
+def chat_completion(prompt, call_site, **kwargs):
+    """Send a single user prompt to MODEL and return the completion text.
+    Every chat call goes through here so token usage is counted per call site and
+    background jobs can be held to their own budget (see turn_context). The model comes
+    from the routing table (route_model) unless a 'model' kwarg is given.
+    """
+    budget = getattr(turn_context, 'budget', None)
+    if budget is not None and (budget['calls'] >= budget['max_calls'] or budget['tokens'] >= budget['max_tokens']):
+        budget['exhausted'] = True
+        raise LLMBudgetExceeded(f"{call_site}: budget of {budget['max_calls']} calls / {budget['max_tokens']} tokens exhausted")
+    model = kwargs.pop('model', None) or route_model(call_site)
+    started = time.perf_counter()
+    user, priority = llm_caller(call_site)
+    response = llm_client.chat(call_site, model, [{"role": "user", "content": prompt}], user=user, priority=priority, **kwargs)
+    tokens = (response.get('usage') or {}).get('total_tokens', 0) or 0
+    if model == MODEL:
+        # The estimator is calibrated for the main model's tokenizer
+        calibrate(prompt, (response.get('usage') or {}).get('prompt_tokens', 0))
+    record_route_sample(f"{call_site}:{model}", time.perf_counter() - started, tokens)
+    increment_metric(f"llm_calls.{call_site}")
+    increment_metric(f"llm_tokens.{call_site}", tokens)
+    turn_context.last_tokens = tokens
+    turn_context.turn_calls = getattr(turn_context, 'turn_calls', 0) + 1
+    if budget is not None:
+        budget['calls'] += 1
+        budget['tokens'] += tokens
+    return response['choices'][0]['message']['content']
+
+def parse_json_object(response):
+    """Parse a JSON object from a model response, also when it is wrapped in extra text. Returns None on failure."""
+    try:
+        return json.loads(response)
+    except (json.JSONDecodeError, TypeError):
+        json_match = re.search(r'\{.*\}', response or "", re.DOTALL)
+        if json_match:
+            try:
+                return json.loads(json_match.group(0))
+            except json.JSONDecodeError:
+                return None
+        return None
+
+def validate_schema(data, schema):
+    """Check that data is a dict whose keys have the types in schema ({key: type or tuple of types})."""
+    return isinstance(data, dict) and all(isinstance(data.get(key), expected) for key, expected in schema.items())
+
+def routed_json_completion(prompt, call_site, schema, check=None, **kwargs):
+    """chat_completion for call sites that return a JSON object. When the routed model's output
+    fails the schema (or the optional check), the call is repeated once on the large model.
+    Returns the parsed object of the last attempt, or None if it could not be parsed.
+    """
+    model = route_model(call_site)
+    data = parse_json_object(chat_completion(prompt, call_site, model=model, **kwargs))
+    if validate_schema(data, schema) and (check is None or check(data)):
+        return data
+    increment_metric(f"route_schema_failures.{call_site}:{model}")
+    if model == MODEL:
+        return data
+    create_log(f"MAIN_FLASK: ROUTED_JSON_COMPLETION: {call_site} output from {model} failed validation, retrying on {MODEL}", force_log=True)
+    increment_metric(f"route_fallbacks.{call_site}")
+    data = parse_json_object(chat_completion(prompt, call_site, model=MODEL, **kwargs))
+    if not (validate_schema(data, schema) and (check is None or check(data))):
+        increment_metric(f"route_schema_failures.{call_site}:{MODEL}")
+    return data
+
+ACTION_TYPES = ["dialogue", "exploration", "combat", "puzzle", "use_item", "investigate_npc", "generic"]
+SINGLE_TURN_SCHEMA = {'action_type': str, 'details': dict, 'narrative': str, 'itemUpdates': list, 'suggestion': str}
+INTERPRETER_SCHEMA = {'action_type': str}
+INVENTORY_SCHEMA = {'itemUpdates': list}
+PUZZLE_JUDGE_SCHEMA = {'solved': bool}
+
+def normalize_command(command):
+    """Normalize player input: case, accents, punctuation and spacing are ignored."""
+    text = unicodedata.normalize('NFKD', command or "")
+    text = "".join(ch for ch in text if not unicodedata.combining(ch)).lower()
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+def resolve_game_npc(name, game_state, int_verbose=False):
+    """NPC of the game the interpreter's (or player's) name refers to: "eira", "Eira Shadowglo"..."""
+    npc = resolve_npc(name, game_state['npc_status'])
+    if npc != name:
+        increment_metric('npc_names_resolved')
+        if int_verbose:
+            create_log(f"MAIN_FLASK: RESOLVE_GAME_NPC: Resolved {name} to {npc}")
+    return npc
+
+def default_game_objective():
+    """Objective used when the generated one cannot be parsed or does not fit the game state schema."""
+    return {
+        'objective': 'Em Eldrida, o traidor Lyrien Darkscale busca roubar a relíquia secreta EnterWealther, uma fonte de poder ancestral. Ele planeja realizar um ritual no solstício de verão para invocar um poder maligno. Só Eira Shadowglow, uma habilidosa guerreira, pode ajudá-lo a parar. Encontre o sábio Thorne Silvermist, que pode fornecer informações valiosas sobre EnterWealther; o mercador Rylan Stonebrook, que pode fornecer suprimentos e armas; e a druida Elara Moonwhisper, que pode fornecer ajuda mágica.',
+        'true_clue': {'content': 'Lyrien busca EnterWealther', 'id': 'clue1'},
+        'npcs': [
+            {'name': 'Lyrien Darkscale', 'status': 'Hostile', 'description': 'Mago sombrio com olhos penetrantes e aura misteriosa.'},
+            {'name': 'Eira Shadowglow', 'status': 'Allied', 'description': 'Guerreira ágil com cabelos negros e olhar determinado.'},
+            {'name': 'Thorne Silvermist', 'status': 'Neutral', 'description': 'Sábio eremita versado em segredos antigos.'},
+            {'name': 'Rylan Stonebrook', 'status': 'Neutral', 'description': 'Mercador astuto com contatos no mercado.'},
+            {'name': 'Elara Moonwhisper', 'status': 'Neutral', 'description': 'Druida mística ligada às forças da natureza.'}
+        ],
+        'welcome_message': 'Você chega em Eldrida e ouve rumores de traição em meio à celebração do solstício de verão.',
+        'initial_map': {
+            'Eldrida': {
+                'description': 'Uma cidade vibrante, cheia de pessoas se preparando para as festividades do solstício.',
+                'exits': ['Floresta de Eldrid', 'Colina do Panteão', 'Cavernas Profundas', 'Porto da Enseada']
+            }
+        }
+    }
+
 def generate_game_objective(int_verbose=False):
     try:
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=[{"role": "user", "content": get_game_objective_prompt(world)}],
-            max_tokens=1000,
-            temperature=0.7
-        ).choices[0].message.content
+        town, world_subset = get_objective_world()
+        if int_verbose:
+            create_log(f"MAIN_FLASK: GENERATE_GAME_OBJECTIVE: Starting town {town}, world subset:\n{world_subset}")
+        response = chat_completion(get_game_objective_prompt(world_subset), "game_objective", max_tokens=1000, temperature=0.7)
         #create_log(f"\nMAIN_FLASK: GENERATE_GAME_OBJECTIVE: Raw API response:\n{response}", force_log=True)
         response = response.replace("'", '"')
         if not response.strip().startswith('{') or not response.strip().endswith('}'):
@@ -75,24 +304,7 @@ def generate_game_objective(int_verbose=False):
         initial_map = objective_data['initial_map']
     except Exception as e:
         create_log(f"\nMAIN_FLASK: GENERATE_GAME_OBJECTIVE: Error generating objective: {str(e)}\nGenerating Default", force_log=True)
-        objective_data = {
-            'objective': 'Em Eldrida, o traidor Lyrien Darkscale busca roubar a relíquia secreta EnterWealther, uma fonte de poder ancestral. Ele planeja realizar um ritual no solstício de verão para invocar um poder maligno. Só Eira Shadowglow, uma habilidosa guerreira, pode ajudá-lo a parar. Encontre o sábio Thorne Silvermist, que pode fornecer informações valiosas sobre EnterWealther; o mercador Rylan Stonebrook, que pode fornecer suprimentos e armas; e a druida Elara Moonwhisper, que pode fornecer ajuda mágica.',
-            'true_clue': {'content': 'Lyrien busca EnterWealther', 'id': 'clue1'},
-            'npcs': [
-                {'name': 'Lyrien Darkscale', 'status': 'Hostile', 'description': 'Mago sombrio com olhos penetrantes e aura misteriosa.'},
-                {'name': 'Eira Shadowglow', 'status': 'Allied', 'description': 'Guerreira ágil com cabelos negros e olhar determinado.'},
-                {'name': 'Thorne Silvermist', 'status': 'Neutral', 'description': 'Sábio eremita versado em segredos antigos.'},
-                {'name': 'Rylan Stonebrook', 'status': 'Neutral', 'description': 'Mercador astuto com contatos no mercado.'},
-                {'name': 'Elara Moonwhisper', 'status': 'Neutral', 'description': 'Druida mística ligada às forças da natureza.'}
-            ],
-            'welcome_message': 'Você chega em Eldrida e ouve rumores de traição em meio à celebração do solstício de verão.',
-            'initial_map': {
-                'Eldrida': {
-                    'description': 'Uma cidade vibrante, cheia de pessoas se preparando para as festividades do solstício.',
-                    'exits': ['Floresta de Eldrid', 'Colina do Panteão', 'Cavernas Profundas', 'Porto da Enseada']
-                }
-            }
-        }
+        objective_data = default_game_objective()
         objective = objective_data['objective']
         true_clue = objective_data['true_clue']
         npcs = objective_data['npcs']
@@ -114,6 +326,20 @@ def get_initial_game_state(int_verbose=False):
     objective_data = generate_game_objective(int_verbose=True) # Temporarily forcing log of game objective
     if int_verbose:
         create_log(f"RUN_ACTION" )
+    try:
+        initial_game_state = build_initial_game_state(objective_data)
+    except (GameStateError, KeyError, IndexError, TypeError, AttributeError) as e:
+        # A game that does not fit the schema would be rejected when loaded after its first turn
+        create_log(f"\nMAIN_FLASK: GET_INITIAL_GAME_STATE: Generated objective does not fit the game state: {str(e)}\nUsing Default", force_log=True)
+        increment_metric('objective_fallbacks')
+        initial_game_state = build_initial_game_state(default_game_objective())
+    if int_verbose:
+        create_log(f"MAIN_FLASK: GET_INITIAL_GAME_STATE: Loaded initial game state")
+    return initial_game_state
+
+def build_initial_game_state(objective_data):
+    """New game state for an objective, checked against the schema. Raises GameStateError, or
+    KeyError/TypeError... when the objective itself is malformed."""
     # Create a list with all NPCs and their status
     npc_status = {
         npc['name']: {
@@ -128,7 +354,7 @@ def get_initial_game_state(int_verbose=False):
         'output_image': INITIAL_IMAGE_FILE_PATH,
         'ambient_sound': DEFAULT_AUDIO_FILE_PATH,
         'location': {'name': list(objective_data['initial_map'].keys())[0], 'exploring_location': None},
-        'known_map': objective_data['initial_map'],
+        'known_map': ensure_map_graph(objective_data['initial_map'], list(objective_data['initial_map'].keys())[0]),
         'current_state': 2,
         'health': 10,
         'resources': {'wands': 2, 'potions': 2, 'energy': 5},
@@ -145,27 +371,38 @@ def get_initial_game_state(int_verbose=False):
         'event_result': "Nenhum evento ocorreu."
         # TODO: Implement logic to handle 'awarded': False field for initial true clue
     }
-    if int_verbose:
-        create_log(f"MAIN_FLASK: GET_INITIAL_GAME_STATE: Loaded initial game state")
+    check_game_state(initial_game_state)
+    initial_game_state['derived'] = build_derived(initial_game_state)
+    migrate_history_index(initial_game_state)
     return initial_game_state
 
 def validate_game_state(game_state):
-    required_keys = [
-        'history', 'output_image', 'ambient_sound', 'location', 'known_map', 'current_state', 'health', 'resources', 
-        'awarded_clues', 'npc_status', 'combat_results', 'puzzle_results', 'character', 'active_puzzle', 
-        'active_combat', 'skill', 'waiting_for_option', 'game_objective', 'event_result'
-    ]
-    if not all(key in game_state for key in required_keys):
-        create_log(f"\n\nMAIN_FLASK: VALIDATE_GAME_STATE: Missing required keys: {set(required_keys) - set(game_state.keys())}\n\n", force_log=True)
-        return False
-    if not isinstance(game_state['history'], list):
-        create_log("\n\nMAIN_FLASK: VALIDATE_GAME_STATE: History is not a list\n\n", force_log=True)
-        return False
-    if not isinstance(game_state['resources'], dict) or not all(k in game_state['resources'] for k in ['wands', 'potions', 'energy']):
-        create_log("\n\nMAIN_FLASK: VALIDATE_GAME_STATE: Invalid resources structure\n\n", force_log=True)
+    """Check a game state dict against the schema (state_model.py), filling defaults of missing
+    optional fields (resources, results lists...) in place."""
+    try:
+        check_game_state(game_state)
+    except GameStateError as e:
+        create_log(f"\n\nMAIN_FLASK: VALIDATE_GAME_STATE: Invalid game state: {e}\n\n", force_log=True)
         return False
     return True
 
+def load_game_state(stored):
+    """Decompress (state_store.py), decode and validate a saved game state, history chunks included.
+    Returns None (logged) when it is invalid."""
+    try:
+        return read_game_state(stored)
+    except GameStateError as e:
+        create_log(f"\n\nMAIN_FLASK: LOAD_GAME_STATE: Invalid game state: {e}\n\n", force_log=True)
+        return None
+
+def load_game_head(stored):
+    """Like load_game_state, without reading the history chunks: the small head record of a save."""
+    try:
+        return read_game_head(stored)
+    except GameStateError as e:
+        create_log(f"\n\nMAIN_FLASK: LOAD_GAME_HEAD: Invalid game state: {e}\n\n", force_log=True)
+        return None
+
 def update_game_state(game_state, int_verbose=False, **updates):
     game_state.update(updates)
     if int_verbose:
@@ -174,14 +411,19 @@ def update_game_state(game_state, int_verbose=False, **updates):
 
 def save_temp_game_state(game_state, int_verbose=False):
     global last_saved_history
-    if last_saved_history != game_state['history']:
+    # A turn waiting for its moderation verdict is saved by run_action once the message is cleared
+    if getattr(turn_context, 'speculative', False) or getattr(turn_context, 'deferred', None) is not None:
+        return
+    # History is appended in place, so the saved turn is told apart by length and last entry
+    history_signature = (len(game_state['history']), game_state['history'][-1] if game_state['history'] else None)
+    if last_saved_history != history_signature:
         for attempt in range(3):
             try:
                 os.makedirs('temp_saves', exist_ok=True)
                 temp_save_path = 'temp_saves/last_session.json'
                 with open(temp_save_path, 'w', encoding='utf-8') as f:
                     json.dump({'game_state': game_state}, f, ensure_ascii=False, indent=4)
-                last_saved_history = game_state['history']
+                last_saved_history = history_signature
                 if int_verbose:
                     create_log(f"MAIN_FLASK: SAVE_TEMP_GAME_STATE: Saved game state to {temp_save_path}")
                 return
@@ -192,6 +434,48 @@ def save_temp_game_state(game_state, int_verbose=False):
                     return
                 time.sleep(1)
 
+def append_history(game_state, *entries, int_verbose=False):
+    """Append entries to the history, skipping any (role, content) already in it.
+    game_state['history_index'] maps a short hash of each entry to its position.
+    """
+    index = migrate_history_index(game_state, int_verbose)['history_index']
+    for entry in entries:
+        key = history_key(entry)
+        if key in index:
+            increment_metric('history_duplicates_skipped')
+            if int_verbose:
+                create_log(f"MAIN_FLASK: APPEND_HISTORY: Skipped duplicate {entry['role']} entry")
+            continue
+        index[key] = len(game_state['history'])
+        game_state['history'].append(entry)
+
+def replace_history_entry(game_state, position, entry):
+    """Replace the history entry at position, keeping history_index in step with it. If the new
+    entry is already in the history, the index comes up one short and migrate_history_index
+    removes the duplicate on the next append.
+    """
+    index = game_state.setdefault('history_index', {})
+    old_key = history_key(game_state['history'][position])
+    if index.get(old_key) == position:
+        del index[old_key]
+    index.setdefault(history_key(entry), position)
+    game_state['history'][position] = entry
+
+def migrate_history_index(game_state, int_verbose=False):
+    """One-off for games saved before the history index (or whose history changed without it):
+    remove duplicates and index the history. Otherwise a constant-time check.
+    """
+    if len(game_state.get('history_index', ())) == len(game_state['history']):
+        return game_state
+    length = len(game_state['history'])
+    clean_duplicate_history(game_state, int_verbose)
+    if len(game_state['history']) != length:
+        # Positions moved, so the stored history chunks no longer match: chunk it again on save
+        game_state.pop('history_chunks', None)
+    game_state['history_index'] = {history_key(entry): position for position, entry in enumerate(game_state['history'])}
+    create_log(f"MAIN_FLASK: MIGRATE_HISTORY_INDEX: Indexed {len(game_state['history'])} history entries", force_log=True)
+    return game_state
+
 def clean_duplicate_history(game_state, int_verbose=False):
     seen = set()
     count = 0
@@ -209,7 +493,9 @@ def clean_duplicate_history(game_state, int_verbose=False):
     return game_state
 
 def format_chat_history(history, game_state):
-    character_name = game_state.get('character', session.get('username', 'Hero')).split()[0]
+    # Background jobs (speculative turns) have no request context, hence no session
+    default_name = session.get('username', 'Hero') if has_request_context() else 'Hero'
+    character_name = game_state.get('character', default_name).split()[0]
     formatted_messages = []
     for msg in history:
         if msg['role'] == 'user':
@@ -219,20 +505,120 @@ def format_chat_history(history, game_state):
         formatted_messages.append(f"{role}: {msg['content']}")
     return "\n\n".join(formatted_messages)
 
+def get_history_page(game_state, before=None, limit=HISTORY_PAGE_SIZE):
+    """Format one page of history ending just before the 'before' turn index (cursor pagination).
+    Only the requested slice is formatted. The returned 'before' is the cursor for the next, older page.
+    """
+    history = game_state['history']
+    end = len(history) if before is None else max(0, min(before, len(history)))
+    start = max(0, end - limit)
+    return {
+        'chat_history': format_chat_history(history[start:end], game_state),
+        'before': start,
+        'has_more': start > 0
+    }
+
+def build_client_view(game_state):
+    return {
+        'health': game_state.get('health', 10),
+        'resources': game_state.get('resources', {}),
+        'current_state': game_state.get('current_state', 1),
+        'clues': game_state.get('clues', []),
+        'npc_status': game_state.get('npc_status', {})
+    }
+
+# Last view sent to each user's client, least recently used first. Kept in memory rather than
+# in game_state so it is not written into every save; a worker that has not served the user
+# (or forgot them) sends the full view instead of a patch.
+client_views = OrderedDict()
+client_views_lock = threading.Lock()
+
+def view_version(view):
+    """Version of a client view, derived from its content so that every worker gives the same
+    view the same version. 48 bits keep it an exact number in JavaScript."""
+    digest = hashlib.blake2b(json.dumps(view, sort_keys=True).encode('utf-8'), digest_size=6).digest()
+    return int.from_bytes(digest, 'big')
+
+def sync_client_view(user_id, game_state, client_version=None, int_verbose=False):
+    """Build the versioned client-state payload sent to game.html.
+    Args:
+        user_id: The player; the last view sent to them is kept in client_views.
+        game_state (dict): The current game state.
+        client_version (int): The state version the client says it holds, or None.
+    Returns:
+        dict: {'state_version', 'state_patch'} (RFC 6902 patch) if the client holds the stored version,
+        otherwise {'state_version', 'state'} with the full view.
+    """
+    # Saves from before client_views kept the view in the game state
+    game_state.pop('client_view', None)
+    view = build_client_view(game_state)
+    version = view_version(view)
+    with client_views_lock:
+        stored = client_views.pop(user_id, None)
+        client_views[user_id] = {'version': version, 'state': copy.deepcopy(view)}
+        while len(client_views) > CLIENT_VIEW_CACHE_SIZE:
+            client_views.popitem(last=False)
+    if client_version is not None and stored is not None and client_version == stored['version']:
+        patch = jsonpatch.make_patch(stored['state'], view).patch
+        if int_verbose:
+            create_log(f"MAIN_FLASK: SYNC_CLIENT_VIEW: Sending patch v{client_version} -> v{version} with {len(patch)} operations")
+        return {'state_version': version, 'state_patch': patch}
+    if int_verbose:
+        create_log(f"MAIN_FLASK: SYNC_CLIENT_VIEW: Client version {client_version} unknown, sending full state v{version}")
+    return {'state_version': version, 'state': view}
+
+# Verdicts of the model check (tier 2 of is_safe), keyed by text hash, least recently used first
+moderation_cache = OrderedDict()
+moderation_lock = threading.Lock()
+
+def cached_moderation(message):
+    key = hashlib.sha256(message.encode('utf-8')).hexdigest()
+    with moderation_lock:
+        verdict = moderation_cache.get(key)
+        if verdict is not None:
+            moderation_cache.move_to_end(key)
+    return key, verdict
+
 def is_safe(message, int_verbose=False):
-    create_log(f"MAIN_FLASK: IS_SAFE is temporarily disabled due to MODEL limitations", force_log=True)
-    return True, "none"
+    """Tiered moderation. Returns (safe, violations).
+    Tier 1 (moderation.screen_text) clears text with no flagged term locally. Flagged text goes to
+    IS_SAFE_MODEL once; its verdict is cached, so repeated text costs nothing.
+    """
+    flagged = screen_text(normalize_command(message))
+    if not flagged:
+        increment_metric('moderation_tier1_cleared')
+        return True, "none"
+    key, verdict = cached_moderation(message)
+    if verdict is not None:
+        increment_metric('moderation_cache_hits')
+        return verdict
+    increment_metric('moderation_tier2_checks')
+    try:
+        response = chat_completion(message, "is_safe", model=IS_SAFE_MODEL, max_tokens=20, temperature=0.0)
+        lines = [line.strip().strip("'").strip() for line in response.strip().splitlines() if line.strip()]
+        if lines and lines[0].lower() == "safe":
+            verdict = (True, "none")
+        else:
+            verdict = (False, lines[1] if len(lines) > 1 else ", ".join(flagged))
+    except Exception as e:
+        # Flagged text is not let through unchecked; the verdict is not cached so the next call retries
+        create_log(f"MAIN_FLASK: IS_SAFE: Model check failed for flagged text ({', '.join(flagged)}): {str(e)}", force_log=True)
+        return False, ", ".join(flagged)
+    with moderation_lock:
+        moderation_cache[key] = verdict
+        while len(moderation_cache) > MODERATION_CACHE_SIZE:
+            moderation_cache.popitem(last=False)
+    if int_verbose or not verdict[0]:
+        create_log(f"MAIN_FLASK: IS_SAFE: Tier 1 flagged {flagged}, model verdict: {verdict}", force_log=not verdict[0])
+    return verdict
 
 def summarize(template, prompt, int_verbose=False):
     try:
         final_prompt = template + prompt
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=[{"role": "user", "content": final_prompt}]
-        )
+        response = chat_completion(final_prompt, "summarize")
         if int_verbose:
-            create_log(f"\nMAIN_FLASK: SUMMARIZE - Summarized text: \n{response.choices[0].message.content}\n")
-        return response.choices[0].message.content
+            create_log(f"\nMAIN_FLASK: SUMMARIZE - Summarized text: \n{response}\n")
+        return response
     except Exception as e:
         create_log(f"\n\nMAIN_FLASK: Error in summarize: {str(e)}\n\n", force_log=True)
         return ""
@@ -241,60 +627,72 @@ def detect_inventory_changes(game_state, last_response, int_verbose=VERBOSE, act
     try:
         inventory = game_state['resources']
         story_context = format_chat_history(game_state['history'], game_state)
-        prompt = system_inventory_prompt.format(story=last_response, inventory=str(inventory)) + \
-                 "\nRetorne SOMENTE um objeto JSON com a chave 'itemUpdates' contendo uma lista de atualizações. " + \
-                 "Exemplo: {'itemUpdates': [{'item': 'poção', 'change': -1}]}. Se nenhuma mudança, retorne {'itemUpdates': []}."
+        prompt = get_inventory_prompt(last_response, str(inventory))
         if int_verbose:
             create_log(f"MAIN_FLASK: DETECT_INVENTORY_CHANGES: Prompt:\n{prompt}\n")
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.0
-        )
-        response_text = response.choices[0].message.content
+        result = routed_json_completion(prompt, "inventory", INVENTORY_SCHEMA, temperature=0.0)
         if int_verbose:
-            create_log(f"MAIN_FLASK: DETECT_INVENTORY_CHANGES: Response:\n{response_text}\n")
-        try:
-            result = json.loads(response_text)
-            if not isinstance(result.get('itemUpdates', []), list):
-                create_log("\n\nMAIN_FLASK: DETECT_INVENTORY_CHANGES: Invalid itemUpdates format\n\n", force_log=True)
-                return []
-            return result.get('itemUpdates', [])
-        except json.JSONDecodeError:
-            create_log(f"\n\nMAIN_FLASK: DETECT_INVENTORY_CHANGES: Invalid JSON response: {response_text}\n\n", force_log=True)
-            json_match = re.search(r'\{.*?\}(?=\s*$|\s*\Z)', response_text, re.DOTALL)
-            if json_match:
-                try:
-                    result = json.loads(json_match.group(0))
-                    if not isinstance(result.get('itemUpdates', []), list):
-                        create_log("\n\nMAIN_FLASK: DETECT_INVENTORY_CHANGES: Invalid itemUpdates format in regex\n\n", force_log=True)
-                        return []
-                    return result.get('itemUpdates', [])
-                except json.JSONDecodeError:
-                    create_log(f"\n\nMAIN_FLASK: DETECT_INVENTORY_CHANGES: Regex failed for JSON: {json_match.group(0)}\n\n", force_log=True)
-            if action_type == "use_item" and item in inventory:
-                create_log(f"\n\nMAIN_FLASK: DETECT_INVENTORY_CHANGES: Falling back to default update for {item}\n\n", force_log=True)
-                return [{"item": item, "change": -1}]
-            return []
+            create_log(f"MAIN_FLASK: DETECT_INVENTORY_CHANGES: Response:\n{result}\n")
+        if validate_schema(result, INVENTORY_SCHEMA):
+            return result['itemUpdates']
+        create_log(f"\n\nMAIN_FLASK: DETECT_INVENTORY_CHANGES: Invalid itemUpdates response: {result}\n\n", force_log=True)
+        if action_type == "use_item" and inventory.get(item, 0) > 0:
+            create_log(f"\n\nMAIN_FLASK: DETECT_INVENTORY_CHANGES: Falling back to default update for {item}\n\n", force_log=True)
+            return [{"item": item, "change": -1}]
+        return []
     except Exception as e:
         create_log(f"\n\nMAIN_FLASK: DETECT_INVENTORY_CHANGES: Unexpected error: {str(e)}\n\n", force_log=True)
-        if action_type == "use_item" and item in inventory:
+        if action_type == "use_item" and inventory.get(item, 0) > 0:
             create_log(f"\n\nMAIN_FLASK: DETECT_INVENTORY_CHANGES: Falling back to default update for {item}\n\n", force_log=True)
             return [{"item": item, "change": -1}]
         return []
 
+NARRATIVE_SCHEMA = {'text': str, 'itemUpdates': list}
+COMBAT_SCRIPT_SCHEMA = {'description': str, 'enemy': dict, 'clues': list}
+PUZZLE_SCHEMA = {'trick': str, 'solution': str, 'clues': list}
+
+def split_narrative_and_items(response, call_site):
+    """Split a structured narrative response ({"text", "itemUpdates"}) into text and inventory updates.
+    If the response is not valid (e.g. JSON cut off by max_tokens), the narrative is salvaged from
+    the "text" value and no inventory update is applied.
+    """
+    data = parse_json_object(response)
+    if validate_schema(data, NARRATIVE_SCHEMA) and data['text'].strip():
+        return data['text'].strip(), data['itemUpdates']
+    create_log(f"MAIN_FLASK: SPLIT_NARRATIVE_AND_ITEMS: {call_site} returned no structured narrative, keeping the text only", force_log=True)
+    increment_metric('narrative_json_repairs')
+    return salvage_narrative_text(response), []
+
+def salvage_narrative_text(response):
+    """Narrative text of an invalid or truncated {"text": ..., "itemUpdates": ...} response, or the
+    response itself when it is not JSON at all.
+    """
+    text = re.sub(r'^```(?:json)?|```$', '', (response or "").strip()).strip()
+    text_match = re.search(r'"text"\s*:\s*"((?:[^"\\]|\\.)*)', text, re.DOTALL)
+    if text_match:
+        value = text_match.group(1)
+        try:
+            return json.loads(f'"{value}"').strip()
+        except json.JSONDecodeError:
+            # Cut off inside an escape sequence
+            return value.replace('\\n', '\n').replace('\\"', '"').rstrip('\\').strip()
+    if text.startswith('{'):
+        return ""
+    return text
+
 def image_generator(prompt, int_verbose=False):
     try:
-        response = client.images.generate(
-            model=IMAGE_MODEL,
-            prompt=prompt,
+        response = llm_client.generate_image(
+            "image_generator",
+            IMAGE_MODEL,
+            prompt,
             width=512,
             height=384,
             steps=1,
             n=1,
             response_format="b64_json"
         )
-        image_data = base64.b64decode(response.data[0].b64_json)
+        image_data = base64.b64decode(response['data'][0]['b64_json'])
         os.makedirs(os.path.dirname(DEFAULT_IMAGE_FILE_PATH), exist_ok=True)
         
         with open(DEFAULT_IMAGE_FILE_PATH, 'wb') as f:
@@ -318,6 +716,13 @@ def image_generator(prompt, int_verbose=False):
         create_log(f"\n\nMAIN_FLASK: IMAGE_GENERATOR: Error generating image: {str(e)}\n\n", force_log=True)
         return ERROR_IMAGE_FILE_PATH
 
+def new_clue_id(game_state):
+    existing_clue_ids = {clue['id'] for clue in game_state['awarded_clues']}
+    total_clues = len(game_state['awarded_clues'])
+    while f"clue_{total_clues + 1:04d}" in existing_clue_ids:
+        total_clues += 1
+    return f"clue_{total_clues + 1:04d}"
+
 def generate_random_events(game_state, event_type, recent_history, int_verbose=False):
     temperature = 0.8
     current_state = game_state.get('current_state', 1)
@@ -345,11 +750,7 @@ def generate_random_events(game_state, event_type, recent_history, int_verbose=F
             total_clues += 1
 
     if event_type == "false_clue":
-        response = client.chat.completions.create(
-            model=MODEL,
-            temperature=temperature,
-            messages=[{"role": "user", "content": prompt_map[event_type](game_state['game_objective'],location, recent_history)}]
-        ).choices[0].message.content
+        response = chat_completion(prompt_map[event_type](game_state['game_objective'],location, recent_history), "false_clue", temperature=temperature)
         if int_verbose:
             create_log(f"MAIN_FLASK: GENERATE_RANDOM_EVENTS: Raw false_clue response: {response}")
         try:
@@ -378,11 +779,7 @@ def generate_random_events(game_state, event_type, recent_history, int_verbose=F
                     create_log(f"\n\nMAIN_FLASK: GENERATE_RANDOM_EVENTS: Regex failed for false_clue: {json_match.group(0)}\n\n", force_log=True)
     
     elif event_type == "true_clue":
-        response = client.chat.completions.create(
-            model=MODEL,
-            temperature=temperature,
-            messages=[{"role": "user", "content": prompt_map[event_type](game_state['game_objective'], location, recent_history)}]
-        ).choices[0].message.content
+        response = chat_completion(prompt_map[event_type](game_state['game_objective'], location, recent_history), "true_clue", temperature=temperature)
         if int_verbose:
             create_log(f"MAIN_FLASK: GENERATE_RANDOM_EVENTS: Raw true_clue response: {response}")
         try:
@@ -429,25 +826,23 @@ def generate_random_events(game_state, event_type, recent_history, int_verbose=F
                     create_log(f"\n\nMAIN_FLASK: GENERATE_RANDOM_EVENTS: Regex failed for true_clue: {json_match.group(0)}\n\n", force_log=True)
     
     elif event_type == "trick":
-        response = client.chat.completions.create(
-            model=MODEL,
-            temperature=temperature,
-            messages=[{"role": "user", "content": prompt_map[event_type](recent_history)}]
-        ).choices[0].message.content
-        if int_verbose:
-            create_log(f"MAIN_FLASK: GENERATE_RANDOM_EVENTS: Raw trick response: {response}")
-        try:
-            trick_data = json.loads(response)
-            events.append({"type": "trick", "content": trick_data['trick'], "solution": trick_data['solution'], "clues": trick_data['clues'], "tries": 0})
-        except json.JSONDecodeError:
-            create_log(f"\n\nMAIN_FLASK: GENERATE_RANDOM_EVENTS: Invalid JSON for trick: {response}\n\n", force_log=True)
-            json_match = re.search(r'\{.*?\}\}(?=\s*$|\s*\Z)', response, re.DOTALL)
-            if json_match:
-                try:
-                    trick_data = json.loads(json_match.group(0))
-                    events.append({"type": "trick", "content": trick_data['trick'], "solution": trick_data['solution'], "clues": trick_data['clues'], "tries": 0})
-                except json.JSONDecodeError:
-                    create_log(f"\n\nMAIN_FLASK: GENERATE_RANDOM_EVENTS: Regex failed for trick: {json_match.group(0)}\n\n", force_log=True)
+        seen_riddles = [result['riddle'] for result in game_state['puzzle_results']]
+        puzzle = take_puzzle(seen_riddles, int_verbose)
+        run_side_effect(schedule_puzzle_refill, int_verbose)
+        if puzzle:
+            run_side_effect(mark_puzzle_served, puzzle['id'])
+            increment_metric('puzzle_library_hits')
+            events.append({"type": "trick", "content": puzzle['content'], "solution": puzzle['solution'], "synonyms": puzzle['synonyms'], "clues": puzzle['clues'], "tries": 0})
+        else:
+            increment_metric('puzzle_library_misses')
+            response = chat_completion(prompt_map[event_type](recent_history), "trick", temperature=temperature)
+            if int_verbose:
+                create_log(f"MAIN_FLASK: GENERATE_RANDOM_EVENTS: Raw trick response: {response}")
+            trick_data = parse_puzzle(parse_json_object(response))
+            if trick_data:
+                events.append({"type": "trick", **trick_data, "tries": 0})
+            else:
+                create_log(f"\n\nMAIN_FLASK: GENERATE_RANDOM_EVENTS: Invalid JSON for trick: {response}\n\n", force_log=True)
     
     elif event_type == "attack":
         combat_type = {
@@ -456,23 +851,17 @@ def generate_random_events(game_state, event_type, recent_history, int_verbose=F
             3: "professional",
             4: "physical"
         }.get(current_state, "physical")
-        response = client.chat.completions.create(
-            model=MODEL,
-            temperature=temperature,
-            messages=[{"role": "user", "content": prompt_map[event_type](combat_type, recent_history)}]
-        ).choices[0].message.content
-        try:
-            attack_data = json.loads(response)
-            events.append({"type": "attack", "content": attack_data['description'], "clue": attack_data['clue'], "tries": 0, "combat_type": combat_type})
-        except json.JSONDecodeError:
-            create_log(f"\n\nMAIN_FLASK: GENERATE_RANDOM_EVENTS: Invalid JSON for attack: {response}\n\n", force_log=True)
-            json_match = re.search(r'\{.*?\}\}(?=\s*$|\s*\Z)', response, re.DOTALL)
-            if json_match:
-                try:
-                    attack_data = json.loads(json_match.group(0))
-                    events.append({"type": "attack", "content": attack_data['description'], "clue": attack_data['clue'], "tries": 0, "combat_type": combat_type})
-                except json.JSONDecodeError:
-                    create_log(f"\n\nMAIN_FLASK: GENERATE_RANDOM_EVENTS: Regex failed for attack: {json_match.group(0)}\n\n", force_log=True)
+        # One call scripts the whole combat: enemy profile and one hint per try
+        response = chat_completion(prompt_map[event_type](combat_type, recent_history, MAX_TRIES), "attack", temperature=temperature)
+        attack_data = parse_json_object(response)
+        if validate_schema(attack_data, COMBAT_SCRIPT_SCHEMA) and attack_data['clues']:
+            clues = [str(clue) for clue in attack_data['clues']][:MAX_TRIES]
+            events.append({
+                "type": "attack", "content": attack_data['description'], "clue": clues[0], "clues": clues,
+                "enemy": attack_data['enemy'], "tries": 0, "combat_type": combat_type
+            })
+        else:
+            create_log(f"\n\nMAIN_FLASK: GENERATE_RANDOM_EVENTS: Invalid combat script for attack: {response}\n\n", force_log=True)
     
     if int_verbose:
         create_log(f"MAIN_FLASK: GENERATE_RANDOM_EVENTS: Generated event: {events[0] if events else 'None'} for state {current_state}")
@@ -513,11 +902,11 @@ def update_inventory(game_state, item_updates, int_verbose=False):
         elif inv_change > 0:
             inventory[item] = inventory.get(item, 0) + inv_change
             if int_verbose:
-                create_log(f'MAIN_FLASK: UPDATE_INVENTORY - Added {change} {item}')
+                create_log(f'MAIN_FLASK: UPDATE_INVENTORY - Added {inv_change} {item}')
         elif inv_change < 0 and item in inventory:
             inventory[item] = max(0, inventory.get(item, 0) + inv_change)
             if int_verbose:
-                create_log(f'MAIN_FLASK: UPDATE_INVENTORY - Removed {abs(change)} {item}')
+                create_log(f'MAIN_FLASK: UPDATE_INVENTORY - Removed {abs(inv_change)} {item}')
         if item in inventory and inventory[item] <= 0:
             del inventory[item]
             if int_verbose:
@@ -525,26 +914,15 @@ def update_inventory(game_state, item_updates, int_verbose=False):
     update_game_state(game_state, resources=inventory)
 
 def handle_false_clue(game_state, event, int_verbose=False):
-    clue = {"content": event['content'], "id": event['id'], "false": True}
-    game_state['awarded_clues'].append(clue)
+    clue = {"content": event['content'], "id": event['id'], "false_clue": True, "awarded": True}
+    add_clue(game_state, clue)
     game_state['recent_clue'] = {"id": event['id'], "content": event['content']}
     item_updates = [{"item": "mysterious_note", "change": 1}]
     update_inventory(game_state, item_updates, int_verbose)
     story_context = format_chat_history(game_state['history'][-4:], game_state)
     location = game_state.get('location', list(game_state['known_map'].keys())[0])
-    prompt = f"""
-        Gere um diálogo em português com um NPC em {location} comentando a pista falsa: {event['content']}. 
-        Contexto recente: {story_context}. 
-        Retorne apenas o diálogo (ex.: NPC: "Texto..." Você: "Texto..."), sem narrativa ou colchetes. 
-        Máximo 3 trocas, 80 palavras. 
-        {everyone_content_policy}
-    """
-    response = client.chat.completions.create(
-        model=MODEL,
-        messages=[{"role": "user", "content": prompt}],
-        max_tokens=150,
-        temperature=0.0
-    ).choices[0].message.content
+    prompt = get_false_clue_dialogue_prompt(location, event['content'], story_context)
+    response = chat_completion(prompt, "false_clue_dialogue", max_tokens=150, temperature=0.0)
     is_safe_result, violations = is_safe(response, int_verbose)
     if not is_safe_result:
         create_log(f"MAIN_FLASK: HANDLE_FALSE_CLUE: Unsafe dialogue: {response}", force_log=True)
@@ -575,22 +953,22 @@ def handle_combat(game_state, event, int_verbose=False):
         return None, None
 
     if combat['tries'] > 0:
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=[{"role": "user", "content": get_attack_prompt(combat.get('combat_type', 'physical'), story_context)}],
-            temperature=0.3
-        ).choices[0].message.content
-        if int_verbose:
-            create_log(f"MAIN_FLASK: HANDLE_COMBAT: JSON(?) response for try {combat['tries'] + 1}: {response}")
-
-        try:
-            attack_data = json.loads(response)
-            combat['clue'] = attack_data['clue']
+        if combat.get('clues'):
+            # Hints come from the script generated with the combat
+            combat['clue'] = combat['clues'][min(combat['tries'], len(combat['clues']) - 1)]
             if int_verbose:
-                create_log(f"MAIN_FLASK: HANDLE_COMBAT: JSON wellformed - Clue response for try {combat['tries'] + 1}: {attack_data['clue']}")
-        except json.JSONDecodeError:
-            create_log("\n\nMAIN_FLASK: HANDLE_COMBAT: Invalid JSON for attack clue: {response}\n\n", force_log=True)
-            combat['clue'] = "Tente novamente com uma nova estratégia."
+                create_log(f"MAIN_FLASK: HANDLE_COMBAT: Scripted clue for try {combat['tries'] + 1}: {combat['clue']}")
+        else:
+            # Combats saved before scripts existed have a single clue, generate the next one
+            response = chat_completion(get_attack_prompt(combat.get('combat_type', 'physical'), story_context, 1), "combat_clue", temperature=0.3)
+            if int_verbose:
+                create_log(f"MAIN_FLASK: HANDLE_COMBAT: JSON(?) response for try {combat['tries'] + 1}: {response}")
+            attack_data = parse_json_object(response)
+            if isinstance(attack_data, dict) and isinstance(attack_data.get('clues'), list) and attack_data['clues']:
+                combat['clue'] = str(attack_data['clues'][0])
+            else:
+                create_log(f"\n\nMAIN_FLASK: HANDLE_COMBAT: Invalid JSON for attack clue: {response}\n\n", force_log=True)
+                combat['clue'] = "Tente novamente com uma nova estratégia."
 
     game_state['active_combat'] = combat
 
@@ -612,27 +990,43 @@ def resolve_combat(game_state, action, int_verbose=False):
     if int_verbose:
         create_log(f"MAIN_FLASK: RESOLVE_COMBAT: Updated combat tries to {combat['tries']}")
 
+    # The hint the player was answering to, before handle_combat moves on to the next one
+    clue = combat['clue']
     if combat['tries'] < MAX_TRIES:
         handle_combat(game_state, combat, int_verbose)
-    
+
+    final_battle = game_state['current_state'] == 5 and bool(npcs_with(game_state, 'confirmed', 'Hostile'))
+    outcomes = {
+        "victory": "vitória final" if final_battle else "vitória",
+        "defeat": "derrota" if combat['tries'] >= MAX_TRIES else "em andamento"
+    }
+
+    # Clear uses (or misses) of the hint are decided locally, only borderline actions go to the model
+    local_clue_used = evaluate_clue_use(normalize_command(action), normalize_command(clue))
+    increment_metric('clue_judge_local' if local_clue_used is not None else 'clue_judge_llm')
+
+    # Single call: narrates both outcomes (and judges the use of the hint if needed), the dice decide locally
+    prompt = get_combat_resolution_prompt(
+        combat['content'],
+        action,
+        clue,
+        outcomes,
+        story_context,
+        combat['combat_type'],
+        combat.get('enemy'),
+        judge_clue=local_clue_used is None
+    )
     try:
-        prompt = get_check_clue_prompt(action, combat['clue'])
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3
-        ).choices[0].message.content
-        try:
-            clue_response = json.loads(response)
-            clue_used = clue_response.get('used_clue', False)
-            if int_verbose:
-                create_log(f"MAIN_FLASK: RESOLVE_COMBAT: Valid JSON in clue response informs if clue was used: {clue_used}")
-        except json.JSONDecodeError:
-            create_log(f"MAIN_FLASK: RESOLVE_COMBAT: Invalid JSON in clue response: {response}", force_log=True)
-            clue_used = False
+        resolution = parse_json_object(chat_completion(prompt, "combat_resolution", temperature=0.3))
     except Exception as e:
-        create_log(f"MAIN_FLASK: RESOLVE_COMBAT: Error evaluating clue use: {str(e)}", force_log=True)
-        clue_used = False
+        create_log(f"MAIN_FLASK: RESOLVE_COMBAT: Error resolving combat: {str(e)}", force_log=True)
+        resolution = None
+    if not isinstance(resolution, dict):
+        create_log(f"MAIN_FLASK: RESOLVE_COMBAT: Invalid JSON in combat resolution", force_log=True)
+        resolution = {}
+    clue_used = local_clue_used if local_clue_used is not None else resolution.get('used_clue') is True
+    if int_verbose:
+        create_log(f"MAIN_FLASK: RESOLVE_COMBAT: Clue used: {clue_used} (judged {'locally' if local_clue_used is not None else 'by the model'})")
 
     percent_success_rate = 0.2
     base_win_prob = percent_success_rate * (
@@ -642,9 +1036,7 @@ def resolve_combat(game_state, action, int_verbose=False):
         (STRENGTH / 100.0) * 0.1
     )
     clue_used_bonus = 0.12
-    ally_bonus = 0.2 if game_state['current_state'] == 5 and any(
-        game_state['npc_status'][npc]['supposed_status'] == 'Allied' for npc in game_state['npc_status']
-    ) else 0.0
+    ally_bonus = 0.2 if game_state['current_state'] == 5 and npcs_with(game_state, 'supposed_status', 'Allied') else 0.0
     win_prob = base_win_prob + clue_used_bonus + ally_bonus if clue_used else base_win_prob + ally_bonus
     win_prob = min(max(win_prob, 0.0), 1.0)   
 
@@ -659,32 +1051,19 @@ def resolve_combat(game_state, action, int_verbose=False):
     game_state['skill'] = old_skill * 1.1
 
     result_status = "won" if won else "lost" if combat['tries'] >= MAX_TRIES else "ongoing"
-    resultado = "vitória" if result_status == "won" else "derrota" if result_status == "lost" else "em andamento"
-
-    if game_state['current_state'] == 5 and won and any(
-        game_state['npc_status'][npc]['supposed_status'] == 'Hostile' and 
-        game_state['npc_status'][npc]['status'] == 'Hostile' for npc in game_state['npc_status']
-    ):
-        resultado = "vitória final"
+    if won and final_battle:
         game_state['current_state'] = None
 
-    prompt = get_combat_resolution_prompt(
-        combat['content'],
-        action,
-        combat['clue'],
-        resultado,
-        story_context,
-        combat['combat_type']
-    )
-    response = client.chat.completions.create(
-        model=MODEL,
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.3
-    ).choices[0].message.content
-
-    is_safe_result, violations = is_safe(response, int_verbose)
+    narrative = resolution.get('victory' if won else 'defeat')
+    if validate_schema(narrative, NARRATIVE_SCHEMA) and narrative['text'].strip():
+        response = narrative['text'].strip()
+        is_safe_result, violations = is_safe(response, int_verbose)
+        if is_safe_result:
+            update_inventory(game_state, narrative['itemUpdates'], int_verbose)
+    else:
+        response, is_safe_result = "", False
     if not is_safe_result:
-        create_log(f"MAIN_FLASK: RESOLVE_COMBAT: Unsafe response: {response}", force_log=True)
+        create_log(f"MAIN_FLASK: RESOLVE_COMBAT: Unsafe or missing response: {response}", force_log=True)
         response = (
             f"Sua ação '{action}' não surtiu o efeito desejado, e a batalha tomou um rumo inesperado."
             if result_status == "ongoing"
@@ -714,6 +1093,52 @@ def handle_puzzle(game_state, event, int_verbose=False):
     
     return f"Quebra-cabeça: {puzzle['content']} Dica: {puzzle['clues'][0]}", "puzzle"
 
+def parse_puzzle(data):
+    """Turn a generated puzzle ({"trick", "solution", "synonyms", "clues"}) into event fields, or None if invalid."""
+    if not validate_schema(data, PUZZLE_SCHEMA) or not data['clues']:
+        return None
+    synonyms = data.get('synonyms') if isinstance(data.get('synonyms'), list) else []
+    return {'content': data['trick'], 'solution': data['solution'], 'synonyms': [str(s) for s in synonyms], 'clues': [str(c) for c in data['clues']]}
+
+def refill_puzzle_library(int_verbose=False):
+    try:
+        response = chat_completion(get_puzzle_library_prompt(PUZZLE_LIBRARY_BATCH), "puzzle_library", temperature=0.9)
+        data = parse_json_object(response)
+        puzzles = [parse_puzzle(puzzle) for puzzle in data.get('puzzles', [])] if isinstance(data, dict) else []
+        puzzles = [puzzle for puzzle in puzzles if puzzle]
+        if not puzzles:
+            create_log(f"MAIN_FLASK: REFILL_PUZZLE_LIBRARY: No valid puzzles in: {response}", force_log=True)
+        store_puzzles(puzzles, int_verbose)
+    except Exception as e:
+        create_log(f"MAIN_FLASK: REFILL_PUZZLE_LIBRARY: Error generating puzzles: {str(e)}", force_log=True)
+    finally:
+        puzzle_refill_running.clear()
+
+def schedule_puzzle_refill(int_verbose=False):
+    """Top up the puzzle library in the background when it runs low. At most one refill runs at a time."""
+    if puzzle_refill_running.is_set() or count_puzzles() >= PUZZLE_LIBRARY_MIN:
+        return
+    puzzle_refill_running.set()
+    background_executor.submit(refill_puzzle_library, int_verbose)
+
+def judge_puzzle_solution(puzzle, solution, int_verbose=False):
+    """Judge an attempt locally (normalized and fuzzy match against the solution and synonyms),
+    asking the model only when the local judge cannot decide. Returns (solved, judged_locally).
+    """
+    accepted = [normalize_command(answer) for answer in [puzzle['solution']] + puzzle.get('synonyms', [])]
+    solved = judge_answer(normalize_command(solution), accepted)
+    if solved is not None:
+        increment_metric('puzzle_judge_local')
+        return solved, True
+    increment_metric('puzzle_judge_llm')
+    data = routed_json_completion(get_puzzle_judge_prompt(puzzle['content'], puzzle['solution'], solution), "puzzle_judge", PUZZLE_JUDGE_SCHEMA, max_tokens=20, temperature=0.0)
+    if not validate_schema(data, PUZZLE_JUDGE_SCHEMA):
+        create_log(f"MAIN_FLASK: JUDGE_PUZZLE_SOLUTION: Invalid JSON in judge response: {data}", force_log=True)
+        return False, False
+    if int_verbose:
+        create_log(f"MAIN_FLASK: JUDGE_PUZZLE_SOLUTION: Model judged '{solution}' as solved={data['solved']}")
+    return data['solved'], False
+
 def resolve_puzzle(game_state, solution, int_verbose=False):
     puzzle = game_state.get('active_puzzle')
     if not puzzle:
@@ -722,11 +1147,9 @@ def resolve_puzzle(game_state, solution, int_verbose=False):
         return "Nenhum quebra-cabeça ativo."
     
     puzzle['tries'] += 1
-    response = client.chat.completions.create(
-        model=MODEL,
-        messages=[{"role": "user", "content": f"Avalie se '{solution}' resolve o quebra-cabeça: {puzzle['content']}"}]
-    ).choices[0].message.content
-    solved = "resolvido" in response.lower()
+    started = time.perf_counter()
+    solved, judged_locally = judge_puzzle_solution(puzzle, solution, int_verbose)
+    record_puzzle_sample(time.perf_counter() - started, judged_locally)
     
     if solved or puzzle['tries'] >= MAX_TRIES:
         game_state['puzzle_results'].append({"riddle": puzzle['content'], "solved": solved})
@@ -736,23 +1159,118 @@ def resolve_puzzle(game_state, solution, int_verbose=False):
         if int_verbose:
             create_log(f"MAIN_FLASK: RESOLVE_PUZZLE: Puzzle resolved, ambient_sound reverted to {game_state['ambient_sound']}")
     else:
-        result = f"Quebra-cabeça: {puzzle['content']} Dica: {puzzle['clues'][puzzle['tries']]}"
+        result = f"Quebra-cabeça: {puzzle['content']} Dica: {puzzle['clues'][min(puzzle['tries'], len(puzzle['clues']) - 1)]}"
     
     if int_verbose:
-        create_log(f"MAIN_FLASK: RESOLVE_PUZZLE: Puzzle {'resolvido' if solved else 'ongoing' if puzzle['tries'] < MAX_TRIES else 'falhou'}, solution: {solution}")
+        create_log(f"MAIN_FLASK: RESOLVE_PUZZLE: Puzzle {'resolvido' if solved else 'ongoing' if puzzle['tries'] < MAX_TRIES else 'falhou'}, solution: {solution}, judged locally: {judged_locally}")
     return result
 
-def run_action(message, game_state, int_verbose=False):
+def interpret_and_narrate(message, game_state, story_context, npc_list, int_verbose=False):
+    """Single-call turn: interpret the command and narrate it in one structured completion.
+    Returns the validated dict (see SINGLE_TURN_SCHEMA), or None so the caller falls back to the two-step flow.
+    """
+    location = game_state['location']['name']
+    exits = get_exits(game_state['known_map'], location)
+    incorporate_clue = f"Incorpore a pista: {game_state['recent_clue']['content']}." if game_state.get('recent_clue') else ""
+    prompt = get_single_turn_prompt(
+        game_state['game_objective'], story_context, message, game_state['event_result'],
+        npc_list, location, exits, incorporate_clue, game_state['resources']
+    )
+    try:
+        response = chat_completion(prompt, "single_turn", max_tokens=500, temperature=0.0)
+    except LLMBudgetExceeded:
+        raise
+    except Exception as e:
+        create_log(f"MAIN_FLASK: INTERPRET_AND_NARRATE: Error in single-call turn: {str(e)}", force_log=True)
+        increment_metric('single_turn_fallbacks')
+        return None
+    data = parse_json_object(response)
+    if not validate_schema(data, SINGLE_TURN_SCHEMA) or data['action_type'] not in ACTION_TYPES:
+        create_log(f"MAIN_FLASK: INTERPRET_AND_NARRATE: Response failed schema validation, falling back to two-step: {response}", force_log=True)
+        increment_metric('single_turn_fallbacks')
+        return None
+    if int_verbose:
+        create_log(f"MAIN_FLASK: INTERPRET_AND_NARRATE: {data['action_type']}, details: {data['details']}, itemUpdates: {data['itemUpdates']}")
+    return data
+
+def check_message(message, caller, int_verbose=False):
+    """is_safe for a player message, on a moderation thread queued as the player's own call."""
+    turn_context.user_id, turn_context.priority = caller
+    try:
+        return is_safe(message, int_verbose)
+    finally:
+        turn_context.user_id = turn_context.priority = None
+
+def run_side_effect(fn, *args):
+    """Run a side effect of the turn outside the game state (cache writes, puzzle library) now, or
+    queue it in turn_context.deferred while the turn may still be dropped."""
+    deferred = getattr(turn_context, 'deferred', None)
+    if deferred is None:
+        fn(*args)
+    else:
+        deferred.append((fn, args))
+
+def moderation_verdict(input_check, message):
+    """Verdict of a model check of player input. Fails closed when it does not arrive within MODERATION_TIMEOUT."""
+    try:
+        return input_check.result(timeout=MODERATION_TIMEOUT)
+    except FutureTimeoutError:
+        create_log(f"\n\nMAIN_FLASK: RUN_ACTION: Moderation timed out after {MODERATION_TIMEOUT}s, message refused: {message}\n\n", force_log=True)
+        increment_metric('moderation_timeouts')
+    except Exception as e:
+        create_log(f"\n\nMAIN_FLASK: RUN_ACTION: Moderation failed, message refused: {str(e)}\n\n", force_log=True)
+    return False, "unchecked"
+
+def run_action(message, game_state, int_verbose=False, turn_mode=None):
+    """Run one player turn and record its LLM calls and latency for the turn mode used.
+    turn_mode is "two_step" (interpreter call, then an action-specific call) or "single"
+    (one structured call that interprets and narrates). Defaults to TURN_MODE.
+    """
+    turn_mode = turn_mode or TURN_MODE
+    turn_context.turn_calls = 0
+    started = time.perf_counter()
     try:
-        # checks if user message is safe
-        if not is_safe(message, int_verbose):
-            create_log(f"\n\nMAIN_FLASK: RUN_ACTION: Unsafe message: {message}\n\n", force_log=True)
+        # Input moderation: clean messages pass tier 1 at once. Flagged ones are checked by the model
+        # while the turn runs on a copy of the state, which is only kept if the message is cleared.
+        # Until then the turn's saves and cache writes are held back (run_side_effect).
+        input_check = None
+        if screen_text(normalize_command(message)):
+            _, verdict = cached_moderation(message)
+            if verdict is not None and not verdict[0]:
+                create_log(f"\n\nMAIN_FLASK: RUN_ACTION: Unsafe message: {message}\n\n", force_log=True)
+                return "Mensagem não permitida."
+            input_check = moderation_executor.submit(check_message, message, llm_caller("is_safe"), int_verbose)
+        if not input_check:
+            return execute_turn(message, game_state, int_verbose, turn_mode)
+        working_state = copy.deepcopy(game_state)
+        outer_deferred = getattr(turn_context, 'deferred', None)
+        turn_context.deferred = []
+        try:
+            result = execute_turn(message, working_state, int_verbose, turn_mode)
+        finally:
+            deferred, turn_context.deferred = turn_context.deferred, outer_deferred
+        safe, violations = moderation_verdict(input_check, message)
+        if not safe:
+            create_log(f"\n\nMAIN_FLASK: RUN_ACTION: Unsafe message ({violations}): {message}\n\n", force_log=True)
             return "Mensagem não permitida."
-        
+        game_state.clear()
+        game_state.update(working_state)
+        for fn, args in deferred:
+            run_side_effect(fn, *args)
+        save_temp_game_state(game_state, int_verbose)
+        return result
+    finally:
+        if not getattr(turn_context, 'speculative', False):
+            record_turn_sample(turn_mode, time.perf_counter() - started, turn_context.turn_calls)
+
+def execute_turn(message, game_state, int_verbose=False, turn_mode="two_step"):
+    try:
+        # The user message is checked by run_action, concurrently with the turn
         # Variables sanitization / initialization block
         if 'location' not in game_state or not game_state['location']:
             game_state['location'] = {'name': list(game_state['known_map'].keys())[0], 'exploring_location': None}
             create_log(f"MAIN_FLASK: RUN_ACTION: No location. Set default location to {game_state['location']['name']}", force_log=True)
+        ensure_map_graph(game_state['known_map'], game_state['location']['name'])
         if 'waiting_for_option' not in game_state:
             game_state['waiting_for_option'] = False
             create_log("MAIN_FLASK: RUN_ACTION: Unknown if waiting for option. Initialized waiting_for_option to False", force_log=True)
@@ -761,6 +1279,9 @@ def run_action(message, game_state, int_verbose=False):
             create_log("MAIN_FLASK: RUN_ACTION: Unknown if there are active options. Initialized active_options to []", force_log=True)
         action_type, details, suggestion = "generic", {}, ""
         suggestion = ""
+        game_state['last_suggestion'] = None
+        normalized_message = normalize_command(message)
+        precomputed_narrative, precomputed_item_updates = None, []
         handle_option_selection = False
         if int_verbose:
             create_log(f"MAIN_FLASK: RUN_ACTION: Input: {message}, waiting_for_option: {game_state.get('waiting_for_option', 'MISSING')}, active_options: {game_state.get('active_options', 'NONE')}")
@@ -775,14 +1296,15 @@ def run_action(message, game_state, int_verbose=False):
         if 'awarded_clues' not in game_state:
             game_state['awarded_clues'] = []
             create_log("MAIN_FLASK: RUN_ACTION: Initialized awarded_clues to [] (for true and false clues)", force_log=True)
-        false_clue_count = len([c for c in game_state['awarded_clues'] if c.get('false_clue', False)])
-        true_clue_count = len([c for c in game_state['awarded_clues'] if not c.get('false_clue', False) and c.get('awarded', True)])
-        total_clue_count = false_clue_count + true_clue_count
+        ensure_derived(game_state)
+        if DERIVED_STATE_CHECK:
+            check_derived(game_state)
+        false_clue_count, true_clue_count, total_clue_count = clue_counts(game_state)
         if int_verbose:
             create_log(f"MAIN_FLASK: RUN_ACTION: Clue counts: false_clue_count={false_clue_count}, true_clue_count={true_clue_count}, total_clue_count={total_clue_count}")
         combat_count = len(game_state['combat_results'])
         puzzle_count = len(game_state['puzzle_results'])
-        ally_count = sum(1 for npc in game_state['npc_status'] if game_state['npc_status'][npc]['supposed_status'] == 'Suspeito')
+        ally_count = len(npcs_with(game_state, 'supposed_status', 'Suspeito'))
         event_handlers = {
             "false_clue": handle_false_clue,
             "trick": handle_puzzle,
@@ -810,11 +1332,11 @@ def run_action(message, game_state, int_verbose=False):
                 f"Escolha uma opção: - Digite apenas o número -\n"
                 + "\n".join(f"{i+1}. {opt[1]['description']}" for i, opt in enumerate(game_state['active_options']))
             )
-            if not message.strip():
+            if not normalized_message:
                 create_log("MAIN_FLASK: RUN_ACTION: Empty input while waiting_for_option", force_log=True)
                 return options_prompt
-            if message.strip().isdigit():
-                option_index = int(message) - 1
+            if normalized_message.isdigit():
+                option_index = int(normalized_message) - 1
                 if 0 <= option_index < len(game_state['active_options']):
                     action_type, details = game_state['active_options'][option_index]
                     suggestion = ""
@@ -828,45 +1350,45 @@ def run_action(message, game_state, int_verbose=False):
                 create_log(f"MAIN_FLASK: RUN_ACTION: Non-numeric input while waiting_for_option: {message}", force_log=True)
                 return options_prompt
 
+        # Navigation ("onde posso ir", "ir para Ventaria") is answered from the map graph, without the model
+        navigation = None
+        if action_type == "generic" and not handle_option_selection and not game_state.get('active_puzzle') and not game_state.get('active_combat'):
+            navigation = answer_navigation(normalized_message, game_state['known_map'], game_state['location']['name'])
+        if navigation:
+            result, destination = navigation
+            action_type, skip_action = "navigation", True
+            if destination:
+                game_state['location'] = {'name': destination, 'exploring_location': None}
+            increment_metric('navigation_local')
+            if int_verbose:
+                create_log(f"MAIN_FLASK: RUN_ACTION: Navigation answered locally, destination: {destination}")
+
         # Interprets the user input if action type is generic or there's no action already running
         if action_type == "generic" and not handle_option_selection:
-            if int_verbose:
-                create_log(f"MAIN_FLASK: RUN_ACTION: entering interpret command because there's no action running")
-            prompt = command_interpreter_prompt.format(
-                story_context=story_context,
-                command=message,
-                event_info=game_state['event_result'],
-                npc_list=npc_list
-            )
-            if int_verbose:
-                create_log(f"MAIN_FLASK: RUN_ACTION: Before command interpreter: Action: {action_type}, Details: {details}, Suggestion: {suggestion}")
-            response = client.chat.completions.create(
-                model=MODEL,
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=200,
-                temperature=0.0
-            ).choices[0].message.content
-            if int_verbose:
-                create_log(f"MAIN_FLASK: RUN_ACTION: Command interpreter response: {response}")
-            try:
-                command_data = json.loads(response)
+            command_data = None
+            if turn_mode == "single" and not game_state.get('active_puzzle') and not game_state.get('active_combat'):
+                command_data = interpret_and_narrate(message, game_state, story_context, npc_list, int_verbose)
+                if command_data:
+                    precomputed_narrative = command_data['narrative'].strip() or None
+                    precomputed_item_updates = command_data['itemUpdates']
+            if command_data is None:
+                if int_verbose:
+                    create_log(f"MAIN_FLASK: RUN_ACTION: entering interpret command because there's no action running")
+                prompt = get_command_interpreter_prompt(story_context, message, game_state['event_result'], npc_list)
+                if int_verbose:
+                    create_log(f"MAIN_FLASK: RUN_ACTION: Before command interpreter: Action: {action_type}, Details: {details}, Suggestion: {suggestion}")
+                command_data = routed_json_completion(
+                    prompt, "command_interpreter", INTERPRETER_SCHEMA, lambda data: data['action_type'] in ACTION_TYPES,
+                    max_tokens=200, temperature=0.0
+                )
+                if int_verbose:
+                    create_log(f"MAIN_FLASK: RUN_ACTION: Command interpreter response: {command_data}")
+                if not isinstance(command_data, dict):
+                    create_log(f"MAIN_FLASK: RUN_ACTION: JSON parsing failed for command interpreter", force_log=True)
+                    return "Comando não reconhecido, tente algo como 'falar com um NPC' ou 'explorar'."
                 command_data.setdefault("action_type", "generic")
                 command_data.setdefault("details", {})
                 command_data.setdefault("suggestion", "")
-            except json.JSONDecodeError:
-                create_log(f"MAIN_FLASK: RUN_ACTION: JSON parsing failed: {response}", force_log=True)
-                json_match = re.search(r'\{.*?\}(?=\s*$|\s*\Z)', response, re.DOTALL)
-                if json_match:
-                    try:
-                        command_data = json.loads(json_match.group(0))
-                        command_data.setdefault("action_type", "generic")
-                        command_data.setdefault("details", {})
-                        command_data['suggestion'] = ""
-                    except json.JSONDecodeError:
-                        command_data = {"action_type": "generic", "response": "Comando não reconhecido, tente algo como 'falar com um NPC' ou 'explorar'."}
-                else:
-                    command_data = {"action_type": "generic", "details": {}, "suggestion": ""}
-                    return "Comando não reconhecido, tente algo como 'falar com um NPC' ou 'explorar'."
             action_type = command_data.get('action_type', 'generic')
             details = command_data.get('details', {})
             suggestion = command_data.get('suggestion', "")
@@ -919,7 +1441,7 @@ def run_action(message, game_state, int_verbose=False):
                     create_log(f"MAIN_FLASK: RUN_ACTION: Dialogue start")
                 suggestion = None
                 sound_trigger = "dialogue"
-                npc = details.get('npc', random.choice(list(game_state['npc_status'].keys())))
+                npc = resolve_game_npc(details['npc'], game_state, int_verbose) if details.get('npc') else random.choice(list(game_state['npc_status'].keys()))
                 location = game_state['location']['name']
                 if npc not in game_state['npc_status']:
                     result = f"Você pode falar com: {npc_list_string}."
@@ -930,44 +1452,39 @@ def run_action(message, game_state, int_verbose=False):
                     if game_state['npc_status'][npc]['status'] == 'Allied' and game_state['npc_status'][npc]['supposed_status'] != "Allied":
                         recent_history = format_chat_history(game_state['history'][-2:], game_state)
                         prompt = get_true_ally_confirmation_prompt(npc, location, recent_history)
-                        response = client.chat.completions.create(
-                            model=MODEL,
-                            messages=[{"role": "user", "content": prompt}],
-                            max_tokens=150,
-                            temperature=0.0
-                        ).choices[0].message.content
+                        response, item_updates = split_narrative_and_items(chat_completion(prompt, "ally_confirmation", max_tokens=200, temperature=0.0), "ally_confirmation")
                         is_safe_result, violations = is_safe(response, int_verbose)
                         if not is_safe_result:
                             create_log(f"MAIN_FLASK: RUN_ACTION: Unsafe ally dialogue: {response}", force_log=True)
                             result = "Diálogo com NPC não permitido."
                         else:
-                            game_state['npc_status'][npc]['supposed_status'] = 'Allied'
+                            update_inventory(game_state, item_updates, int_verbose)
+                            set_npc_status(game_state, npc, supposed_status='Allied')
                             result = f"{response}"
                             if int_verbose:
                                 create_log(f"MAIN_FLASK: RUN_ACTION: Confirmed {npc} as Allied")
                     else:
                         incorporate_clue = f"Incorpore a pista: {game_state['recent_clue']['content']}." if game_state.get('recent_clue') else ""
-                        prompt = get_npc_dialogue_prompt(game_state['game_objective'], npc, location, story_context, incorporate_clue)
-                        response = client.chat.completions.create(
-                            model=MODEL,
-                            messages=[{"role": "user", "content": prompt}],
-                            max_tokens=200,
-                            temperature=0.0
-                        ).choices[0].message.content
+                        if precomputed_narrative:
+                            response, item_updates = precomputed_narrative, precomputed_item_updates
+                        else:
+                            prompt = get_npc_dialogue_prompt(game_state['game_objective'], npc, location, story_context, incorporate_clue)
+                            response, item_updates = split_narrative_and_items(chat_completion(prompt, "npc_dialogue", max_tokens=250, temperature=0.0), "npc_dialogue")
                         is_safe_result, violations = is_safe(response, int_verbose)
                         if not is_safe_result:
                             result = "Resposta do NPC não permitida."
                         else:
+                            update_inventory(game_state, item_updates, int_verbose)
                             result = f"{response}"
                             if int_verbose:
                                 create_log(f"MAIN_FLASK: RUN_ACTION - Generated dialogue with non true ally NPC" )
                 if not false_npc:
                     if game_state['npc_status'][npc]['supposed_status'] not in ['Allied', 'Suspeito']:
-                        game_state['npc_status'][npc]['supposed_status'] = 'Contactado'
+                        set_npc_status(game_state, npc, supposed_status='Contactado')
 
             elif action_type == "exploration":
                 if not handle_option_selection:
-                    location = details.get('location', game_state['location']['name'])
+                    location = resolve_location(details['location'], game_state['known_map']) if details.get('location') else game_state['location']['name']
                     game_state['location']['exploring_location'] = location
                     if int_verbose:
                         create_log(f"MAIN_FLASK: RUN_ACTION: Set exploring_location to {location}")
@@ -975,9 +1492,9 @@ def run_action(message, game_state, int_verbose=False):
                 if int_verbose:
                     create_log(f"MAIN_FLASK: RUN_ACTION: Exploration block start, false_clue_count={false_clue_count}, true_clue_count={true_clue_count}, total_clue_count={total_clue_count}")
                 if handle_option_selection:
-                    if not message.strip().isdigit() or not (1 <= int(message) <= 3):
+                    if not normalized_message.isdigit() or not (1 <= int(normalized_message) <= 3):
                         result = f"Por favor, escolha uma opção válida (1, 2, 3)."
-                        game_state['history'].append({'role': 'assistant', 'content': result})
+                        append_history(game_state, {'role': 'assistant', 'content': result})
                         save_temp_game_state(game_state, int_verbose)
                         return result
                     if not game_state.get('active_options') or len(game_state['active_options']) != 3:
@@ -986,17 +1503,15 @@ def run_action(message, game_state, int_verbose=False):
                         game_state['active_options'] = []
                         game_state.pop('exploration_success', None)
                         result = f"Você não achou nada interessante dessa vez."
-                        game_state['history'].append({'role': 'assistant', 'content': result})
+                        append_history(game_state, {'role': 'assistant', 'content': result})
                         save_temp_game_state(game_state, int_verbose)
                         return result
-                    option_index = int(message) - 1
+                    option_index = int(normalized_message) - 1
                     reward_type = game_state['exploration_success'].get('reward_type', 'none')
                     if int_verbose:
                         create_log(f"MAIN_FLASK: RUN_ACTION: Selected option index: {option_index}, reward_type: {reward_type}")
                     if option_index == game_state['exploration_success']['index'] and game_state['location']['exploring_location'] == game_state['exploration_success']['exploring_location']:
-                        false_clue_count = len([c for c in game_state['awarded_clues'] if c.get('false_clue', False)])
-                        true_clue_count = len([c for c in game_state['awarded_clues'] if not c.get('false_clue', False) and c.get('awarded', True)])
-                        total_clue_count = false_clue_count + true_clue_count
+                        false_clue_count, true_clue_count, total_clue_count = clue_counts(game_state)
                         if current_state in [2, 4] and total_clue_count < (MAX_FALSE_CLUE + MAX_TRUE_CLUE):
                             if false_clue_count >= MAX_FALSE_CLUE:
                                 reward_type = "true_clue"
@@ -1022,11 +1537,19 @@ def run_action(message, game_state, int_verbose=False):
                                 f"current_exploring_location={game_state['location']['exploring_location']}, "
                                 f"reward_type={reward_type}"
                             )
+                        selected_option = game_state['active_options'][option_index][1]
+                        resolution = selected_option.get('resolution', '').strip()
                         if reward_type in ["true_clue", "false_clue"]:
                             event_type = reward_type
-                            option_description = game_state['active_options'][option_index][1]['description']
-                            recent_history_with_action = recent_history + f"\nAção escolhida: {option_description}"
-                            event = generate_random_events(game_state, event_type, recent_history_with_action, int_verbose)
+                            if selected_option.get('clue', '').strip() and selected_option.get('clue_type') == reward_type:
+                                # Resolved locally: the clue was generated together with the options
+                                event = {"type": reward_type, "content": selected_option['clue'].strip(), "id": new_clue_id(game_state)}
+                                increment_metric('exploration_precomputed_resolutions')
+                            else:
+                                option_description = selected_option['description']
+                                recent_history_with_action = recent_history + f"\nAção escolhida: {option_description}"
+                                event = generate_random_events(game_state, event_type, recent_history_with_action, int_verbose)
+                                increment_metric('exploration_fallback_resolutions')
                             if int_verbose:
                                 create_log(
                                     f"MAIN_FLASK: RUN_ACTION: generate_random_events returned: {event}"
@@ -1034,9 +1557,9 @@ def run_action(message, game_state, int_verbose=False):
                                 )
                             if event and 'content' in event and 'id' in event:
                                 clue = {'content': event['content'], 'id': event['id'], 'false_clue': reward_type == "false_clue", 'awarded': True}
-                                game_state['awarded_clues'].append(clue)
+                                add_clue(game_state, clue)
                                 game_state['recent_clue'] = {"id": clue['id'], "content": clue['content']}
-                                result = f"Você encontrou uma pista: {clue['content']}."
+                                result = f"{resolution}\nVocê encontrou uma pista: {clue['content']}." if resolution else f"Você encontrou uma pista: {clue['content']}."
                                 if int_verbose:
                                     create_log(f"MAIN_FLASK: RUN_ACTION: Awarded {reward_type}: {clue['content']}, id: {clue['id']} to awarded_clues")
                             else:
@@ -1044,20 +1567,21 @@ def run_action(message, game_state, int_verbose=False):
                                 result = f"Você explorou, mas não encontrou nada relevante."
                         else:
                             result = f"Você explorou, mas não encontrou nada relevante."
-                        false_clue_count = len([c for c in game_state['awarded_clues'] if c.get('false_clue', False)])
-                        true_clue_count = len([c for c in game_state['awarded_clues'] if not c.get('false_clue', False) and c.get('awarded', True)])
-                        total_clue_count = false_clue_count + true_clue_count
+                        false_clue_count, true_clue_count, total_clue_count = clue_counts(game_state)
                         if int_verbose:
                             create_log(f"MAIN_FLASK: RUN_ACTION: Post-award clue counts: false_clue_count={false_clue_count}, true_clue_count={true_clue_count}, total_clue_count={total_clue_count}")
                     else:
                         option_description = game_state['active_options'][option_index][1]['description']
+                        resolution = game_state['active_options'][option_index][1].get('resolution', '').strip()
                         if reward_type == "none":
                             result = f"Você descobriu algo interessante, mas não encontrou pistas concretas. Quem sabe na próxima."
                             if int_verbose:
                                 create_log(f"MAIN_FLASK: RUN_ACTION: Awarded narrative reward for {option_description}")
                         else:
                             result = f"Você explorou, mas não encontrou nada relevante."
-                    game_state['history'].append({'role': 'assistant', 'content': result})
+                        if resolution:
+                            result = f"{resolution}\n{result}"
+                    append_history(game_state, {'role': 'assistant', 'content': result})
                     game_state['waiting_for_option'] = False
                     game_state['active_options'] = []
                     game_state.pop('exploration_success', None)
@@ -1096,24 +1620,20 @@ def run_action(message, game_state, int_verbose=False):
                             result = f"Você coletou todas as pistas disponíveis em {game_state['location']['exploring_location']}. Não há mais pistas a encontrar.\nVocê evoluiu para o nível 3!"
                             if int_verbose:
                                 create_log(f"MAIN_FLASK: RUN_ACTION: Transitioned to state 3: total_clue_count={total_clue_count}")
-                            game_state['history'].append({'role': 'assistant', 'content': result})
+                            append_history(game_state, {'role': 'assistant', 'content': result})
                             save_temp_game_state(game_state, int_verbose)
                             sound_trigger = "generic"
                             final_result = result + f"\n\nSugestão: {suggestion}"
+                            game_state['last_suggestion'] = suggestion
                             return final_result
                     if int_verbose:
                         create_log(f"MAIN_FLASK: RUN_ACTION: Exploration reward type: {reward_type}")
-                    prompt = get_exploration_prompt(location, recent_history, clues, reward_type)
+                    prompt = get_exploration_prompt(location, recent_history, clues, reward_type, game_state['game_objective'])
                     try:
-                        response = client.chat.completions.create(
-                            model=MODEL,
-                            messages=[{"role": "user", "content": prompt}],
-                            max_tokens=200,
-                            temperature=0.0
-                        ).choices[0].message.content
+                        response = chat_completion(prompt, "exploration", max_tokens=600, temperature=0.0)
                         if int_verbose:
                             create_log(f"MAIN_FLASK: RUN_ACTION: Exploration response: {response}")
-                        is_safe_result = is_safe(response, int_verbose)
+                        is_safe_result, violations = is_safe(response, int_verbose)
                         if not is_safe_result:
                             create_log(f"MAIN_FLASK: RUN_ACTION: Unsafe exploration response: {response}", force_log=True)
                             return "Resposta de exploração não permitida."
@@ -1131,6 +1651,9 @@ def run_action(message, game_state, int_verbose=False):
                             success_index = next((i for i, opt in enumerate(options) if opt['outcome'] == "success"), None)
                             if success_index is None:
                                 raise ValueError("No success option found")
+                            for opt in options:
+                                # Remember which reward the stored clue was written for
+                                opt['clue_type'] = reward_type if opt['outcome'] == "success" and reward_type in ["true_clue", "false_clue"] else "none"
                             shuffled_options = options.copy()
                             random.shuffle(shuffled_options)
                             new_success_index = next((i for i, opt in enumerate(shuffled_options) if opt['outcome'] == "success"), None)
@@ -1149,7 +1672,7 @@ def run_action(message, game_state, int_verbose=False):
                             }
                             game_state['waiting_for_option'] = True
                             result += "\nEscolha uma opção: - Digite apenas o número -\n" + "\n".join(f"{i+1}. {opt['description']}" for i, opt in enumerate(options))
-                            game_state['history'].append({
+                            append_history(game_state, {
                                 'role': 'assistant',
                                 'content': result
                             })
@@ -1173,7 +1696,7 @@ def run_action(message, game_state, int_verbose=False):
                             }
                             game_state['waiting_for_option'] = True
                             result = f"Você explora {location}, observando detalhes ao seu redor.\nEscolha uma opção: - Digite apenas o número - \n" + "\n".join(f"{i+1}. {opt['description']}" for i, opt in enumerate(options))
-                            game_state['history'].append({
+                            append_history(game_state, {
                                 'role': 'assistant',
                                 'content': result
                             })
@@ -1189,7 +1712,7 @@ def run_action(message, game_state, int_verbose=False):
                 if int_verbose:
                     create_log(f"MAIN_FLASK: RUN_ACTION: Use_item block start")
                 item = details.get('item')
-                if item and item in game_state['resources']:
+                if item and game_state['resources'].get(item, 0) > 0:
                     item_updates = [{"item": item, "change": -1}]
                     update_inventory(game_state, item_updates, int_verbose)
                     result = f"Você usou {item}. Quantidade restante: {game_state['resources'].get(item, 0)}."
@@ -1200,7 +1723,7 @@ def run_action(message, game_state, int_verbose=False):
             elif action_type == "investigate_npc":
                 if int_verbose:
                     create_log(f"MAIN_FLASK: RUN_ACTION: Investigate block start")
-                npc = details.get('npc', random.choice(list(game_state['npc_status'].keys())))
+                npc = resolve_game_npc(details['npc'], game_state, int_verbose) if details.get('npc') else random.choice(list(game_state['npc_status'].keys()))
                 location = game_state['location']['name']
                 if npc not in game_state['npc_status']:
                     result = f"Você descobriu que {npc} não está presente em {location} ou não é importante."
@@ -1211,7 +1734,7 @@ def run_action(message, game_state, int_verbose=False):
                         result = f"Você investigou {npc} e agora tem certeza que é confiável. - Bloco em desenvolvimento"
                         sound_trigger = "dialogue"
                     else:
-                        game_state['npc_status'][npc]['supposed_status'] = 'Suspeito'
+                        set_npc_status(game_state, npc, supposed_status='Suspeito')
                         item_updates = [{"item": "suspect_marked", "change": 1}]
                         update_inventory(game_state, item_updates, int_verbose)
                         result = f"Você anotou no seu inventário para não esquecer que {npc} é suspeito."
@@ -1222,7 +1745,7 @@ def run_action(message, game_state, int_verbose=False):
                     create_log(f"MAIN_FLASK: RUN_ACTION: Combat block start")
                 if not game_state.get('active_combat'):
                     if current_state == 5:
-                        hostile_npcs = [npc for npc in game_state['npc_status'] if game_state['npc_status'][npc]['status'] == 'Hostile']
+                        hostile_npcs = npcs_with(game_state, 'status', 'Hostile')
                         hostile_npc = hostile_npcs[0] if hostile_npcs else "o Traidor"
                         event = {"type": "attack", "content": f"{hostile_npc} confronta você!", "clue": "Ataque rápido!", "tries": 0, "combat_type": "physical"}
                         result, sound_trigger = handle_combat(game_state, event, int_verbose)
@@ -1255,19 +1778,31 @@ def run_action(message, game_state, int_verbose=False):
                 location = game_state['location']['name']
                 if int_verbose:
                     create_log(f"MAIN_FLASK: RUN_ACTION: Current location: {location}, known_map keys: {list(game_state['known_map'].keys())}")
-                exits = game_state['known_map'].get(location, {}).get('exits', [])
+                exits = get_exits(game_state['known_map'], location)
                 story_context_with_exits = story_context
                 if exits:
-                    story_context_with_exits += f"\nSaídas disponíveis para sair de {location}: {', '.join(exits)}."
+                    story_context_with_exits += f"\n{exits_text(game_state['known_map'], location)}"
                 incorporate_clue = f"Incorpore a pista: {game_state['recent_clue']['content']}." if game_state.get('recent_clue') else ""
-                prompt = get_general_action_prompt(game_state['game_objective'], details, location, story_context_with_exits, incorporate_clue, npc_list)
-                response = client.chat.completions.create(
-                    model=MODEL,
-                    messages=[{"role": "user", "content": prompt}],
-                    max_tokens=300,
-                    temperature=0.0
-                ).choices[0].message.content
-                is_safe_result = is_safe(response, int_verbose)
+                # Vague generic commands (no details) are answered from the cross-user narrative cache when possible
+                cacheable = NARRATIVE_CACHE_ENABLED and not details
+                recent_texts = [entry['content'] for entry in game_state['history'][-20:] if entry['role'] == 'assistant']
+                cached = lookup_narrative(location, current_state, exits, normalized_message, game_state['npc_status'].keys(), recent_texts, int_verbose) if cacheable and not precomputed_narrative else None
+                if precomputed_narrative:
+                    response = precomputed_narrative
+                    update_inventory(game_state, precomputed_item_updates, int_verbose)
+                elif cached:
+                    response, saved_tokens = cached
+                    increment_metric('narrative_cache_hits')
+                    increment_metric('narrative_cache_saved_tokens', saved_tokens)
+                else:
+                    prompt = get_general_action_prompt(game_state['game_objective'], details, location, story_context_with_exits, incorporate_clue, npc_list)
+                    response = chat_completion(prompt, "general_action", max_tokens=300, temperature=0.0)
+                    if cacheable:
+                        increment_metric('narrative_cache_misses')
+                        # Narratives built around this game's clue are not shared
+                        if not incorporate_clue:
+                            run_side_effect(store_narrative, location, current_state, exits, normalized_message, list(game_state['npc_status'].keys()), response, getattr(turn_context, 'last_tokens', 0), int_verbose)
+                is_safe_result, violations = is_safe(response, int_verbose)
                 if not is_safe_result:
                     result = "Resposta genérica não permitida."
                 else:
@@ -1282,23 +1817,17 @@ def run_action(message, game_state, int_verbose=False):
             final_result = f"Sua ação em {game_state['location']['name']} não revela novas pistas."
         if suggestion and not skip_action and not game_state['waiting_for_option'] and (event_type is None or event_type != "attack"):
             final_result += f"\n\nSugestão: {suggestion}"
+            game_state['last_suggestion'] = suggestion
         
         # State transition control block
         if not game_state.get('waiting_for_option'):
-            false_clue_count = len([c for c in game_state['awarded_clues'] if c.get('false_clue', False)])
-            true_clue_count = len([c for c in game_state['awarded_clues'] if not c.get('false_clue', False) and c.get('awarded', True)])
-            total_clue_count = false_clue_count + true_clue_count
-            if current_state == 3 and any(
-                game_state['npc_status'][npc]['supposed_status'] == 'Allied' and \
-                game_state['npc_status'][npc]['status'] == 'Allied' for npc in game_state['npc_status']
-            ) and ally_count >= MAX_FALSE_ALLY:
+            false_clue_count, true_clue_count, total_clue_count = clue_counts(game_state)
+            if current_state == 3 and npcs_with(game_state, 'confirmed', 'Allied') and ally_count >= MAX_FALSE_ALLY:
                 game_state['current_state'] = 4
                 if int_verbose:
                     create_log(f"MAIN_FLASK: RUN_ACTION: State 3 to 4: Allied found, {ally_count} allies")
                 final_result += "\nCom um aliado confiável e suspeitos identificados, você evoluiu para o nível 4!"
-            elif current_state == 4 and any(
-                game_state['npc_status'][npc]['supposed_status'] == 'Hostile' for npc in game_state['npc_status']
-            ):
+            elif current_state == 4 and npcs_with(game_state, 'supposed_status', 'Hostile'):
                 game_state['current_state'] = 5
                 if int_verbose:
                     create_log(f"MAIN_FLASK: RUN_ACTION: State 4 to 5: Traitor identified")
@@ -1314,20 +1843,133 @@ def run_action(message, game_state, int_verbose=False):
         if sound_trigger and sound_trigger not in SOUND_MAP:
             create_log(f"Unmapped sound_trigger: {sound_trigger}, using default", force_log=True)
 
+        append_history(game_state, {'role': 'user', "content": message}, {'role': 'assistant', 'content': final_result}, int_verbose=int_verbose)
         update_game_state(
             game_state,
             output_image=generated_image,
-            history=game_state['history'] + [{'role': 'user', "content": message}, {'role': 'assistant', 'content': final_result}],
             ambient_sound=ambient_sound
         )
         save_temp_game_state(game_state, int_verbose)
         return final_result
 
+    except LLMUnavailable as e:
+        # Provider down or circuit open: fail fast with a game text instead of an error
+        create_log(f"\n\nMAIN_FLASK: RUN_ACTION: LLM unavailable: {str(e)}\n\n", force_log=True)
+        return "Uma névoa densa cobre Eldrida e o narrador se cala por um momento. Tente novamente em instantes."
     except Exception as e:
         error_details = f"\n\nFailed in main_action: {e}\n{traceback.format_exc()}\n\n"
         create_log(f"\n\nRUN_ACTION ERROR:{error_details} - {str(e)}\n\n", str(e), force_log=True)
         return f"Error unexpected em ação: {str(e)}"
 
 
+# Speculative turns: the suggested next command, pre-run per user in the background
+speculations = {}
+speculations_lock = threading.Lock()
+
+def snapshot_game_state(game_state):
+    """Copy the game state for a speculative turn.
+    History entries are never mutated in place, so they are shared with the original
+    and only the list itself is copied. Everything else is deep-copied.
+    """
+    snapshot = copy.deepcopy({key: value for key, value in game_state.items() if key not in ('history', 'history_index')})
+    snapshot['history'] = list(game_state['history'])
+    snapshot['history_index'] = dict(game_state.get('history_index', {}))
+    return snapshot
+
+def state_fingerprint(game_state):
+    """Cheap identity of a game state: everything but history, plus history length and last entry."""
+    head = {key: value for key, value in game_state.items() if key not in ('history', 'history_index')}
+    last_entry = game_state['history'][-1] if game_state['history'] else None
+    payload = json.dumps([head, len(game_state['history']), last_entry], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+def _run_speculation(suggestion, snapshot, entry, int_verbose=False):
+    turn_context.budget = {'max_calls': SPECULATION_MAX_CALLS, 'max_tokens': SPECULATION_MAX_TOKENS, 'calls': 0, 'tokens': 0, 'exhausted': False}
+    turn_context.speculative = True
+    # Side effects outside the snapshot wait for take_speculation, the player may type something else
+    turn_context.deferred = []
+    try:
+        result = run_action(suggestion, snapshot, int_verbose)
+        if turn_context.budget['exhausted']:
+            if int_verbose:
+                create_log(f"MAIN_FLASK: RUN_SPECULATION: Budget exhausted for '{suggestion}', result dropped")
+            return None
+        return {'result': result, 'state': snapshot, 'side_effects': turn_context.deferred}
+    finally:
+        entry['usage'] = {'calls': turn_context.budget['calls'], 'tokens': turn_context.budget['tokens']}
+        turn_context.budget = None
+        turn_context.speculative = False
+        turn_context.deferred = None
+
+def _record_wasted_speculation(entry):
+    usage = entry.get('usage') or {'calls': 0, 'tokens': 0}
+    increment_metric('speculation_wasted_calls', usage['calls'])
+    increment_metric('speculation_wasted_tokens', usage['tokens'])
+
+def discard_speculation(user_id, int_verbose=False):
+    with speculations_lock:
+        entry = speculations.pop(user_id, None)
+    if entry:
+        # The tokens are only known once the job finishes; runs immediately if it already has
+        entry['future'].add_done_callback(lambda _future: _record_wasted_speculation(entry))
+        if int_verbose:
+            create_log(f"MAIN_FLASK: DISCARD_SPECULATION: Discarded speculation '{entry['command']}' for user {user_id}")
+
+def start_speculation(user_id, game_state, int_verbose=False):
+    """Pre-run the suggested next command against a snapshot of the saved game state."""
+    discard_speculation(user_id, int_verbose)
+    suggestion = game_state.get('last_suggestion')
+    if not SPECULATION_ENABLED or not suggestion or game_state.get('waiting_for_option'):
+        return
+    entry = {
+        'command': normalize_command(suggestion),
+        'suggestion': suggestion,
+        'fingerprint': state_fingerprint(game_state),
+        'usage': None
+    }
+    entry['future'] = background_executor.submit(_run_speculation, suggestion, snapshot_game_state(game_state), entry, int_verbose)
+    with speculations_lock:
+        speculations[user_id] = entry
+    increment_metric('speculation_started')
+    if int_verbose:
+        create_log(f"MAIN_FLASK: START_SPECULATION: Speculating '{suggestion}' for user {user_id}")
+
+def take_speculation(user_id, command, game_state, int_verbose=False):
+    """Return (result, game_state) from a speculative turn matching the player's command, or None.
+    A non-matching or stale speculation is discarded and its tokens are counted as wasted.
+    """
+    with speculations_lock:
+        entry = speculations.get(user_id)
+    if not entry:
+        return None
+    if entry['command'] != normalize_command(command) or entry['fingerprint'] != state_fingerprint(game_state):
+        discard_speculation(user_id, int_verbose)
+        increment_metric('speculation_misses')
+        return None
+    try:
+        outcome = entry['future'].result(timeout=SPECULATION_WAIT_SECONDS)
+    except Exception as e:
+        create_log(f"MAIN_FLASK: TAKE_SPECULATION: Speculative turn failed or timed out: {str(e)}", force_log=True)
+        outcome = None
+    if outcome is None:
+        discard_speculation(user_id, int_verbose)
+        increment_metric('speculation_misses')
+        return None
+    with speculations_lock:
+        speculations.pop(user_id, None)
+    speculative_state = outcome['state']
+    # The history records what the player typed, not the suggestion text
+    for entry_index in range(len(game_state['history']), len(speculative_state['history'])):
+        history_entry = speculative_state['history'][entry_index]
+        if history_entry['role'] == 'user' and history_entry['content'] == entry['suggestion']:
+            replace_history_entry(speculative_state, entry_index, {'role': 'user', 'content': command})
+    increment_metric('speculation_hits')
+    increment_metric('speculation_used_tokens', entry['usage']['tokens'])
+    for fn, args in outcome['side_effects']:
+        run_side_effect(fn, *args)
+    if int_verbose:
+        create_log(f"MAIN_FLASK: TAKE_SPECULATION: Committed speculative turn for '{command}' (user {user_id})")
+    save_temp_game_state(speculative_state, int_verbose)
+    return outcome['result'], speculative_state
 
 #print(generate_game_objective())
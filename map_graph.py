@@ -0,0 +1,97 @@
+import re
+from collections import deque
+
+from world_index import resolve_location
+
+# The known map of a game as a graph, kept in game_state['known_map']:
+#     {place: {'description': str, 'exits': [place, ...], 'discovered': bool}}
+# Every exit is a node of its own (undiscovered until visited) and exits go both ways, so the
+# 'exits' lists are the adjacency index. Navigation questions are answered from it locally;
+# prompts only get the exits when a narrative is written anyway.
+
+WHERE_TO_GO = re.compile(
+    r"\b(a?onde|para onde|pra onde) (eu )?(posso|consigo|devo|da para|da pra) (ir|seguir|viajar)\b"
+    r"|\b(quais|que) (sao )?(as )?(saidas|caminhos)\b|^(ver )?(as )?saidas$"
+)
+ROUTE_TO = re.compile(r"\b(como (eu )?(chego|chegar|vou|ir)|qual (e )?o caminho|caminho) (a|ao|ate|para|pra|em) (?P<place>.+)$")
+TRAVEL_TO = re.compile(r"^(ir|vou|viajar|seguir|partir|voltar|andar) (para|pra|ate|ao|a) (?P<place>.+)$")
+
+def ensure_map_graph(known_map, current=None):
+    """Turn a known_map (initial map from the objective, or an older save) into the graph form.
+    Idempotent. Mutates and returns known_map.
+    """
+    for place, data in list(known_map.items()):
+        data.setdefault('description', "")
+        data.setdefault('exits', [])
+        data.setdefault('discovered', bool(data['description']))
+        for exit_name in data['exits']:
+            node = known_map.setdefault(exit_name, {'description': "", 'exits': [], 'discovered': False})
+            if place not in node.setdefault('exits', []):
+                node['exits'].append(place)
+    if current in known_map:
+        known_map[current]['discovered'] = True
+    return known_map
+
+def get_exits(known_map, place):
+    return list(known_map.get(place, {}).get('exits', []))
+
+def shortest_path(known_map, start, goal):
+    """Places from start to goal (both included), or None when goal is not reachable."""
+    if start not in known_map or goal not in known_map:
+        return None
+    previous = {start: None}
+    queue = deque([start])
+    while queue:
+        place = queue.popleft()
+        if place == goal:
+            path = []
+            while place is not None:
+                path.append(place)
+                place = previous[place]
+            return path[::-1]
+        for next_place in known_map[place]['exits']:
+            if next_place not in previous:
+                previous[next_place] = place
+                queue.append(next_place)
+    return None
+
+def place_label(known_map, place):
+    return place if known_map.get(place, {}).get('discovered') else f"{place} (inexplorado)"
+
+def exits_text(known_map, place):
+    exits = get_exits(known_map, place)
+    if not exits:
+        return ""
+    return f"Saídas disponíveis para sair de {place}: {', '.join(place_label(known_map, name) for name in exits)}."
+
+def move_to(known_map, place):
+    known_map[place]['discovered'] = True
+
+def answer_navigation(normalized_message, known_map, location):
+    """Answer navigation commands from the graph. Returns (text, destination or None), or None when
+    the command is not a navigation command (or names a place that is not on the map).
+    """
+    if WHERE_TO_GO.search(normalized_message):
+        return exits_text(known_map, location) or f"Você ainda não conhece caminhos a partir de {location}.", None
+    route = ROUTE_TO.search(normalized_message)
+    travel = TRAVEL_TO.search(normalized_message)
+    match = route or travel
+    if not match:
+        return None
+    goal = resolve_location(match.group('place'), known_map)
+    if goal not in known_map:
+        # Places inside the town ("ir para a taverna") are explored, not travelled to
+        return None
+    if goal == location:
+        return f"Você já está em {location}.", None
+    path = shortest_path(known_map, location, goal)
+    if path is None:
+        return f"Você não conhece um caminho de {location} até {goal}.", None
+    if route:
+        steps = " -> ".join(place_label(known_map, place) for place in path)
+        return f"Para chegar a {goal}: {steps}.", None
+    for place in path[1:]:
+        move_to(known_map, place)
+    arrival = known_map[goal]['description'] or "Um lugar que você ainda não conhece."
+    via = f" passando por {', '.join(path[1:-1])}" if len(path) > 2 else ""
+    return f"Você viaja de {location} para {goal}{via}. {arrival}\n{exits_text(known_map, goal)}".strip(), goal
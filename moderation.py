@@ -0,0 +1,41 @@
+import re
+
+# Tier 1 of is_safe: a lexicon of terms that are never expected in an all-ages fantasy RPG.
+# Text that matches none of them is cleared without a model call; matches are only a flag for
+# the model check (tier 2), never a verdict on their own. Texts arrive normalized (accents
+# folded, lowercase, no punctuation, see main_flask.normalize_command).
+# Ordinary combat vocabulary (espada, luta, sangue, morte...) is deliberately absent.
+
+LEXICON = {
+    "conteúdo sexual": [
+        r"sex\w*", r"porn\w*", r"nud[ae]s?", r"pelad[ao]s?", r"transar?\w*", r"estupr\w*", r"orgasm\w*",
+        r"erotic\w*", r"masturb\w*", r"penis", r"vagina\w*", r"seios?", r"bunda\w*", r"nsfw"
+    ],
+    "discurso de ódio": [
+        r"macac[ao]s?", r"viad[ao]s?", r"bich(a|inha)s?", r"sapatao", r"traveco\w*", r"retardad[ao]s?",
+        r"nazi\w*", r"hitler", r"genocid\w*", r"racis\w*", r"nigg\w*", r"fagg?ot\w*"
+    ],
+    "violência explícita": [
+        r"tortur\w*", r"decapit\w*", r"esquartej\w*", r"mutil\w*", r"estripa\w*", r"degol\w*",
+        r"gore", r"entranhas", r"viscera\w*"
+    ],
+    "autolesão": [
+        r"suicid\w*", r"me matar", r"se matar", r"automutil\w*", r"cortar os pulsos?"
+    ],
+    "linguagem inapropriada": [
+        r"porra", r"caralh\w*", r"merda\w*", r"fod[aeiou]\w*", r"puta\w*", r"put[oa]s?", r"cu", r"buceta\w*",
+        r"arrombad\w*", r"desgracad\w*", r"fuck\w*", r"shit\w*", r"bitch\w*"
+    ],
+    "drogas": [
+        r"cocain\w*", r"heroin\w*", r"maconh\w*", r"crack", r"metanfetamin\w*"
+    ]
+}
+
+PATTERNS = {
+    category: re.compile(r"\b(?:" + "|".join(terms) + r")\b")
+    for category, terms in LEXICON.items()
+}
+
+def screen_text(normalized_text):
+    """Return the categories whose terms appear in the text; an empty list clears it."""
+    return [category for category, pattern in PATTERNS.items() if pattern.search(normalized_text)]
@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import random
+import sqlite3
+
+from config import (
+    NARRATIVE_CACHE_PATH, NARRATIVE_CACHE_SIMILARITY, NARRATIVE_CACHE_TTL, NARRATIVE_CACHE_MAX_SERVES,
+    NARRATIVE_CACHE_VARIANTS, NARRATIVE_CACHE_NEW_VARIANT_CHANCE
+)
+from create_log import create_log
+
+# Cross-user cache of narratives for generic commands ("onde posso ir", "olhar ao redor"...).
+# It lives in its own SQLite file so it is shared by every gunicorn worker in the container
+# but is not uploaded to GCS with users.db.
+
+def init_narrative_cache():
+    try:
+        os.makedirs(os.path.dirname(NARRATIVE_CACHE_PATH), exist_ok=True)
+        with sqlite3.connect(NARRATIVE_CACHE_PATH, timeout=5) as conn:
+            c = conn.cursor()
+            c.execute('''CREATE TABLE IF NOT EXISTS narrative_cache (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                scope TEXT NOT NULL,
+                command TEXT NOT NULL,
+                mentioned_npcs TEXT NOT NULL,
+                response TEXT NOT NULL,
+                tokens INTEGER NOT NULL DEFAULT 0,
+                hits INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL
+            )''')
+            c.execute("CREATE INDEX IF NOT EXISTS idx_narrative_cache_scope ON narrative_cache (scope)")
+            conn.commit()
+    except Exception as e:
+        create_log(f"\n\nNARRATIVE_CACHE: INIT_NARRATIVE_CACHE: Error initializing cache: {str(e)}\n\n", force_log=True)
+
+def command_signature(normalized_command):
+    """Character trigrams of a normalized command, padded so short words still count."""
+    padded = f"  {normalized_command} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def similarity(signature_a, signature_b):
+    if not signature_a or not signature_b:
+        return 0.0
+    return len(signature_a & signature_b) / len(signature_a | signature_b)
+
+def cache_scope(location, current_state, exits):
+    return json.dumps([location, current_state, sorted(exits or [])], ensure_ascii=False)
+
+def lookup_narrative(location, current_state, exits, normalized_command, npc_names, recent_texts=(), int_verbose=False):
+    """Return (response, tokens) of a cached narrative for a similar command in the same scope, or None.
+    Args:
+        npc_names: NPCs of the requesting game. Entries mentioning any other NPC are skipped.
+        recent_texts: Texts the player saw recently. Those variants are not served again.
+    """
+    try:
+        signature = command_signature(normalized_command)
+        now = time.time()
+        with sqlite3.connect(NARRATIVE_CACHE_PATH, timeout=5) as conn:
+            c = conn.cursor()
+            c.execute("DELETE FROM narrative_cache WHERE created_at < ? OR hits >= ?", (now - NARRATIVE_CACHE_TTL, NARRATIVE_CACHE_MAX_SERVES))
+            c.execute("SELECT id, command, mentioned_npcs, response, tokens, hits FROM narrative_cache WHERE scope = ?",
+                      (cache_scope(location, current_state, exits),))
+            rows = c.fetchall()
+            npc_names = set(npc_names)
+            matches = [
+                row for row in rows
+                if similarity(signature, command_signature(row[1])) >= NARRATIVE_CACHE_SIMILARITY
+                and set(json.loads(row[2])) <= npc_names
+            ]
+            # Variability: grow the variant pool before reusing it, and skip what the player has just seen
+            if len(matches) < NARRATIVE_CACHE_VARIANTS and random.random() < NARRATIVE_CACHE_NEW_VARIANT_CHANCE:
+                conn.commit()
+                return None
+            candidates = [row for row in matches if row[3].strip() not in recent_texts]
+            if not candidates:
+                conn.commit()
+                return None
+            least_served = min(row[5] for row in candidates)
+            entry_id, _, _, response, tokens, _ = random.choice([row for row in candidates if row[5] == least_served])
+            c.execute("UPDATE narrative_cache SET hits = hits + 1 WHERE id = ?", (entry_id,))
+            conn.commit()
+        if int_verbose:
+            create_log(f"NARRATIVE_CACHE: LOOKUP_NARRATIVE: Hit for '{normalized_command}' in {location}, saved {tokens} tokens")
+        return response, tokens
+    except Exception as e:
+        create_log(f"\n\nNARRATIVE_CACHE: LOOKUP_NARRATIVE: Error reading cache: {str(e)}\n\n", force_log=True)
+        return None
+
+def store_narrative(location, current_state, exits, normalized_command, npc_names, response, tokens, int_verbose=False):
+    try:
+        # Full or first names, so the entry is only served to games that have these NPCs
+        mentioned_npcs = [name for name in npc_names if name in response or name.split()[0] in response]
+        with sqlite3.connect(NARRATIVE_CACHE_PATH, timeout=5) as conn:
+            c = conn.cursor()
+            c.execute("INSERT INTO narrative_cache (scope, command, mentioned_npcs, response, tokens, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                      (cache_scope(location, current_state, exits), normalized_command, json.dumps(mentioned_npcs, ensure_ascii=False),
+                       response, tokens, time.time()))
+            conn.commit()
+        if int_verbose:
+            create_log(f"NARRATIVE_CACHE: STORE_NARRATIVE: Stored '{normalized_command}' in {location} ({tokens} tokens)")
+    except Exception as e:
+        create_log(f"\n\nNARRATIVE_CACHE: STORE_NARRATIVE: Error writing cache: {str(e)}\n\n", force_log=True)
@@ -0,0 +1,29 @@
+# Prompt templates, compiled once at import by prompts.py. A compiled template is a fixed prefix
+# (content policy first, then the static instructions, whitespace collapsed) followed by a short
+# str.format suffix holding the per-call values. Every prompt therefore starts with the same
+# policy text and each template with the same instructions, which the provider can cache, and
+# the indentation of the source strings is never sent.
+
+templates = {}
+
+def minify(text):
+    """Collapse runs of spaces and drop indentation and blank lines."""
+    lines = (" ".join(line.split()) for line in (text or "").strip().splitlines())
+    return "\n".join(line for line in lines if line)
+
+def compile_template(name, static, dynamic, policy=""):
+    """Register a template.
+    Args:
+        static: instructions without per-call values. Not formatted, so JSON examples use plain braces.
+        dynamic: str.format template with the per-call values, sent after the static part.
+        policy: text placed before everything else (the shared content policy).
+    """
+    prefix = "\n".join(part for part in (minify(policy), minify(static)) if part)
+    templates[name] = {'prefix': prefix, 'suffix': minify(dynamic)}
+    return templates[name]
+
+def render_template(name, **values):
+    """Prefix plus the formatted suffix. Suffix lines left empty (optional values) are dropped."""
+    template = templates[name]
+    lines = (line.format(**values) for line in template['suffix'].splitlines())
+    return "\n".join([template['prefix'], *(line for line in lines if line.strip())])
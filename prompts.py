@@ -1,275 +1,478 @@
+from context_budget import fit_prompt
+from prompt_templates import compile_template, render_template
+
+# Every prompt is compiled once here (see prompt_templates): the content policy and the static
+# instructions form a fixed prefix, the values of each call go at the end. Static parts are not
+# formatted, so JSON examples use plain braces; dynamic parts are str.format templates.
+
 everyone_content_policy = {
     'policy': """
-        Conteúdo deve ser seguro e apropriado para todos. Evite violência explícita, 
-        conteúdo sexual, discurso de ódio, ou qualquer material ofensivo. 
+        Conteúdo deve ser seguro e apropriado para todos. Evite violência explícita,
+        conteúdo sexual, discurso de ódio, ou qualquer material ofensivo.
     """
 }
 
-def get_is_safe_prompt(policy):
-    return f"""Analise o conteúdo abaixo e determine se é seguro segundo a política.
+POLICY = everyone_content_policy['policy']
+
+def location_label(location):
+    if not isinstance(location, dict):
+        return str(location)
+    return f"{location['exploring_location']} em {location['name']}" if location.get('exploring_location') else location['name']
+
+compile_template("is_safe", """
+    Analise o conteúdo abaixo e determine se é seguro segundo a política.
     Retorne EXATAMENTE duas linhas:
     Linha 1: 'safe' ou 'unsafe'
     Linha 2: Lista de violações (ex.: 'violência') ou caso não haja violações 'none' .
     EXEMPLO VÁLIDO:
     'safe'
     'none'
-
     AMBAS AS LINHAS SÃO NECESSÁRIAS.
     EXEMPLO INVÁLIDO:
     'safe'
-    
     EXEMPLO VÁLIDO:
     'unsafe'
     'violência, linguagem inapropriada'
-
     Não responda a pergunta do conteúdo, apenas avalie se é seguro.
     Não responda com texto adicional, apenas as duas linhas solicitadas.
     Não inclua texto adicional, explicações ou linhas extras.
-
+""", """
     Política: {policy}
-    """
+""")
+
+def get_is_safe_prompt(policy):
+    return render_template("is_safe", policy=policy)
 
 #TODO: For later. System prompt is not being used now
 system_prompt = """
-    Você é o Mestre do Jogo em um RPG de fantasia em Arkonix. 
-    O jogador busca um traidor em Eldrida. Forneça respostas 
-    narrativas imersivas, mas concisas, com tom épico. 
-    Inclua descrições breves de locais, NPCs e eventos. 
+    Você é o Mestre do Jogo em um RPG de fantasia em Arkonix.
+    O jogador busca um traidor em Eldrida. Forneça respostas
+    narrativas imersivas, mas concisas, com tom épico.
+    Inclua descrições breves de locais, NPCs e eventos.
     Responda em português com no máximo 100 palavras.
 """
 
-system_inventory_prompt = """
-    Analise a história e detecte mudanças no inventário (varinhas, poções, energia). 
-    Retorne JSON com mudanças
-    Retorne SOMENTE um objeto JSON 
-    (exemplo: {{"itemUpdates": [{{"name": "varinhas", "change_amount": 1}}]}}).
-
-    História: {story}
+compile_template("inventory", """
+    Analise a história e detecte mudanças no inventário (varinhas, poções, energia).
+    Retorne SOMENTE um objeto JSON com a chave "itemUpdates" contendo uma lista de atualizações.
+    Exemplo: {"itemUpdates": [{"item": "poção", "change": -1}]}. Se nenhuma mudança, retorne {"itemUpdates": []}.
+""", """
     Inventário atual: {inventory}
-"""
+    História: {story}
+""")
 
-command_interpreter_prompt = """
+def get_inventory_prompt(story, inventory):
+    return render_template("inventory", story=story, inventory=inventory)
+
+compile_template("command_interpreter", """
     Interprete o comando do jogador no contexto de um RPG. Retorne SOMENTE um objeto JSON com:
     - "action_type": ("dialogue", "exploration", "combat", "puzzle", "use_item", "investigate_npc", "generic")
-    - "details": objeto com detalhes (ex.: {{"npc": "Lyra Westminster"}}, {{"location": "Taverna"}}, {{"item": "poção"}})
+    - "details": objeto com detalhes (ex.: {"npc": "Lyra Westminster"}, {"location": "Taverna"}, {"item": "poção"})
     - "suggestion": string com uma sugestão de ação relevante (ex.: "Explore a cidade e converse com os habitantes") se "action_type" for "generic", caso contrário, deixe vazio ("")
-    Primeiro, verifique se o comando é um número (1, 2, 3) e se o contexto recente contém opções numeradas (ex.: "1. Abordar Thorold..."). 
+    Primeiro, verifique se o comando é um número (1, 2, 3) e se o contexto recente contém opções numeradas (ex.: "1. Abordar Thorold...").
     Se for um número, selecione a opção correspondente do contexto mais recente:
     - Se a opção contém "falar", "perguntar", "abordar", ou "conversar", use "dialogue" e inclua "npc" em "details" (use o NPC mencionado ou o mais recente no contexto, ex.: "Thorold").
     - Se a opção contém "procurar", "investigar", "examinar", "observar", use "exploration" e inclua "location" em "details" (use a localização atual ou mencionada no contexto).
     - Caso contrário, use "generic" com uma sugestão relevante.
-    NPCs válidos: {npc_list}
-    Se o comando menciona um NPC (ex.: "falar com Eira") ou continua um diálogo (ex.: perguntas ou respostas sem NPC explícito), use "dialogue" e inclua o NPC em "details" usando o nome completo correspondente (ex.: "Eira" -> "Eira Shadowglow"). 
+    Se o comando menciona um NPC válido (ex.: "falar com Eira") ou continua um diálogo (ex.: perguntas ou respostas sem NPC explícito), use "dialogue" e inclua o NPC em "details" usando o nome completo correspondente (ex.: "Eira" -> "Eira Shadowglow").
     Se o comando não mencionar um NPC, mas seguir um diálogo recente, use o NPC mais recente do contexto.
-    Se o comando contém "procurar", "investigar", "examinar", "observar", , "ir para", use "exploration" e inclua "location" em "details" (use a localização atual ou mencionada no contexto).
-    Se o comando for uma pergunta vaga sobre possíveis ações ou interlocutores (ex.: "o que posso fazer", "onde posso ir", "com quem posso falar"), retorne "action_type" como "generic" com "details" vazio e uma "suggestion" listando NPCs ou locais relevantes (ex.: "Converse com Eira Shadowglow ou visite o Templo da Estrela")    
+    Se o comando contém "procurar", "investigar", "examinar", "observar", "ir para", use "exploration" e inclua "location" em "details" (use a localização atual ou mencionada no contexto).
+    Se o comando for uma pergunta vaga sobre possíveis ações ou interlocutores (ex.: "o que posso fazer", "onde posso ir", "com quem posso falar"), retorne "action_type" como "generic" com "details" vazio e uma "suggestion" listando NPCs ou locais relevantes (ex.: "Converse com Eira Shadowglow ou visite o Templo da Estrela")
     Se o comando for ambíguo, default para "generic". Não assuma intenções baseadas apenas no contexto.
     Sugestões para "generic" devem recomendar diálogo com um NPC relevante ao objetivo do jogo.
     Baseie-se no contexto e histórico para sugerir ações relevantes aos objetivos do jogo.
-    Não inclua texto fora do JSON.  
+    Não inclua texto fora do JSON.
     Responda em português com no máximo 100 palavras.
+""", """
+    NPCs válidos: {npc_list}
     Contexto: {story_context}
     Eventos recentes: {event_info}
     Comando do jogador: {command}
-"""
+""")
+
+def get_command_interpreter_prompt(story_context, command, event_info, npc_list):
+    return fit_prompt("command_interpreter", lambda story_context, event_info: render_template(
+        "command_interpreter", story_context=story_context, command=command, event_info=event_info, npc_list=npc_list
+    ), [
+        {'name': 'story_context', 'text': story_context, 'priority': 1, 'keep': 'end'},
+        {'name': 'event_info', 'text': event_info, 'priority': 2, 'keep': 'end'}
+    ])
+
+def get_narrative_json_instruction(text_description):
+    return f"""Retorne SOMENTE um objeto JSON: {{"text": {text_description}, "itemUpdates": lista de mudanças no inventário causadas pela narrativa}}.
+        Exemplo de "itemUpdates": [{{"item": "potions", "change": -1}}]. Se nenhuma mudança, use [].
+        Não inclua texto fora do JSON."""
+
+DIALOGUE_JSON_INSTRUCTION = get_narrative_json_instruction("\"apenas o diálogo (ex.: Nome: 'Texto...' Você: 'Texto...'), sem narrativa ou colchetes\"")
+
+compile_template("true_clue", """
+    Extraia do objetivo do jogo uma pista verdadeira para ajudar o jogador.
+    Incorpore o local e o contexto recente diretamente na pista.
+    Exemplo: {"clue": "Laylus foi visto na taverna da cidade.", "id": "clue_001"}
+    Retorne SOMENTE um objeto JSON: {"clue": "pista", "id": "id unico"}
+    IDs devem ser unicos e diferentes de qualquer ID no contexto recente.
+    Pista: max. 40 palavras, em português puro, sem caracteres especiais.
+    JSON completo e bem-formado, sem texto fora do JSON.
+""", """
+    Objetivo do jogo: {objective}
+    Local: {location}
+    Contexto recente: {recent_history}
+""", POLICY)
 
 def get_true_clue_prompt(objective, location, recent_history):
-    location_str = f"{location['exploring_location']} em {location['name']}" if location.get('exploring_location') else location['name']
-    return f"""
-        Extraia do objetivo do jogo a seguir uma pista verdadeira para ajudar o jogador.
-        Incorpore o local ({location}) e o contexto recente diretamente nas pistas.
-        Exemplo: [{{"clue": "Laylus foi visto na taverna de {location_str}.", "id": "clue_001"}}]
-
-        Contexto recente:
-        {recent_history}
-        
-        Objetivo do jogo: 
-        {objective}
-
-        Retorne SOMENTE um objeto JSON: {{"clue": "pista", "id": "id unico"}}
-        IDs devem ser unicos e diferentes de qualquer ID no contexto recente.
-        Pista: max. 40 palavras, em português puro, sem caracteres especiais.
-        JSON completo e bem-formado, sem texto fora do JSON.
-        {everyone_content_policy['policy']}
-    """
+    return fit_prompt("true_clue", lambda recent_history, objective: render_template(
+        "true_clue", objective=objective, location=location_label(location), recent_history=recent_history
+    ), [
+        {'name': 'recent_history', 'text': recent_history, 'priority': 1, 'keep': 'end'},
+        {'name': 'objective', 'text': objective, 'priority': 2, 'keep': 'start'}
+    ])
+
+compile_template("false_clue", """
+    Crie uma pista falsa para um RPG de fantasia no local indicado, baseada no contexto recente.
+    Faça a pista parecer plausivel, mas contradiga o objetivo do jogo.
+    Exemplo: {"clue": "Ouvi dizer que Lyrien esta escondido na floresta ao norte.", "id": "clue_001"}
+    Retorne SOMENTE um objeto JSON: {"clue": "pista falsa", "id": "id unico"}.
+    ID deve ser unico e diferente de qualquer ID no contexto recente.
+    Pista: max. 40 palavras, em português puro, sem caracteres especiais.
+    JSON completo e bem-formado, sem texto fora do JSON.
+""", """
+    Objetivo do jogo: {objective}
+    Local: {location}
+    Contexto recente: {recent_history}
+""", POLICY)
 
 def get_false_clue_prompt(objective, location, recent_history):
-    return f"""
-        Crie uma pista falsa para um RPG de fantasia em {location}, baseada no contexto recente. 
-        Faça a pista parecer plausivel, mas contradiga o objetivo do jogo.
-        Exemplo: {{"clue": "Ouvi dizer que Lyrien esta escondido na floresta ao norte.", "id": "clue_001"}}
-
-        Contexto recente:
-        {recent_history}
-        
-        Objetivo do jogo: 
-        {objective}
-
-        Retorne SOMENTE um objeto JSON: {{"clue": "pista falsa", "id": "id unico"}}.
-        ID deve ser unico e diferente de qualquer ID no contexto recente.
-        Pista: max. 40 palavras, em português puro, sem caracteres especiais.
-        JSON completo e bem-formado, sem texto fora do JSON.
-        {everyone_content_policy['policy']}
-    """
+    return fit_prompt("false_clue", lambda recent_history, objective: render_template(
+        "false_clue", objective=objective, location=location_label(location), recent_history=recent_history
+    ), [
+        {'name': 'recent_history', 'text': recent_history, 'priority': 1, 'keep': 'end'},
+        {'name': 'objective', 'text': objective, 'priority': 2, 'keep': 'start'}
+    ])
+
+compile_template("false_clue_dialogue", """
+    Gere um diálogo em português com um NPC no local indicado comentando a pista falsa.
+    Retorne apenas o diálogo (ex.: NPC: "Texto..." Você: "Texto..."), sem narrativa ou colchetes.
+    Máximo 3 trocas, 80 palavras.
+""", """
+    Local: {location}
+    Pista falsa: {clue}
+    Contexto recente: {story_context}
+""", POLICY)
+
+def get_false_clue_dialogue_prompt(location, clue, story_context):
+    return render_template("false_clue_dialogue", location=location_label(location), clue=clue, story_context=story_context)
+
+compile_template("check_clue", """
+    Avalie se a dica foi usada na mensagem.
+    Retorne SOMENTE um objeto JSON: {"used_clue": true} ou {"used_clue": false}.
+    Não inclua texto fora do JSON.
+    Certifique-se de que o JSON seja completo e bem-formado.
+""", """
+    DICA: {clue}
+    MENSAGEM: {message}
+""")
 
 def get_check_clue_prompt(message, clue):
-    return f"""
-        Avalie se a dica foi usada na mensagem.
-        DICA: {clue} 
-        MENSAGEM: {message}
-        Retorne SOMENTE um objeto JSON: {{"used_clue": true}} ou {{"used_clue": false}}.
-        Não inclua texto fora do JSON.
-        Certifique-se de que o JSON seja completo e bem-formado.
-    """
+    return render_template("check_clue", message=message, clue=clue)
 
-def get_attack_prompt(combat_type, recent_history):
+compile_template("attack", """
+    Gere uma situação do tipo indicado, baseada no contexto recente.
+    Descreva brevemente o oponente e contexto (1-2 frases).
+    Defina o perfil do oponente: nome, estilo de luta ou argumentação e uma fraqueza.
+    Gere EXATAMENTE o número de pistas indicado, em sequência, para facilitar a vitória (ex.: evidência para oral, tática para profissional, fraqueza para físico),
+    uma para cada tentativa, cada uma mais explícita que a anterior e coerente com a fraqueza do oponente.
+    Retorne SOMENTE um objeto JSON: {"description": "descrição", "enemy": {"name": "nome", "style": "estilo", "weakness": "fraqueza"}, "clues": ["dica 1", "dica 2", "dica 3"]}.
+    Não inclua texto fora do JSON.
+    A descrição e cada pista devem ter no máximo 50 palavras.
+    Certifique-se de que o JSON seja completo e bem-formado.
+""", """
+    Tipo: {combat_description}
+    Número de pistas: {num_clues}
+    Contexto recente: {recent_history}
+""", POLICY)
+
+def get_attack_prompt(combat_type, recent_history, num_clues=3):
     combat_description = {
         "oral": "um confronto verbal onde o jogador deve persuadir ou convencer o oponente com argumentos ou evidências",
         "professional": "uma competição de habilidades onde o jogador deve demonstrar maior competência ou estratégia",
         "physical": "um combate físico onde o jogador enfrenta o oponente em uma luta"
     }.get(combat_type, "um combate físico")
-    return f"""
-        Gere uma situação do tipo {combat_description}, baseada no contexto recente: {recent_history}. 
-        Descreva brevemente o oponente e contexto (1-2 frases).
-        Gere uma pista para facilitar a vitória (ex.: evidência para oral, tática para profissional, fraqueza para físico). 
-        Retorne SOMENTE um objeto JSON: {{"description": "descrição", "clue": "dica para vencer"}}. 
-        Não inclua texto fora do JSON. 
-        A descrição e a pista devem ter no máximo 50 palavras cada.
-        Certifique-se de que o JSON seja completo e bem-formado.
-        {everyone_content_policy['policy']}
-    """
+    return render_template("attack", combat_description=combat_description, num_clues=num_clues, recent_history=recent_history)
 
-def get_combat_resolution_prompt(combat_content, action, clue, result, story_context, combat_type):
+compile_template("combat_resolution", """
+    Crie respostas narrativas imersivas para a resolução de um evento, uma para cada resultado possível.
+    Baseie a narrativa PRINCIPALMENTE na ação do jogador fornecida.
+    Use o contexto recente APENAS para ambientação (e.g., localização, tom da história), sem incorporar ações anteriores do histórico.
+    Para eventos em andamento, indique que o jogador pode tentar novamente, sem mencionar tentativas específicas.
+    Para vitórias ou derrotas, foque na ação mais recente do jogador, destacando seu impacto no resultado.
+    Evite mencionar saúde, habilidade ou a dica fornecida.
+    Retorne SOMENTE um objeto JSON com uma chave por resultado possível, cada uma com {"text": "narrativa (2-5 frases) em português para o resultado", "itemUpdates": []},
+    e com "used_clue": true ou false se for pedido para avaliar o uso da dica.
+    "itemUpdates" é a lista de mudanças no inventário causadas pela narrativa, ex.: [{"item": "potions", "change": -1}]. Se nenhuma mudança, use [].
+    Exemplo: {"used_clue": true, "victory": {"text": "narrativa", "itemUpdates": []}, "defeat": {"text": "narrativa", "itemUpdates": []}}
+    Não inclua texto fora do JSON.
+    Máximo 100 palavras por narrativa.
+""", """
+    Tipo: {combat_type}. {combat_instruction}
+    Evento: {combat_content}
+    {enemy}
+    Ação do jogador: {action}
+    Dica disponível: {clue}
+    Resultados possíveis: {outcomes}
+    Avaliar uso da dica ("used_clue"): {judge_clue}
+    Contexto recente: {story_context}
+""", POLICY)
+
+def get_combat_resolution_prompt(combat_content, action, clue, outcomes, story_context, combat_type, enemy=None, judge_clue=True):
     combat_instruction = {
         "oral": "Descreva um debate verbal onde o jogador usa argumentos ou evidências para persuadir o oponente. Para vitórias, destaque a persuasão bem-sucedida. Para derrotas, indique que os argumentos não convenceram.",
         "professional": "Descreva uma competição de habilidades onde o jogador demonstra competência. Para vitórias, destaque a superioridade do jogador. Para derrotas, indique que o oponente foi mais habilidoso.",
         "physical": "Descreva uma luta física com ação intensa. Para vitórias, destaque o triunfo em combate. Para derrotas, indique que o jogador foi superado fisicamente. Se o resultado for 'vitória final', inclua o aliado ajudando a vencer."
     }.get(combat_type, "Descreva uma luta física")
-    return f"""
-        Crie uma resposta narrativa imersiva para a resolução de um evento. 
-        Tipo: {combat_type}. {combat_instruction}
-        Evento: {combat_content}
-        Ação do jogador: {action}
-        Resultado: {result}
-        Contexto recente: {story_context}
-        Baseie a narrativa PRINCIPALMENTE na ação do jogador fornecida: '{action}'. 
-        Use o contexto recente APENAS para ambientação (e.g., localização, tom da história), sem incorporar ações anteriores do histórico.
-        Para eventos em andamento, indique que o jogador pode tentar novamente, sem mencionar tentativas específicas.
-        Para vitórias ou derrotas, foque na ação mais recente do jogador, destacando seu impacto no resultado.
-        Evite mencionar saúde, habilidade ou a dica fornecida.
-        Retorne uma string com o diálogo (2-5 frases) em português, sem JSON.
-        Máximo 100 palavras.
-        {everyone_content_policy['policy']}
-    """
+    enemy_str = f"Oponente: {enemy.get('name', '')}, estilo: {enemy.get('style', '')}, fraqueza: {enemy.get('weakness', '')}" if enemy else ""
+    return render_template(
+        "combat_resolution",
+        combat_type=combat_type,
+        combat_instruction=combat_instruction,
+        combat_content=combat_content,
+        enemy=enemy_str,
+        action=action,
+        clue=clue,
+        outcomes=", ".join(f'"{key}" = {value}' for key, value in outcomes.items()),
+        judge_clue="sim" if judge_clue else "não",
+        story_context=story_context
+    )
+
+compile_template("trick", """
+    Crie um enigma em Eldrida baseado no contexto recente.
+    Forneça uma descrição narrativa curta (1-2 frases).
+    Retorne JSON: {"trick": "descrição", "solution": "solução", "synonyms": ["outra forma de dizer a solução"], "clues": ["dica1", "dica2", "dica3"]}.
+    A solução deve ser curta (1-3 palavras); em "synonyms" liste sinônimos e variações aceitáveis da solução.
+    Retorne SOMENTE JSON. Não inclua texto fora do JSON.
+    O enigma deve ser temático (ex.: runas, guarda).
+    Responda em português com no máximo 100 palavras.
+""", """
+    Contexto recente: {recent_history}
+""", POLICY)
 
 def get_trick_prompt(recent_history):
-    return f"""
-        Crie um enigma em Eldrida baseado no contexto recente: {recent_history}. 
-        Forneça uma descrição narrativa curta (1-2 frases). 
-        Retorne JSON: {{"trick": "descrição", "solution": "solução", "clues": ["dica1", "dica2", "dica3"]}}.
-        Retorne SOMENTE JSON. Não inclua texto fora do JSON. 
-        O enigma deve ser temático (ex.: runas, guarda). 
-        Responda em português com no máximo 100 palavras.
-        {everyone_content_policy['policy']}
-    """
+    return render_template("trick", recent_history=recent_history)
 
-def get_exploration_prompt(location, recent_history, clues, reward_type="none"):
-    return f"""
-        Crie uma narrativa imersiva para uma ação de exploração em {location} em Eldrida, RPG de fantasia. 
-        Contexto: {recent_history}. 
-        Pistas: {clues}. 
-        Gere EXATAMENTE três opções de exploração específicas para {location}. 
-        EXATAMENTE uma opção deve ser bem-sucedida, com {f'uma pista verdadeira' if reward_type == 'true_clue' else f'uma pista falsa' if reward_type == 'false_clue' else f'um item (coin ou potion)' if reward_type == 'item' else 'nenhum resultado'}.
-        As outras duas opções devem ter resultado nulo (sem item ou pista). 
-        Retorne SOMENTE um objeto JSON:
-        - "description": narrativa (1-2 frases, máx. 50 palavras)
-        - "options": lista de 3 objetos, cada um com:
-          - "description": descrição da opção (1 frase, máx. 30 palavras)
-          - "action_type": "exploration"
-          - "outcome": "success" para a opção bem-sucedida, "none" para outras
-          - "reward": "" para todas as opções
-        Exemplo:
-        {{
-            "description": "Você explora {location}, sentindo uma aura misteriosa.",
-            "options": [
-                {{"description": "Examinar mesa da taverna.", "action_type": "exploration", "outcome": "success", "reward": ""}},
-                {{"description": "Olhar atrás do quadro.", "action_type": "exploration", "outcome": "none", "reward": ""}},
-                {{"description": "Procurar no baú.", "action_type": "exploration", "outcome": "none", "reward": ""}}
-            ]
-        }}
-        Não inclua texto fora do JSON. Máximo 100 palavras. 
-        {everyone_content_policy['policy']}
-    """
+compile_template("puzzle_library", """
+    Crie enigmas diferentes para Eldrida, RPG de fantasia medieval (ex.: runas, guardas, portas encantadas, charadas de esfinges), na quantidade indicada.
+    Cada enigma tem uma descrição narrativa curta (1-2 frases) que não depende de um local ou personagem específico.
+    A solução deve ser curta (1-3 palavras); em "synonyms" liste sinônimos e variações aceitáveis da solução.
+    Forneça três dicas, cada uma mais explícita que a anterior.
+    Retorne SOMENTE um objeto JSON: {"puzzles": [{"trick": "descrição", "solution": "solução", "synonyms": ["sinônimo"], "clues": ["dica1", "dica2", "dica3"]}]}.
+    Não inclua texto fora do JSON. Responda em português.
+""", """
+    Quantidade de enigmas: {count}
+""", POLICY)
+
+def get_puzzle_library_prompt(count):
+    return render_template("puzzle_library", count=count)
+
+compile_template("puzzle_judge", """
+    Avalie se a resposta do jogador resolve o enigma.
+    Aceite respostas com o mesmo significado da solução esperada, mesmo com outras palavras.
+    Retorne SOMENTE um objeto JSON: {"solved": true} ou {"solved": false}.
+    Não inclua texto fora do JSON.
+""", """
+    ENIGMA: {riddle}
+    SOLUÇÃO ESPERADA: {solution}
+    RESPOSTA DO JOGADOR: {answer}
+""")
+
+def get_puzzle_judge_prompt(riddle, solution, answer):
+    return render_template("puzzle_judge", riddle=riddle, solution=solution, answer=answer)
+
+compile_template("exploration", """
+    Crie uma narrativa imersiva para uma ação de exploração no local indicado em Eldrida, RPG de fantasia.
+    Gere EXATAMENTE três opções de exploração específicas para o local.
+    EXATAMENTE uma opção deve ser bem-sucedida, com o resultado indicado.
+    As outras duas opções devem ter resultado nulo (sem item ou pista).
+    Retorne SOMENTE um objeto JSON:
+    - "description": narrativa (1-2 frases, máx. 50 palavras)
+    - "options": lista de 3 objetos, cada um com:
+      - "description": descrição da opção (1 frase, máx. 30 palavras)
+      - "action_type": "exploration"
+      - "outcome": "success" para a opção bem-sucedida, "none" para outras
+      - "reward": "" para todas as opções
+      - "resolution": o que acontece quando o jogador escolhe a opção (1 frase, máx. 30 palavras), sem citar a pista
+      - "clue": conforme a instrução para "clue"
+    Exemplo:
+    {
+        "description": "Você explora o local, sentindo uma aura misteriosa.",
+        "options": [
+            {"description": "Examinar mesa da taverna.", "action_type": "exploration", "outcome": "success", "reward": "", "resolution": "Sob a mesa, você encontra um bilhete dobrado.", "clue": "pista"},
+            {"description": "Olhar atrás do quadro.", "action_type": "exploration", "outcome": "none", "reward": "", "resolution": "Atrás do quadro há apenas poeira.", "clue": ""},
+            {"description": "Procurar no baú.", "action_type": "exploration", "outcome": "none", "reward": "", "resolution": "O baú está vazio.", "clue": ""}
+        ]
+    }
+    Não inclua texto fora do JSON. Máximo 250 palavras.
+""", """
+    {objective}
+    Local: {location}
+    Resultado da opção bem-sucedida: {reward}
+    Instrução para "clue": {clue_instruction}
+    Pistas: {clues}
+    Contexto: {recent_history}
+""", POLICY)
+
+def get_exploration_prompt(location, recent_history, clues, reward_type="none", objective=""):
+    reward = {
+        "true_clue": "uma pista verdadeira",
+        "false_clue": "uma pista falsa",
+        "item": "um item (coin ou potion)"
+    }.get(reward_type, "nenhum resultado")
+    clue_instruction = {
+        "true_clue": 'para a opção "success", uma pista verdadeira extraída do objetivo do jogo (máx. 40 palavras); "" para as outras',
+        "false_clue": 'para a opção "success", uma pista falsa e plausível que contradiga o objetivo do jogo (máx. 40 palavras); "" para as outras'
+    }.get(reward_type, '"" para todas as opções')
+    # The objective only matters when the successful option carries a clue
+    objective = f"Objetivo do jogo: {objective}" if reward_type in ['true_clue', 'false_clue'] else ""
+    return fit_prompt("exploration", lambda recent_history, clues, objective: render_template(
+        "exploration", objective=objective, location=location_label(location), reward=reward, clue_instruction=clue_instruction,
+        clues=clues, recent_history=recent_history
+    ), [
+        {'name': 'recent_history', 'text': recent_history, 'priority': 1, 'keep': 'end'},
+        {'name': 'clues', 'text': clues, 'priority': 2, 'keep': 'end'},
+        {'name': 'objective', 'text': objective, 'priority': 3, 'keep': 'start'}
+    ])
+
+compile_template("game_objective", """
+    Crie um objetivo de jogo para um RPG de fantasia no mundo descrito.
+    Use português puro, sem caracteres especiais ou jargões.
+    Estruture a resposta SOMENTE como um objeto JSON com os campos abaixo.
+    Retorne SOMENTE um objeto JSON. Não inclua texto fora do JSON. Certifique-se de que o JSON seja completo e bem-formado.
+    - "objective": Narrativa épica (150-200 palavras) sobre um traidor que pretende tomar o poder, usando uma relíquia secreta que aumenta sua capacidade.
+    A narrativa deve conter o traidor, um plano malígno (ex.: usar a relíquia durante o ritual do solstício), um aliado confiável do jogador, que o ajudará a vencer e
+    três NPCs auxiliares com papéis na trama (ex.: sábio, mercador, druida). Inclua também a trama e os recursos que o jogador precisará adquirir para poder vencer a batalha final.
+    - "true_clue": Objeto com "content" (uma pista sobre o traidor, ex.: "Lyrien busca Cetro EnterWealther") e "id" (string única, ex.: "clue1").
+    - "npcs": Lista de objetos, cada um com "name" (ex.: Lyrien Darkscale), "status" (Hostile, Allied, Neutral), e "description" (10-15 palavras descrevendo o NPC sem spoilers,
+    ex.: "Mago sombrio com olhos penetrantes."). Certifique-se de incluir o traidor, o aliado, e os três NPCs auxiliares.
+    Se NPCs forem fornecidos no Mundo, escolha os que usará a partir dali. Caso contrário, crie-os.
+    - "welcome_message": Mensagem inicial (20-30 palavras) introduzindo a cidade e o reino atuais e um rumor vago de traição, sem spoilers (ex.: "Você chega na cidade de Luminaria, no reino de Eldrida e ouve rumores de traição...").
+    - "initial_map": Objeto com a cidade inicial indicada no Mundo, ex."Luminaria" contendo "description" (ex.: "Uma cidade vibrante") e "exits" (lista de 3-4 saídas escolhidas entre as outras cidades, ex.: ["Ventaria", "Kragnir", "Tharros"]).
+    Exemplo de formato:
+    {
+        "objective": "texto",
+        "true_clue": {"content": "pista", "id": "clue1"},
+        "npcs": [{"name": "Nome", "status": "Neutral", "description": "texto"}],
+        "welcome_message": "texto",
+        "initial_map": {"Luminaria": {"description": "texto", "exits": ["Ventaria", "Kragnir", "Tharros"]}}
+    }
+""", """
+    Mundo: {world}
+""", POLICY)
 
 def get_game_objective_prompt(world):
-    return f"""
-        Crie um objetivo de jogo para um RPG de fantasia no mundo descrito. 
-        Use português puro, sem caracteres especiais ou jargões.
-        Estruture a resposta SOMENTE como um objeto JSON com os campos abaixo. 
-        Retorne SOMENTE um objeto JSON. Não inclua texto fora do JSON. Certifique-se de que o JSON seja completo e bem-formado.
-        - "objective": Narrativa épica (150-200 palavras) sobre um traidor que pretende tomar o poder, usando uma relíquia secreta que aumenta sua capacidade.
-        A narrativa deve conter o traidor, um plano malígno (ex.: usar a relíquia durante o ritual do solstício), um aliado confiável do jogador, que o ajudará a vencer e 
-        três NPCs auxiliares com papéis na trama (ex.: sábio, mercador, druida). Inclua também a trama e os recursos que o jogador precisará adquirir para poder vencer a batalha final.
-        - "true_clue": Objeto com "content" (uma pista sobre o traidor, ex.: "Lyrien busca Cetro EnterWealther") e "id" (string única, ex.: "clue1").
-        - "npcs": Lista de objetos, cada um com "name" (ex.: Lyrien Darkscale), "status" (Hostile, Allied, Neutral), e "description" (10-15 palavras descrevendo o NPC sem spoilers, 
-        ex.: "Mago sombrio com olhos penetrantes."). Certifique-se de incluir o traidor, o aliado, e os três NPCs auxiliares. 
-        Se NPCs forem fornecidos no Mundo, escolha os que usará a partir dali. Caso contrário, crie-os. 
-        - "welcome_message": Mensagem inicial (20-30 palavras) introduzindo a cidade e o reino atuais e um rumor vago de traição, sem spoilers (ex.: "Você chega na cidade de Luminaria, no reino de Eldrida e ouve rumores de traição...").
-        - "initial_map": Objeto com a localização inicial obtida do Mundo a seguir, ex."Luminaria" contendo "description" (ex.: "Uma cidade vibrante") e "exits" (lista de 3-4 saídas, ex.: ["Ventaria", "Kragnir", "Tharros"]).
-
-        Exemplo de formato:
-        {{
-            "objective": "texto",
-            "true_clue": {{"content": "pista", "id": "clue1"}},
-            "npcs": [{{"name": "Nome", "status": "Neutral", "description": "texto"}}],
-            "welcome_message": "texto",
-            "initial_map": {{"Luminaria": {{"description": "texto", "exits": ["Ventaria", "Kragnir", "Tharros"]}}}}
-        }}
-        
-        Mundo:{world}
-
-        {everyone_content_policy['policy']}
-    """
+    return fit_prompt("game_objective", lambda world: render_template("game_objective", world=world), [
+        {'name': 'world', 'text': world, 'priority': 1, 'keep': 'start'}
+    ])
+
+compile_template("ally_confirmation", f"""
+    Crie um diálogo em português com o NPC indicado, no local indicado, confirmando que é aliado confiável.
+    Mostre o NPC revelando sua oposição ao vilão (ex.: 'Eu sei do plano do traidor e quero pará-lo').
+    {DIALOGUE_JSON_INSTRUCTION}
+    Máximo 3 trocas, 80 palavras.
+""", """
+    NPC: {npc}
+    Local: {location}
+    Contexto: {story_context}
+""", POLICY)
 
 def get_true_ally_confirmation_prompt(npc, location, story_context):
-    return f"""
-        Crie um diálogo em português com {npc} em {location} confirmando que é aliado confiável. 
-        Contexto: {story_context}. 
-        Mostre {npc} revelando sua oposição ao vilão (ex.: 'Eu sei do plano do traidor e quero pará-lo'). 
-        Retorne apenas o diálogo (ex.: Eira: "Texto..." Você: "Texto..."), sem narrativa ou colchetes. 
-        Máximo 3 trocas, 80 palavras. 
-        {everyone_content_policy['policy']}
-    """
+    return render_template("ally_confirmation", npc=npc, location=location_label(location), story_context=story_context)
+
+compile_template("npc_dialogue", f"""
+    Gere um diálogo com o NPC indicado, no local indicado.
+    Instruções:
+    - Evite repetir falas anteriores do diálogo, especialmente do histórico recente.
+    - Construa respostas que avancem a narrativa e se conectem ao contexto.
+    - Leve em consideração o objetivo do jogo, sem dar muitas dicas ou antecipar eventos a partir dele. Apenas o suficiente para manter o interesse do jogador e avançar a narrativa.
+    - Máximo 3 trocas, 80 palavras.
+    {DIALOGUE_JSON_INSTRUCTION}
+""", """
+    Objetivo: {objective}
+    NPC: {npc}
+    Local: {location}
+    Contexto: {story_context}
+    {clue}
+""", POLICY)
 
 def get_npc_dialogue_prompt(objective, npc, location, story_context, clue):
-    return f"""
-        Gere um diálogo com {npc} em {location}.
-        Contexto: {story_context}
-        Objetivo: {objective}
-        {clue}
-        Instruções:
-        - Evite repetir falas anteriores do diálogo, especialmente do histórico recente.
-        - Construa respostas que avancem a narrativa e se conectem ao contexto.
-        - Leve em consideração o objetivo do jogo, sem dar muitas dicas ou antecipar eventos a partir dele. Apenas o suficiente para manter o interesse do jogador e avançar a narrativa.
-        - Retorne apenas o diálogo (ex.: {npc}: "Texto..." Você: "Texto..."), sem narrativa ou colchetes.
-        - Máximo 3 trocas, 80 palavras.
-        {everyone_content_policy['policy']}
-    """        
+    return fit_prompt("npc_dialogue", lambda story_context, objective, clue: render_template(
+        "npc_dialogue", objective=objective, npc=npc, location=location_label(location), story_context=story_context, clue=clue
+    ), [
+        {'name': 'story_context', 'text': story_context, 'priority': 1, 'keep': 'end'},
+        {'name': 'objective', 'text': objective, 'priority': 2, 'keep': 'start'},
+        {'name': 'clue', 'text': clue, 'priority': 3, 'keep': 'start'}
+    ])
+
+compile_template("general_action", """
+    Responda ao comando do jogador com uma narrativa imersiva no local indicado. Não inclua uma lista de opções.
+    Tenha em mente o objetivo do jogo, mas não dê dicas sobre o papel dos NPCs na trama. O jogador deve ir descobrindo o que fazer, com leve direcionamento, para manter seu interesse.
+    Para comandos perguntando sobre destinos, (ex.: 'onde posso ir'), crie locais interessantes dentro da cidade (ex.: tavernas, becos, praças, mercado, templo) como o foco principal, mas liste também as saídas disponíveis do local (fornecidas no contexto).
+    Para comandos pedindo auxílo genérico para interação com NPCs (ex.:"com quem posso falar", "quem posso encontrar"), sugira dialogar com NPCs válidos (ex.: "Converse com os Eira Shadowglow ou com a Rainha Lyra sobre o plano do traidor").
+    Máximo 100 palavras.
+""", """
+    Objetivo: {objective}
+    NPCs válidos: {npc_list}
+    Local: {location}
+    Contexto: {story_context}
+    {clue}
+    Comando: {message}
+""", POLICY)
 
 def get_general_action_prompt(objective, message, location, story_context, clue, npc_list):
-    return f"""
-        Responda ao comando a seguir com uma narrativa imersiva em {location}. Não inclua uma lista de opções.
-        Objetivo: {objective}
-        Tenha em mente o objetivo do jogo, mas não dê dicas sobre o papel dos NPCs na trama. O jogador deve ir descobrindo o que fazer, com leve direcionamento, para manter seu interesse.
-        Contexto: {story_context}
-        NPCs válidos: {npc_list}
-        Comando: {message}
-        {clue}
-        Para comandos perguntando sobre destinos, (ex.: 'onde posso ir'), crie locais interessantes dentro da cidade (ex.: tavernas, becos, praças, mercado, templo) como o foco principal, mas liste também as saídas disponíveis de {location} (fornecidas no contexto).
-        Para comandos pedindo auxílo genérico para interação com NPCs (ex.:"com quem posso falar", "quem posso encontrar"), sugira dialogar com NPCs válidos (ex.: "Converse com os Eira Shadowglow ou com a Rainha Lyra sobre o plano do traidor").
-
-        Máximo 100 palavras.
-        {everyone_content_policy['policy']}
-    """
+    return fit_prompt("general_action", lambda story_context, objective, clue: render_template(
+        "general_action", objective=objective, npc_list=npc_list, location=location_label(location),
+        story_context=story_context, clue=clue, message=message
+    ), [
+        {'name': 'story_context', 'text': story_context, 'priority': 1, 'keep': 'end'},
+        {'name': 'objective', 'text': objective, 'priority': 2, 'keep': 'start'},
+        {'name': 'clue', 'text': clue, 'priority': 3, 'keep': 'start'}
+    ])
 
+compile_template("single_turn", """
+    Você é o Mestre do Jogo de um RPG de fantasia. Interprete o comando do jogador E responda a ele em uma única resposta.
+    Retorne SOMENTE um objeto JSON com:
+    - "action_type": ("dialogue", "exploration", "combat", "puzzle", "use_item", "investigate_npc", "generic")
+    - "details": objeto com detalhes (ex.: {"npc": "Lyra Westminster"}, {"location": "Taverna"}, {"item": "poção"})
+    - "narrative": se "action_type" for "dialogue", o diálogo com o NPC (ex.: Nome: "Texto..." Você: "Texto..."), máximo 3 trocas e 80 palavras;
+      se for "generic", uma narrativa imersiva no local atual respondendo ao comando, sem lista de opções, máximo 100 palavras;
+      para os demais tipos, ""
+    - "itemUpdates": lista de mudanças no inventário causadas pela narrativa (ex.: [{"item": "potions", "change": -1}]), ou [] se nenhuma
+    - "suggestion": sugestão de ação relevante ao objetivo (ex.: "Converse com Eira Shadowglow") se "action_type" for "generic", caso contrário ""
+    Regras de interpretação:
+    - Se o comando menciona um NPC ou continua um diálogo recente, use "dialogue" com o nome completo do NPC em "details" (ex.: "Eira" -> "Eira Shadowglow").
+    - Se o comando contém "procurar", "investigar", "examinar", "observar" ou "ir para", use "exploration" com "location" em "details".
+    - Perguntas vagas sobre ações ou interlocutores (ex.: "onde posso ir", "com quem posso falar") são "generic" com "details" vazio.
+    - Para destinos, crie locais dentro da cidade e liste também as saídas do local atual.
+    - Se o comando for ambíguo, use "generic".
+    - Não dê dicas sobre o papel dos NPCs na trama e evite repetir falas anteriores.
+    Não inclua texto fora do JSON. Responda em português.
+""", """
+    Objetivo: {objective}
+    NPCs válidos: {npc_list}
+    Local atual: {location}
+    Saídas: {exits}
+    Inventário atual: {inventory}
+    Contexto: {story_context}
+    Eventos recentes: {event_info}
+    {clue}
+    Comando do jogador: {command}
+""", POLICY)
 
+def get_single_turn_prompt(objective, story_context, command, event_info, npc_list, location, exits, clue, inventory):
+    return fit_prompt("single_turn", lambda story_context, event_info, objective, clue: render_template(
+        "single_turn", objective=objective, npc_list=npc_list, location=location_label(location),
+        exits=', '.join(exits) if exits else 'nenhuma conhecida', inventory=inventory,
+        story_context=story_context, event_info=event_info, clue=clue, command=command
+    ), [
+        {'name': 'story_context', 'text': story_context, 'priority': 1, 'keep': 'end'},
+        {'name': 'event_info', 'text': event_info, 'priority': 2, 'keep': 'end'},
+        {'name': 'objective', 'text': objective, 'priority': 3, 'keep': 'start'},
+        {'name': 'clue', 'text': clue, 'priority': 4, 'keep': 'start'}
+    ])
@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import random
+import sqlite3
+from difflib import SequenceMatcher
+
+from config import PUZZLE_LIBRARY_PATH, PUZZLE_TYPO_MIN_CHARS, PUZZLE_FUZZY_REJECT
+from create_log import create_log
+
+# Library of ready-made puzzles (riddle, accepted answers, hints), filled in the background so a
+# trick event does not wait for a model call. Like the narrative cache it lives in its own SQLite
+# file shared by the workers in the container and is not uploaded to GCS.
+
+# Answers containing these words are left to the model judge ("não é o tempo")
+NEGATION_WORDS = {"nao", "nem", "nunca", "jamais"}
+# Words ignored around an answer ("a resposta e o tempo", "acho que seria uma vela")
+ANSWER_STOPWORDS = {"o", "a", "os", "as", "um", "uma", "uns", "umas", "e", "eh", "de", "do", "da", "resposta",
+                    "acho", "que", "seria", "sera", "talvez", "creio", "penso", "isso", "isto", "ela", "ele"}
+
+def init_puzzle_library():
+    try:
+        os.makedirs(os.path.dirname(PUZZLE_LIBRARY_PATH), exist_ok=True)
+        with sqlite3.connect(PUZZLE_LIBRARY_PATH, timeout=5) as conn:
+            c = conn.cursor()
+            c.execute('''CREATE TABLE IF NOT EXISTS puzzles (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                content TEXT NOT NULL UNIQUE,
+                solution TEXT NOT NULL,
+                synonyms TEXT NOT NULL,
+                clues TEXT NOT NULL,
+                served INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL
+            )''')
+            conn.commit()
+    except Exception as e:
+        create_log(f"\n\nPUZZLE_LIBRARY: INIT_PUZZLE_LIBRARY: Error initializing library: {str(e)}\n\n", force_log=True)
+
+def count_puzzles():
+    try:
+        with sqlite3.connect(PUZZLE_LIBRARY_PATH, timeout=5) as conn:
+            return conn.execute("SELECT COUNT(*) FROM puzzles").fetchone()[0]
+    except Exception as e:
+        create_log(f"\n\nPUZZLE_LIBRARY: COUNT_PUZZLES: Error reading library: {str(e)}\n\n", force_log=True)
+        return 0
+
+def store_puzzles(puzzles, int_verbose=False):
+    """Store puzzles ({'content', 'solution', 'synonyms', 'clues'}), skipping riddles already in the library."""
+    stored = 0
+    try:
+        with sqlite3.connect(PUZZLE_LIBRARY_PATH, timeout=5) as conn:
+            c = conn.cursor()
+            for puzzle in puzzles:
+                c.execute("INSERT OR IGNORE INTO puzzles (content, solution, synonyms, clues, created_at) VALUES (?, ?, ?, ?, ?)",
+                          (puzzle['content'], puzzle['solution'], json.dumps(puzzle['synonyms'], ensure_ascii=False),
+                           json.dumps(puzzle['clues'], ensure_ascii=False), time.time()))
+                stored += c.rowcount
+            conn.commit()
+        if int_verbose:
+            create_log(f"PUZZLE_LIBRARY: STORE_PUZZLES: Stored {stored} of {len(puzzles)} puzzles")
+    except Exception as e:
+        create_log(f"\n\nPUZZLE_LIBRARY: STORE_PUZZLES: Error writing library: {str(e)}\n\n", force_log=True)
+    return stored
+
+def take_puzzle(exclude_contents=(), int_verbose=False):
+    """Return one of the least served puzzles the player has not seen yet, or None if there is none.
+    The puzzle counts as served once the caller passes its 'id' to mark_puzzle_served.
+    """
+    try:
+        with sqlite3.connect(PUZZLE_LIBRARY_PATH, timeout=5) as conn:
+            c = conn.cursor()
+            c.execute("SELECT id, content, solution, synonyms, clues, served FROM puzzles ORDER BY served LIMIT 50")
+            rows = [row for row in c.fetchall() if row[1] not in exclude_contents]
+            if not rows:
+                return None
+            least_served = rows[0][5]
+            puzzle_id, content, solution, synonyms, clues, _ = random.choice([row for row in rows if row[5] == least_served])
+        if int_verbose:
+            create_log(f"PUZZLE_LIBRARY: TAKE_PUZZLE: Picked puzzle {puzzle_id}: {content}")
+        return {'id': puzzle_id, 'content': content, 'solution': solution, 'synonyms': json.loads(synonyms), 'clues': json.loads(clues)}
+    except Exception as e:
+        create_log(f"\n\nPUZZLE_LIBRARY: TAKE_PUZZLE: Error reading library: {str(e)}\n\n", force_log=True)
+        return None
+
+def mark_puzzle_served(puzzle_id):
+    try:
+        with sqlite3.connect(PUZZLE_LIBRARY_PATH, timeout=5) as conn:
+            conn.execute("UPDATE puzzles SET served = served + 1 WHERE id = ?", (puzzle_id,))
+            conn.commit()
+    except Exception as e:
+        create_log(f"\n\nPUZZLE_LIBRARY: MARK_PUZZLE_SERVED: Error writing library: {str(e)}\n\n", force_log=True)
+
+def answer_words(text):
+    return [word for word in text.split() if word not in ANSWER_STOPWORDS]
+
+def is_swap_typo(answer, phrase):
+    """answer is phrase with two adjacent characters swapped ("tmepo"), and phrase is long enough
+    (PUZZLE_TYPO_MIN_CHARS) for that to be a typo. Insertions, deletions and replaced letters often
+    spell another word ("templo", "sobra", "porta"), so they are left to the model judge.
+    """
+    if len(answer) != len(phrase) or len(phrase) < PUZZLE_TYPO_MIN_CHARS:
+        return False
+    diffs = [i for i, (a, b) in enumerate(zip(answer, phrase)) if a != b]
+    return (len(diffs) == 2 and diffs[1] == diffs[0] + 1
+            and answer[diffs[0]] == phrase[diffs[1]] and answer[diffs[1]] == phrase[diffs[0]])
+
+def judge_answer(normalized_answer, normalized_accepted):
+    """Judge a normalized answer against the normalized accepted answers without a model call.
+    Returns True (solved), False (clearly wrong) or None when the model judge has to decide.
+    An answer is accepted only when, apart from stopwords, it is one accepted phrase (or a swap typo
+    of one). Other near misses, and longer answers containing a phrase such as a list of guesses,
+    go to the model judge.
+    """
+    all_words = normalized_answer.split()
+    if not all_words:
+        return False
+    if NEGATION_WORDS & set(all_words):
+        return None
+    words = answer_words(normalized_answer)
+    answer = " ".join(words)
+    best_ratio = 0.0
+    contains_match = False
+    shares_word = False
+    for accepted in normalized_accepted:
+        accepted_words = answer_words(accepted) or accepted.split()
+        if not accepted_words:
+            continue
+        phrase = " ".join(accepted_words)
+        if answer == phrase or is_swap_typo(answer, phrase):
+            return True
+        best_ratio = max(best_ratio, SequenceMatcher(None, phrase, answer).ratio())
+        shares_word = shares_word or any(len(word) > 3 and word in words for word in accepted_words)
+        # Something close to the phrase inside a longer answer: not clearly wrong
+        windows = [" ".join(words[i:i + len(accepted_words)]) for i in range(len(words) - len(accepted_words) + 1)]
+        contains_match = contains_match or any(SequenceMatcher(None, phrase, window).ratio() >= PUZZLE_FUZZY_REJECT for window in windows)
+    if contains_match:
+        return None
+    if best_ratio < PUZZLE_FUZZY_REJECT and not shares_word:
+        return False
+    return None
@@ -0,0 +1,154 @@
+import os
+import time
+import itertools
+import sqlite3
+import threading
+
+from config import RATE_LIMIT_PATH, LLM_RATE_PER_SECOND, LLM_BURST, LLM_RATE_MAX_WAIT, LLM_FAIR_QUEUE_MEMORY
+from create_log import create_log
+
+# Token bucket for Together requests shared by every gunicorn worker through a small SQLite
+# file (one row, updated under BEGIN IMMEDIATE). Provider rate-limit headers tighten the bucket
+# and a 429 pauses it. Within a worker, callers wait in a fair queue: interactive calls go
+# before background ones and, inside a class, the user served longest ago goes first, so a
+# player sending many commands cannot starve the others. The queue is per worker: the bucket is
+# shared, but fairness only holds among the callers of one worker.
+
+PRIORITIES = {"interactive": 0, "background": 1}
+
+scheduler = threading.Condition()
+waiting = []
+last_served = {}  # user -> monotonic time of their last slot, forgotten after LLM_FAIR_QUEUE_MEMORY
+arrivals = itertools.count()
+
+def init_rate_limiter():
+    try:
+        os.makedirs(os.path.dirname(RATE_LIMIT_PATH), exist_ok=True)
+        with sqlite3.connect(RATE_LIMIT_PATH, timeout=5) as conn:
+            c = conn.cursor()
+            c.execute('''CREATE TABLE IF NOT EXISTS token_bucket (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                paused_until REAL NOT NULL DEFAULT 0
+            )''')
+            c.execute("INSERT OR IGNORE INTO token_bucket (id, tokens, updated_at) VALUES (1, ?, ?)", (LLM_BURST, time.time()))
+            conn.commit()
+    except Exception as e:
+        create_log(f"\n\nRATE_LIMITER: INIT_RATE_LIMITER: Error initializing bucket: {str(e)}\n\n", force_log=True)
+
+def update_bucket(update):
+    """Run update(tokens, paused_until, now) -> (tokens, paused_until, result) on the refilled bucket
+    inside one write transaction, so workers never interleave. Returns result, or None on error.
+    """
+    conn = None
+    try:
+        conn = sqlite3.connect(RATE_LIMIT_PATH, timeout=5, isolation_level=None)
+        conn.execute("BEGIN IMMEDIATE")
+        tokens, updated_at, paused_until = conn.execute("SELECT tokens, updated_at, paused_until FROM token_bucket WHERE id = 1").fetchone()
+        now = time.time()
+        tokens = min(LLM_BURST, tokens + max(0.0, now - max(updated_at, paused_until)) * LLM_RATE_PER_SECOND)
+        tokens, paused_until, result = update(tokens, paused_until, now)
+        conn.execute("UPDATE token_bucket SET tokens = ?, updated_at = ?, paused_until = ? WHERE id = 1", (tokens, now, paused_until))
+        conn.execute("COMMIT")
+        return result
+    except Exception as e:
+        create_log(f"\n\nRATE_LIMITER: UPDATE_BUCKET: Error updating bucket: {str(e)}\n\n", force_log=True)
+        return None
+    finally:
+        if conn is not None:
+            conn.close()
+
+def take_token():
+    """Take one token. Returns 0 when taken, otherwise the seconds until one is expected."""
+    def update(tokens, paused_until, now):
+        if now < paused_until:
+            return tokens, paused_until, paused_until - now
+        if tokens >= 1:
+            return tokens - 1, paused_until, 0
+        return tokens, paused_until, (1 - tokens) / LLM_RATE_PER_SECOND
+    wait_time = update_bucket(update)
+    # Without the bucket file calls are let through rather than blocked
+    return 0 if wait_time is None else wait_time
+
+def prune_last_served(now):
+    """Forget users not served for LLM_FAIR_QUEUE_MEMORY. They then rank as never served, still
+    ahead of every recently served user. Called with the scheduler held."""
+    for user in [user for user, served_at in last_served.items() if now - served_at > LLM_FAIR_QUEUE_MEMORY]:
+        del last_served[user]
+
+def next_in_line():
+    return min(waiting, key=lambda w: (w[0], last_served.get(w[1], 0.0), w[2]))
+
+def acquire(user=None, priority="interactive"):
+    """Wait for a request slot. Returns the seconds waited, or None if LLM_RATE_MAX_WAIT passed."""
+    entry = (PRIORITIES.get(priority, 1), user, next(arrivals))
+    started = time.monotonic()
+    with scheduler:
+        waiting.append(entry)
+    try:
+        while True:
+            remaining = LLM_RATE_MAX_WAIT - (time.monotonic() - started)
+            if remaining <= 0:
+                return None
+            with scheduler:
+                if next_in_line() is not entry:
+                    scheduler.wait(timeout=min(0.5, remaining))
+                    continue
+            # The bucket transaction may wait on another worker's lock: run it without holding the
+            # scheduler, so the rest of the queue (and new arrivals) are not blocked behind it
+            wait_time = take_token()
+            if wait_time == 0:
+                with scheduler:
+                    served_at = time.monotonic()
+                    last_served[user] = served_at
+                    prune_last_served(served_at)
+                return served_at - started
+            with scheduler:
+                scheduler.wait(timeout=min(wait_time, 0.5, remaining))
+    finally:
+        with scheduler:
+            waiting.remove(entry)
+            scheduler.notify_all()
+
+def reset_seconds(reset):
+    """Seconds until an x-ratelimit-reset value: a delay ("2", "1.5s", "250ms") or an epoch
+    timestamp in seconds or milliseconds. None when it cannot be read."""
+    if reset is None:
+        return None
+    value = str(reset).strip().lower()
+    scale = 1.0
+    if value.endswith("ms"):
+        value, scale = value[:-2], 0.001
+    elif value.endswith("s"):
+        value = value[:-1]
+    try:
+        seconds = float(value) * scale
+    except ValueError:
+        return None
+    if seconds > 1e12:
+        seconds /= 1000
+    if seconds > 1e9:
+        seconds -= time.time()
+    return max(0.0, seconds)
+
+def observe_response(status_code, headers):
+    """Tighten the bucket with the provider's view: remaining requests and 429 pauses."""
+    remaining = headers.get("x-ratelimit-remaining")
+    retry_after = headers.get("Retry-After")
+    if retry_after is None:
+        retry_after = reset_seconds(headers.get("x-ratelimit-reset"))
+    if status_code != 429 and remaining is None:
+        return
+    def update(tokens, paused_until, now):
+        if status_code == 429:
+            try:
+                pause = float(retry_after)
+            except (TypeError, ValueError):
+                pause = 1.0
+            return 0.0, max(paused_until, now + min(pause, LLM_RATE_MAX_WAIT)), None
+        try:
+            return min(tokens, float(remaining)), paused_until, None
+        except ValueError:
+            return tokens, paused_until, None
+    update_bucket(update)
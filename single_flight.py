@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from config import SINGLE_FLIGHT_SHARED, SINGLE_FLIGHT_PATH, SINGLE_FLIGHT_WAIT
+from create_log import create_log
+
+# Single-flight coalescing of identical LLM requests: while a request with a given key is in
+# flight, other callers with the same key wait for it and share its result instead of sending
+# their own. Within a worker this uses in-memory flights. With SINGLE_FLIGHT_SHARED, workers also
+# coordinate through a lock table in SQLite: the worker that claims a key publishes the result
+# for the others, which poll for it. Nothing is shared once a flight has finished, so this is not
+# a result cache across players.
+
+flights = {}
+flights_lock = threading.Lock()
+suppressed = {'local': 0, 'shared': 0}
+
+def get_suppressed_counts():
+    with flights_lock:
+        return dict(suppressed)
+
+def init_single_flight():
+    if not SINGLE_FLIGHT_SHARED:
+        return
+    try:
+        os.makedirs(os.path.dirname(SINGLE_FLIGHT_PATH), exist_ok=True)
+        with sqlite3.connect(SINGLE_FLIGHT_PATH, timeout=5) as conn:
+            c = conn.cursor()
+            c.execute('''CREATE TABLE IF NOT EXISTS flights (
+                key TEXT PRIMARY KEY,
+                started_at REAL NOT NULL,
+                result TEXT,
+                finished_at REAL
+            )''')
+            conn.commit()
+    except Exception as e:
+        create_log(f"\n\nSINGLE_FLIGHT: INIT_SINGLE_FLIGHT: Error initializing lock table: {str(e)}\n\n", force_log=True)
+
+def claim_shared(key):
+    """Claim the key across workers. Returns 'leader', or 'follower' when another worker is running it.
+    A finished flight is taken over by the next caller: results are only shared with requests
+    that were waiting while it ran, never with later ones (they may come from other players).
+    """
+    now = time.time()
+    try:
+        with sqlite3.connect(SINGLE_FLIGHT_PATH, timeout=5) as conn:
+            c = conn.cursor()
+            # Finished results are kept for followers still polling, unfinished claims are abandoned after the wait limit
+            c.execute("DELETE FROM flights WHERE COALESCE(finished_at, started_at) < ?", (now - SINGLE_FLIGHT_WAIT,))
+            c.execute("""INSERT INTO flights (key, started_at) VALUES (?, ?)
+                         ON CONFLICT(key) DO UPDATE SET started_at = excluded.started_at, result = NULL, finished_at = NULL
+                         WHERE finished_at IS NOT NULL""", (key, now))
+            claimed = c.rowcount == 1
+            conn.commit()
+        return 'leader' if claimed else 'follower'
+    except Exception as e:
+        create_log(f"\n\nSINGLE_FLIGHT: CLAIM_SHARED: Error reading lock table: {str(e)}\n\n", force_log=True)
+        return 'leader'
+
+def publish_shared(key, result):
+    try:
+        with sqlite3.connect(SINGLE_FLIGHT_PATH, timeout=5) as conn:
+            if result is None:
+                conn.execute("DELETE FROM flights WHERE key = ?", (key,))
+            else:
+                conn.execute("UPDATE flights SET result = ?, finished_at = ? WHERE key = ?", (json.dumps(result), time.time(), key))
+            conn.commit()
+    except Exception as e:
+        create_log(f"\n\nSINGLE_FLIGHT: PUBLISH_SHARED: Error writing lock table: {str(e)}\n\n", force_log=True)
+
+def wait_shared(key):
+    """Poll for the result another worker is producing. Returns None if it does not arrive in time."""
+    deadline = time.time() + SINGLE_FLIGHT_WAIT
+    delay = 0.05
+    while time.time() < deadline:
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+        try:
+            with sqlite3.connect(SINGLE_FLIGHT_PATH, timeout=5) as conn:
+                row = conn.execute("SELECT result FROM flights WHERE key = ?", (key,)).fetchone()
+        except Exception as e:
+            create_log(f"\n\nSINGLE_FLIGHT: WAIT_SHARED: Error reading lock table: {str(e)}\n\n", force_log=True)
+            return None
+        if row is None:
+            # The leader failed and released the key
+            return None
+        if row[0] is not None:
+            return json.loads(row[0])
+    return None
+
+def run(key, fn):
+    """Return fn(), or the result of an identical in-flight call with the same key."""
+    with flights_lock:
+        flight = flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = flights[key] = {'done': threading.Event(), 'result': None, 'error': None}
+        else:
+            suppressed['local'] += 1
+    if not leader:
+        flight['done'].wait()
+        if flight['error'] is not None:
+            raise flight['error']
+        return flight['result']
+    try:
+        flight['result'] = run_shared(key, fn) if SINGLE_FLIGHT_SHARED else fn()
+        return flight['result']
+    except Exception as e:
+        flight['error'] = e
+        raise
+    finally:
+        with flights_lock:
+            flights.pop(key, None)
+        flight['done'].set()
+
+def run_shared(key, fn):
+    if claim_shared(key) == 'follower':
+        result = wait_shared(key)
+        if result is not None:
+            with flights_lock:
+                suppressed['shared'] += 1
+            return result
+        # Nothing arrived from the other worker in time, run it here
+        return fn()
+    result = None
+    try:
+        result = fn()
+        return result
+    finally:
+        publish_shared(key, result)
@@ -0,0 +1,198 @@
+import json
+import hashlib
+from dataclasses import dataclass, field, fields, is_dataclass, MISSING
+from typing import Any, Optional, Union, get_type_hints, get_origin, get_args
+
+# The schema of a saved game, written once as dataclasses. The game itself keeps working on the
+# plain dict (turn code, client view patches and speculative snapshots all index it), so the
+# classes are not instantiated: each one is compiled into a checker that walks the decoded JSON,
+# checks every field against its annotation and fills the defaults of missing fields in place.
+# Keys outside the schema ('derived', 'history_index', 'history_chunks', ...) are kept as they are.
+
+@dataclass(slots=True)
+class Resources:
+    # update_inventory drops items that reach 0, so a missing key is a spent resource; the
+    # starting amounts only apply when the whole object is missing (GameState.resources)
+    wands: int = 0
+    potions: int = 0
+    energy: int = 0
+
+@dataclass(slots=True)
+class Location:
+    name: str
+    exploring_location: Optional[str] = None
+
+@dataclass(slots=True)
+class Clue:
+    content: str
+    id: Any
+    false_clue: bool = False  # Older saves have a 'false' key instead (see derived_state.is_false_clue)
+    awarded: bool = True
+
+@dataclass(slots=True)
+class NpcStatus:
+    name: str
+    status: str
+    supposed_status: str = 'Neutral'
+    description: str = ""
+
+@dataclass(slots=True)
+class MapPlace:
+    # 'discovered' is filled by map_graph.ensure_map_graph, from the description
+    description: str = ""
+    exits: list[str] = field(default_factory=list)
+
+@dataclass(slots=True)
+class HistoryEntry:
+    role: str
+    content: str
+
+def history_key(entry):
+    """Short hash identifying a history entry (duplicate check, history chunks)."""
+    return hashlib.blake2b(f"{entry['role']}\n{entry['content']}".encode('utf-8'), digest_size=8).hexdigest()
+
+@dataclass(slots=True)
+class GameState:
+    history: list[HistoryEntry]
+    output_image: str
+    ambient_sound: str
+    location: Union[Location, str]  # Plain place name in older saves
+    known_map: dict[str, MapPlace]
+    current_state: Optional[int]
+    health: float
+    awarded_clues: list[Clue]
+    npc_status: dict[str, NpcStatus]
+    character: str
+    skill: float
+    game_objective: str
+    resources: Resources = field(default_factory=lambda: {'wands': 2, 'potions': 2, 'energy': 5})
+    combat_results: list[Any] = field(default_factory=list)
+    puzzle_results: list[Any] = field(default_factory=list)
+    active_puzzle: Optional[dict[str, Any]] = None
+    active_combat: Optional[dict[str, Any]] = None
+    waiting_for_option: bool = False
+    event_result: Any = "Nenhum evento ocorreu."
+
+class GameStateError(ValueError):
+    """Game state not matching the schema. path is where, e.g. ['npc_status', 'Lyra', 'status']."""
+    def __init__(self, path, message):
+        self.path = path
+        self.message = message
+        super().__init__(message)
+
+    def __str__(self):
+        return f"{'.'.join(str(part) for part in self.path) or 'game_state'}: {self.message}"
+
+checkers = {}
+
+def compile_type(annotation):
+    """Checker for a field annotation: a function of the value that raises GameStateError.
+    The path of an error is built while it propagates, so valid states pay nothing for it.
+    """
+    if annotation is Any:
+        return lambda value: None
+    if is_dataclass(annotation):
+        return compile_record(annotation)
+    origin, args = get_origin(annotation), get_args(annotation)
+    if origin is Union:
+        nullable = type(None) in args
+        options = [compile_type(arg) for arg in args if arg is not type(None)]
+        def check_union(value):
+            if value is None and nullable:
+                return
+            error = None
+            for option in options:
+                try:
+                    return option(value)
+                except GameStateError as e:
+                    error = error or e
+            raise error
+        return check_union
+    if origin is list:
+        check_item = compile_type(args[0])
+        def check_list(value):
+            if not isinstance(value, list):
+                raise GameStateError([], f"expected a list, got {type(value).__name__}")
+            for position, item in enumerate(value):
+                try:
+                    check_item(item)
+                except GameStateError as e:
+                    e.path.insert(0, position)
+                    raise
+        return check_list
+    if origin is dict:
+        check_item = compile_type(args[1])
+        def check_dict(value):
+            if not isinstance(value, dict):
+                raise GameStateError([], f"expected an object, got {type(value).__name__}")
+            for key, item in value.items():
+                try:
+                    check_item(item)
+                except GameStateError as e:
+                    e.path.insert(0, key)
+                    raise
+        return check_dict
+    # JSON has one number type: floats accept ints, and bools (an int subclass) are no numbers
+    accepted = (int, float) if annotation is float else (annotation,)
+    def check_scalar(value):
+        if not isinstance(value, accepted) or (isinstance(value, bool) and annotation is not bool):
+            raise GameStateError([], f"expected {annotation.__name__}, got {type(value).__name__}")
+    return check_scalar
+
+def compile_record(cls):
+    if cls in checkers:
+        return checkers[cls]
+    hints = get_type_hints(cls)
+    spec = []
+    for schema_field in fields(cls):
+        if schema_field.default_factory is not MISSING:
+            default = schema_field.default_factory
+        elif schema_field.default is not MISSING:
+            default = lambda value=schema_field.default: value
+        else:
+            default = None
+        spec.append((schema_field.name, compile_type(hints[schema_field.name]), default))
+    def check_record(value):
+        if not isinstance(value, dict):
+            raise GameStateError([], f"expected a {cls.__name__} object, got {type(value).__name__}")
+        for name, check_field, default in spec:
+            if name in value:
+                try:
+                    check_field(value[name])
+                except GameStateError as e:
+                    e.path.insert(0, name)
+                    raise
+            elif default is not None:
+                value[name] = default()
+            else:
+                raise GameStateError([name], "missing")
+    checkers[cls] = check_record
+    return check_record
+
+def check_game_state(game_state):
+    """Validate a game state dict against the schema, filling missing defaults in place.
+    Returns game_state; raises GameStateError.
+    """
+    compile_record(GameState)(game_state)
+    return game_state
+
+def check_history(entries):
+    """Validate history entries on their own (history chunks are checked once, when written)."""
+    if 'history' not in checkers:
+        checkers['history'] = compile_type(list[HistoryEntry])
+    checkers['history'](entries)
+    return entries
+
+def encode_game_state(game_state):
+    """Compact JSON for the database and the session: no indentation or spaces after separators,
+    and accented text written as is instead of \\u escapes.
+    """
+    return json.dumps(game_state, ensure_ascii=False, separators=(',', ':'))
+
+def decode_game_state(text):
+    """Parse and validate a saved game state. Raises GameStateError (also for malformed JSON)."""
+    try:
+        game_state = json.loads(text)
+    except (TypeError, ValueError) as e:
+        raise GameStateError([], f"not JSON: {e}")
+    return check_game_state(game_state)
@@ -0,0 +1,262 @@
+import json
+import time
+import hashlib
+import sqlite3
+
+import zstandard
+
+from config import (
+    DB_PATH, STATE_COMPRESSION, STATE_ZSTD_LEVEL, STATE_DICT_SIZE, STATE_DICT_SAMPLES, STATE_DICT_MIN_SAMPLES,
+    HISTORY_CHUNK_ENTRIES
+)
+from create_log import create_log
+from state_model import GameStateError, encode_game_state, decode_game_state, check_history, history_key
+
+# Storage format of the game_states.game_state column. Saves repeat the same keys, NPC
+# descriptions, objective and narrative phrases, so they are compressed with zstd and a
+# dictionary trained on earlier saves:
+#     STATE_FORMAT_ZSTD (1 byte) + zstd frame (BLOB)
+# The frame header names the dictionary it needs (0 = none). Dictionaries are kept in the
+# state_dictionaries table of users.db, so they travel to GCS with the saves that use them and are
+# never deleted. Rows written before compression are JSON text and are read as they are; they
+# are compressed the next time they are saved.
+#
+# A save is a small head record: the game state without its history, plus
+#     'history_chunks': {'head': chunk_hash or None, 'entries': n}
+# and the history entries after the first n in 'history'. The first n entries are a chain of
+# immutable chunks of HISTORY_CHUNK_ENTRIES entries in the history_chunks table, each addressed by
+# the hash of its content and of the chunk before it. History only grows, so the saves and the
+# autosave of one game share their chunks: saving to a slot or loading one copies a head, and a
+# turn writes a new chunk only when the inline entries fill one.
+
+STATE_FORMAT_ZSTD = 1
+
+dictionaries = {}  # dict_id -> zstandard.ZstdCompressionDict, loaded on first use
+current_dictionary = None  # dict_id used for new saves, None until one is trained
+
+def init_state_store(int_verbose=False):
+    """Create the dictionary table, load the newest dictionary and train the first one once
+    there are enough saves. Called at startup, after init_db.
+    """
+    try:
+        with sqlite3.connect(DB_PATH) as conn:
+            c = conn.cursor()
+            c.execute('''CREATE TABLE IF NOT EXISTS state_dictionaries (
+                dict_id INTEGER PRIMARY KEY,
+                dictionary BLOB NOT NULL,
+                samples INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''')
+            c.execute('''CREATE TABLE IF NOT EXISTS history_chunks (
+                chunk_hash TEXT PRIMARY KEY,
+                prev_hash TEXT,
+                data BLOB NOT NULL
+            )''')
+            conn.commit()
+            c.execute("SELECT dict_id, dictionary FROM state_dictionaries ORDER BY dict_id DESC LIMIT 1")
+            row = c.fetchone()
+        if row:
+            use_dictionary(row[0], zstandard.ZstdCompressionDict(row[1]))
+            if int_verbose:
+                create_log(f"STATE_STORE: INIT_STATE_STORE: Using dictionary {row[0]}")
+        else:
+            train_state_dictionary(int_verbose=int_verbose)
+        collect_history_chunks(int_verbose=int_verbose)
+    except Exception as e:
+        create_log(f"\n\nSTATE_STORE: INIT_STATE_STORE: Error initializing state store: {str(e)}\n\n", force_log=True)
+
+def training_samples(game_state):
+    """A save split into the pieces that repeat across saves: each top-level entry and each history entry."""
+    samples = []
+    for key, value in game_state.items():
+        if key == 'history':
+            samples.extend(encode_game_state(entry).encode('utf-8') for entry in value)
+        elif key != 'history_index':
+            samples.append(encode_game_state({key: value}).encode('utf-8'))
+    return samples
+
+def build_dictionary(game_states, dict_id, chunks=()):
+    """Dictionary trained on save heads and on history chunks (most of the history of a game
+    lives in its chunks, the heads keep only the last entries)."""
+    samples = [sample for game_state in game_states for sample in training_samples(game_state)]
+    samples.extend(encode_game_state(entry).encode('utf-8') for chunk in chunks for entry in chunk['entries'])
+    return zstandard.train_dictionary(STATE_DICT_SIZE, samples, dict_id=dict_id, level=STATE_ZSTD_LEVEL)
+
+def use_dictionary(dict_id, dictionary):
+    global current_dictionary
+    dictionary.precompute_compress(level=STATE_ZSTD_LEVEL)
+    dictionaries[dict_id] = dictionary
+    current_dictionary = dict_id
+
+def train_state_dictionary(int_verbose=False):
+    """Train a dictionary on the most recent saves and history chunks and use it for new saves. Saves compressed
+    with an older dictionary keep reading with it. Returns the new dict_id, or None.
+    """
+    try:
+        with sqlite3.connect(DB_PATH) as conn:
+            c = conn.cursor()
+            c.execute("SELECT game_state FROM game_states ORDER BY created_at DESC LIMIT ?", (STATE_DICT_SAMPLES,))
+            rows = c.fetchall()
+            if len(rows) < STATE_DICT_MIN_SAMPLES:
+                if int_verbose:
+                    create_log(f"STATE_STORE: TRAIN_STATE_DICTIONARY: {len(rows)} saves, need {STATE_DICT_MIN_SAMPLES} to train")
+                return None
+            game_states = []
+            for (stored,) in rows:
+                try:
+                    game_states.append(json.loads(unpack_value(stored)))
+                except (GameStateError, ValueError):
+                    continue
+            chunks = []
+            for (data,) in c.execute("SELECT data FROM history_chunks ORDER BY rowid DESC LIMIT ?", (STATE_DICT_SAMPLES,)).fetchall():
+                try:
+                    chunks.append(json.loads(unpack_value(data)))
+                except (GameStateError, ValueError):
+                    continue
+            c.execute("SELECT COALESCE(MAX(dict_id), 0) + 1 FROM state_dictionaries")
+            dict_id = c.fetchone()[0]
+            dictionary = build_dictionary(game_states, dict_id, chunks)
+            c.execute("INSERT INTO state_dictionaries (dict_id, dictionary, samples) VALUES (?, ?, ?)",
+                      (dict_id, dictionary.as_bytes(), len(game_states)))
+            conn.commit()
+        use_dictionary(dict_id, dictionary)
+        create_log(f"STATE_STORE: TRAIN_STATE_DICTIONARY: Trained dictionary {dict_id} ({len(dictionary.as_bytes())} bytes) on {len(game_states)} saves and {len(chunks)} history chunks", force_log=True)
+        return dict_id
+    except Exception as e:
+        create_log(f"\n\nSTATE_STORE: TRAIN_STATE_DICTIONARY: Error training dictionary: {str(e)}\n\n", force_log=True)
+        return None
+
+def get_dictionary(dict_id):
+    if dict_id not in dictionaries:
+        with sqlite3.connect(DB_PATH) as conn:
+            row = conn.execute("SELECT dictionary FROM state_dictionaries WHERE dict_id = ?", (dict_id,)).fetchone()
+        if not row:
+            raise GameStateError([], f"compressed with unknown dictionary {dict_id}")
+        dictionaries[dict_id] = zstandard.ZstdCompressionDict(row[0])
+    return dictionaries[dict_id]
+
+def pack_value(value):
+    """Value stored in a game_state or history chunk column: a compressed BLOB, or JSON text with
+    STATE_COMPRESSION off."""
+    text = encode_game_state(value)
+    if not STATE_COMPRESSION:
+        return text
+    compressor = zstandard.ZstdCompressor(level=STATE_ZSTD_LEVEL, dict_data=dictionaries.get(current_dictionary))
+    return bytes([STATE_FORMAT_ZSTD]) + compressor.compress(text.encode('utf-8'))
+
+def unpack_value(stored):
+    """JSON of a stored value (str or UTF-8 bytes, both accepted by json.loads).
+    Rows are fetched as they are stored and only decompressed here, when a route decodes them.
+    """
+    if isinstance(stored, str):
+        return stored
+    if not stored or stored[0] != STATE_FORMAT_ZSTD:
+        raise GameStateError([], f"unknown storage format {bytes(stored[:1])!r}")
+    frame = memoryview(stored)[1:]
+    try:
+        dict_id = zstandard.get_frame_parameters(frame).dict_id
+        decompressor = zstandard.ZstdDecompressor(dict_data=get_dictionary(dict_id) if dict_id else None)
+        return decompressor.decompress(frame)
+    except zstandard.ZstdError as e:
+        raise GameStateError([], f"corrupt compressed state: {e}")
+
+def store_game_head(c, user_id, game_name, head):
+    c.execute("INSERT OR REPLACE INTO game_states (user_id, game_name, game_state, created_at) VALUES (?, ?, ?, ?)",
+              (user_id, game_name, pack_value(head), time.strftime('%Y-%m-%d %H:%M:%S')))
+
+def store_game_state(c, user_id, game_name, game_state):
+    """Write a game with the cursor of the caller (who commits): new full chunks of its history,
+    then its head record. Returns the head.
+    """
+    history = game_state['history']
+    marker = game_state.get('history_chunks') or {'head': None, 'entries': 0}
+    chunk_hash, chunked = marker['head'], marker['entries']
+    if chunked > len(history):
+        chunk_hash, chunked = None, 0
+    while len(history) - chunked >= HISTORY_CHUNK_ENTRIES:
+        entries = check_history(history[chunked:chunked + HISTORY_CHUNK_ENTRIES])
+        # Keys of the entries are stored too, so loading rebuilds history_index without hashing
+        chunk = {'prev': chunk_hash, 'entries': entries, 'keys': [history_key(entry) for entry in entries]}
+        prev_hash, chunk_hash = chunk_hash, hashlib.blake2b(encode_game_state(chunk).encode('utf-8'), digest_size=16).hexdigest()
+        c.execute("INSERT OR IGNORE INTO history_chunks (chunk_hash, prev_hash, data) VALUES (?, ?, ?)",
+                  (chunk_hash, prev_hash, pack_value(chunk)))
+        chunked += HISTORY_CHUNK_ENTRIES
+    game_state['history_chunks'] = {'head': chunk_hash, 'entries': chunked}
+    head = {key: value for key, value in game_state.items() if key not in ('history', 'history_index')}
+    head['history'] = history[chunked:]
+    store_game_head(c, user_id, game_name, head)
+    return head
+
+def copy_game_state(c, user_id, source_name, target_name):
+    """Copy-on-write save: the target gets the head of the source, chunks stay shared. Returns
+    False when the source does not exist.
+    """
+    c.execute("""INSERT OR REPLACE INTO game_states (user_id, game_name, game_state, created_at)
+                 SELECT user_id, ?, game_state, ? FROM game_states WHERE user_id = ? AND game_name = ?""",
+              (target_name, time.strftime('%Y-%m-%d %H:%M:%S'), user_id, source_name))
+    return c.rowcount > 0
+
+def read_game_head(stored):
+    """Head record of a stored game, validated (its 'history' holds only the inline entries).
+    Rows from before history chunks hold the whole game."""
+    return decode_game_state(unpack_value(stored))
+
+def restore_history(game_state):
+    """Prepend the chunked history entries to the inline ones and index them."""
+    marker = game_state.get('history_chunks')
+    if not marker:
+        return game_state
+    entries, keys = [], []
+    if marker['head']:
+        with sqlite3.connect(DB_PATH) as conn:
+            rows = conn.execute("""WITH RECURSIVE chain(chunk_hash, prev_hash, data, depth) AS (
+                    SELECT chunk_hash, prev_hash, data, 0 FROM history_chunks WHERE chunk_hash = ?
+                    UNION ALL
+                    SELECT h.chunk_hash, h.prev_hash, h.data, chain.depth + 1 FROM history_chunks h JOIN chain ON h.chunk_hash = chain.prev_hash
+                ) SELECT data FROM chain ORDER BY depth DESC""", (marker['head'],)).fetchall()
+        for (data,) in rows:
+            chunk = json.loads(unpack_value(data))
+            entries.extend(chunk['entries'])
+            keys.extend(chunk['keys'])
+    if len(entries) != marker['entries']:
+        raise GameStateError(['history_chunks'], f"{len(entries)} of {marker['entries']} chunked entries found")
+    inline = game_state['history']
+    game_state['history'] = entries + inline
+    game_state['history_index'] = {key: position for position, key in enumerate(keys + [history_key(entry) for entry in inline])}
+    return game_state
+
+def read_game_state(stored):
+    """Whole game of a stored value: the validated head plus its history chunks, which were
+    validated when written and are never rewritten."""
+    return restore_history(read_game_head(stored))
+
+def collect_history_chunks(int_verbose=False):
+    """Delete chunks no save refers to any more (deleted users and slots). Called at startup.
+    Runs in one write transaction: another worker's save (chunks, then the head referring to them)
+    cannot land between reading the heads and deleting the chunks they do not reach.
+    """
+    with sqlite3.connect(DB_PATH, timeout=30) as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        prev_of = dict(c.execute("SELECT chunk_hash, prev_hash FROM history_chunks").fetchall())
+        if not prev_of:
+            conn.rollback()
+            return 0
+        live = set()
+        for (stored,) in c.execute("SELECT game_state FROM game_states").fetchall():
+            try:
+                chunk_hash = (json.loads(unpack_value(stored)).get('history_chunks') or {}).get('head')
+            except (GameStateError, ValueError, AttributeError) as e:
+                # An unreadable head may still refer to chunks: keep them all
+                create_log(f"\n\nSTATE_STORE: COLLECT_HISTORY_CHUNKS: Skipped, unreadable save: {str(e)}\n\n", force_log=True)
+                conn.rollback()
+                return 0
+            while chunk_hash and chunk_hash not in live:
+                live.add(chunk_hash)
+                chunk_hash = prev_of.get(chunk_hash)
+        dead = [(chunk_hash,) for chunk_hash in prev_of if chunk_hash not in live]
+        c.executemany("DELETE FROM history_chunks WHERE chunk_hash = ?", dead)
+        conn.commit()
+    if int_verbose or dead:
+        create_log(f"STATE_STORE: COLLECT_HISTORY_CHUNKS: Deleted {len(dead)} of {len(prev_of)} history chunks", force_log=bool(dead))
+    return len(dead)
@@ -0,0 +1,365 @@
+"""Manual benchmarks, not part of the app image (see .dockerignore).
+Run with the app environment (.env) in place:
+    python test_bench.py               # every benchmark
+    python test_bench.py turn_modes    # only the named ones
+"""
+import sys
+import copy
+import json
+import time
+import random
+import sqlite3
+import tempfile
+import os
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def bench_turn_modes(runs=3):
+    """LLM calls per turn and p50/p95 latency of the two-step and single-call turn modes."""
+    from main_flask import get_initial_game_state, run_action, turn_context
+
+    base_state = get_initial_game_state()
+    npc = next(iter(base_state['npc_status']))
+    commands = [
+        "olhar ao redor",
+        "onde posso ir",
+        "com quem posso falar",
+        f"falar com {npc}",
+        f"perguntar a {npc} sobre o traidor",
+        "o que devo fazer agora",
+    ]
+    for turn_mode in ("two_step", "single"):
+        latencies, calls = [], []
+        for _ in range(runs):
+            game_state = copy.deepcopy(base_state)
+            for command in commands:
+                started = time.perf_counter()
+                run_action(command, game_state, turn_mode=turn_mode)
+                latencies.append(time.perf_counter() - started)
+                calls.append(turn_context.turn_calls)
+        print(f"TURN_MODES: {turn_mode}: turns={len(latencies)} calls/turn={sum(calls) / len(calls):.2f} "
+              f"p50={percentile(latencies, 0.5):.2f}s p95={percentile(latencies, 0.95):.2f}s")
+
+
+def bench_clue_evaluator():
+    """Share of the labelled combat actions (clue_use_samples.json) decided locally, and mistakes among them."""
+    from main_flask import normalize_command
+    from clue_evaluator import evaluate_clue_use
+
+    with open('clue_use_samples.json', encoding='utf-8') as f:
+        samples = json.load(f)
+    decided, wrong = 0, []
+    started = time.perf_counter()
+    for sample in samples:
+        used = evaluate_clue_use(normalize_command(sample['action']), normalize_command(sample['clue']))
+        if used is not None:
+            decided += 1
+            if used != sample['used']:
+                wrong.append(sample['action'])
+    elapsed = time.perf_counter() - started
+    print(f"CLUE_EVALUATOR: samples={len(samples)} local={decided / len(samples):.0%} escalated={len(samples) - decided} "
+          f"wrong={len(wrong)} avg={elapsed / len(samples) * 1e6:.0f}us")
+    for action in wrong:
+        print(f"CLUE_EVALUATOR: wrong: {action}")
+
+
+def bench_puzzle_judge():
+    """Verdicts of the local puzzle judge on labelled answers (None: left to the model judge)."""
+    from main_flask import normalize_command
+    from puzzle_library import judge_answer
+
+    cases = [
+        ("tempo", ["tempo"], True),
+        ("A resposta é o tempo!", ["o tempo"], True),
+        ("tmepo", ["tempo"], True),
+        ("templo", ["tempo"], None),
+        ("o templo", ["o tempo"], None),
+        ("sobra", ["sombra"], None),
+        ("rico", ["rio"], None),
+        ("porta", ["porto"], None),
+        ("tempo, vento ou fogo", ["tempo"], None),
+        ("não é o tempo", ["tempo"], None),
+        ("fogo", ["tempo"], False),
+    ]
+    wrong = []
+    for answer, accepted, expected in cases:
+        verdict = judge_answer(normalize_command(answer), [normalize_command(phrase) for phrase in accepted])
+        if verdict is not expected:
+            wrong.append(f"{answer!r} vs {accepted}: {verdict}, expected {expected}")
+    print(f"PUZZLE_JUDGE: cases={len(cases)} wrong={len(wrong)}")
+    for case in wrong:
+        print(f"PUZZLE_JUDGE: wrong: {case}")
+
+
+def bench_objective_fallback():
+    """Malformed generated objectives must start the default game instead of a game rejected on its next load."""
+    import main_flask
+    from state_model import GameStateError, decode_game_state, encode_game_state
+
+    default = main_flask.default_game_objective()
+    place = next(iter(default['initial_map']))
+    malformed = {
+        'null npc status': dict(default, npcs=[dict(default['npcs'][0], status=None)]),
+        'object exits': dict(default, initial_map={place: {'description': "Cidade.", 'exits': {'norte': "Floresta"}}}),
+        'unhashable exits': dict(default, initial_map={place: {'description': "Cidade.", 'exits': [{'name': "Floresta"}]}}),
+        'numeric exits': dict(default, initial_map={place: {'description': "Cidade.", 'exits': [1, 2]}}),
+        'map as list': dict(default, initial_map=[place]),
+        'missing true clue': {key: value for key, value in default.items() if key != 'true_clue'},
+    }
+    generate_game_objective = main_flask.generate_game_objective
+    wrong = []
+    try:
+        for label, objective in malformed.items():
+            main_flask.generate_game_objective = lambda int_verbose=False, objective=objective: copy.deepcopy(objective)
+            try:
+                game_state = main_flask.get_initial_game_state()
+                decode_game_state(encode_game_state(game_state))
+                if game_state['game_objective'] != default['objective']:
+                    wrong.append(f"{label}: kept the malformed objective")
+            except (GameStateError, KeyError, TypeError, AttributeError) as e:
+                wrong.append(f"{label}: {type(e).__name__}: {e}")
+    finally:
+        main_flask.generate_game_objective = generate_game_objective
+    print(f"OBJECTIVE_FALLBACK: cases={len(malformed)} wrong={len(wrong)}")
+    for case in wrong:
+        print(f"OBJECTIVE_FALLBACK: wrong: {case}")
+
+
+def bench_model_routes(runs=5):
+    """Latency, tokens and schema validity of the command interpreter prompt on each model tier."""
+    from main_flask import (
+        get_initial_game_state, format_chat_history, chat_completion, parse_json_object, validate_schema,
+        get_metrics, INTERPRETER_SCHEMA, ACTION_TYPES
+    )
+    from prompts import get_command_interpreter_prompt
+    from config import MODEL_TIERS
+
+    game_state = get_initial_game_state()
+    npc = next(iter(game_state['npc_status']))
+    prompts = [
+        get_command_interpreter_prompt(
+            format_chat_history(game_state['history'][-4:], game_state), command, "", ", ".join(game_state['npc_status'])
+        )
+        for command in ("olhar ao redor", f"falar com {npc}", "usar uma poção", "explorar a floresta")
+    ]
+    for tier, model in MODEL_TIERS.items():
+        valid = 0
+        for _ in range(runs):
+            for prompt in prompts:
+                data = parse_json_object(chat_completion(prompt, "bench_interpreter", model=model, max_tokens=200, temperature=0.0))
+                valid += validate_schema(data, INTERPRETER_SCHEMA) and data['action_type'] in ACTION_TYPES
+        route = get_metrics()['routes'][f"bench_interpreter:{model}"]
+        print(f"MODEL_ROUTES: {tier} ({model}): calls={route['count']} valid={valid / route['count']:.0%} "
+              f"avg_tokens={route['avg_tokens']} p50={route['p50_latency']}s p95={route['p95_latency']}s")
+
+
+def bench_prompt_templates():
+    """Tokens in the fixed prefix and in the per-call suffix of each compiled prompt template."""
+    import os
+    from prompts import POLICY
+    from prompt_templates import templates, minify
+    from context_budget import estimate_tokens
+
+    for name, template in sorted(templates.items()):
+        prefix, suffix = estimate_tokens(template['prefix']), estimate_tokens(template['suffix'])
+        print(f"PROMPT_TEMPLATES: {name}: prefix={prefix} suffix={suffix} cacheable={prefix / (prefix + suffix):.0%}")
+    with_policy = [t['prefix'] for t in templates.values() if t['prefix'].startswith(minify(POLICY))]
+    print(f"PROMPT_TEMPLATES: {len(with_policy)} templates share a {estimate_tokens(os.path.commonprefix(with_policy))} token policy prefix")
+
+
+def bench_world_index():
+    """Tokens of the world sent to the game objective prompt: whole world vs. starting town subset."""
+    from world import world, world_with_npcs
+    from world_index import world_index, get_objective_world
+    from context_budget import estimate_tokens
+
+    full, full_npcs = estimate_tokens(str(world)), estimate_tokens(str(world_with_npcs))
+    for town in world_index['towns']:
+        subset = estimate_tokens(get_objective_world(town)[1])
+        print(f"WORLD_INDEX: {town}: subset={subset} world={full} ({full / subset:.1f}x) world_with_npcs={full_npcs} ({full_npcs / subset:.1f}x)")
+
+
+def bench_history_dedup(sizes=(1000, 10000), runs=50):
+    """Per-request cost of the full duplicate scan vs. append-time dedup, at 1k and 10k turns."""
+    from main_flask import clean_duplicate_history, migrate_history_index, append_history
+
+    for turns in sizes:
+        history = []
+        for turn in range(turns):
+            history.append({'role': 'user', 'content': f"comando {turn % 50}"})
+            history.append({'role': 'assistant', 'content': f"Narrativa do turno {turn}. " * 20})
+        started = time.perf_counter()
+        for _ in range(runs):
+            clean_duplicate_history({'history': list(history)})
+        full_scan = (time.perf_counter() - started) / runs
+        game_state = {'history': list(history)}
+        started = time.perf_counter()
+        migrate_history_index(game_state)
+        migration = time.perf_counter() - started
+        started = time.perf_counter()
+        for run in range(runs):
+            migrate_history_index(game_state)
+            append_history(game_state, {'role': 'user', 'content': f"novo comando {run}"}, {'role': 'assistant', 'content': f"Nova narrativa {run}."})
+        appended = (time.perf_counter() - started) / runs
+        print(f"HISTORY_DEDUP: turns={turns} entries={len(history)} full_scan={full_scan * 1e3:.2f}ms "
+              f"append={appended * 1e6:.1f}us migration(once)={migration * 1e3:.2f}ms kept={len(game_state['history']) - 2 * runs}")
+
+
+def sample_game_state(turns, rng):
+    """Synthetic save with turns of history, NPCs and narrative sentences drawn from world.py."""
+    from world import world_with_npcs
+
+    towns = [town for kingdom in world_with_npcs['kingdoms'].values() for town in kingdom['towns'].items()]
+    town_name, town = rng.choice(towns)
+    npcs = [npc for _, other in towns for npc in (other.get('npcs') or {}).items()]
+    sentences = [sentence.strip() for _, other in towns for sentence in other['description'].split(". ") if sentence.strip()]
+    history = []
+    for turn in range(turns):
+        history.append({'role': 'user', 'content': f"{rng.choice(['explorar', 'falar com', 'investigar', 'ir para'])} {rng.choice(npcs)[0]}"})
+        history.append({'role': 'assistant', 'content': ". ".join(rng.sample(sentences, 4)) + f". (turno {turn})"})
+    return {
+        'history': history, 'output_image': "static/images/image.png", 'ambient_sound': "static/sounds/ambient.mp3",
+        'location': {'name': town_name, 'exploring_location': None},
+        'known_map': {town_name: {'description': town['description'], 'exits': ["Floresta de Eldrid"], 'discovered': True},
+                      "Floresta de Eldrid": {'description': "", 'exits': [town_name], 'discovered': False}},
+        'current_state': 2, 'health': 10, 'resources': {'wands': 2, 'potions': 2, 'energy': 5},
+        'awarded_clues': [{'content': rng.choice(sentences), 'id': f"clue{n}", 'false_clue': n % 2 == 0, 'awarded': True} for n in range(20)],
+        'npc_status': {name: {'name': name, 'status': rng.choice(['Neutral', 'Allied', 'Hostile']), 'supposed_status': 'Neutral',
+                              'description': npc['description']} for name, npc in rng.sample(npcs, 5)},
+        'combat_results': [], 'puzzle_results': [], 'character': 'Herói', 'active_puzzle': None, 'active_combat': None,
+        'skill': 50, 'waiting_for_option': False, 'game_objective': f"Encontre o traidor em {town_name}. " + rng.choice(sentences),
+        'event_result': "Nenhum evento ocorreu."
+    }
+
+
+def bench_state_codec(sizes=(100, 1000, 10000), runs=20):
+    """Serialize, deserialize and validate a game state with 100, 1k and 10k turns of history,
+    against the previous json.dumps / json.loads + key check."""
+    from state_model import encode_game_state, decode_game_state, check_game_state
+
+    for turns in sizes:
+        game_state = sample_game_state(turns, random.Random(0))
+        old_text, new_text = json.dumps(game_state), encode_game_state(game_state)
+        timings = {}
+        for label, function in (
+            ('dumps(old)', lambda: json.dumps(game_state)),
+            ('encode', lambda: encode_game_state(game_state)),
+            ('loads', lambda: json.loads(old_text)),
+            ('validate', lambda: check_game_state(game_state)),
+            ('decode+validate', lambda: decode_game_state(new_text)),
+        ):
+            started = time.perf_counter()
+            for _ in range(runs):
+                function()
+            timings[label] = (time.perf_counter() - started) / runs
+        print(f"STATE_CODEC: turns={turns} size old={len(old_text.encode('utf-8')) / 1024:.0f}KB new={len(new_text.encode('utf-8')) / 1024:.0f}KB "
+              + " ".join(f"{label}={seconds * 1e3:.2f}ms" for label, seconds in timings.items()))
+
+
+def bench_state_storage(saves=60, runs=5):
+    """Size of users.db (what upload_db_to_gcs sends) and load latency of the same saves stored as
+    JSON text, zstd and zstd with a dictionary trained on other saves."""
+    import state_store
+    from state_model import encode_game_state, decode_game_state
+
+    rng = random.Random(0)
+    training = [sample_game_state(rng.randint(20, 400), rng) for _ in range(saves)]
+    measured = [sample_game_state(rng.randint(20, 400), rng) for _ in range(saves)]
+    dictionary = state_store.build_dictionary(training, dict_id=1)
+    for label in ('json', 'zstd', 'zstd+dict'):
+        if label == 'zstd+dict':
+            state_store.use_dictionary(1, dictionary)
+        else:
+            state_store.current_dictionary = None
+        pack = encode_game_state if label == 'json' else state_store.pack_value
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'users.db')
+            with sqlite3.connect(path) as conn:
+                conn.execute("CREATE TABLE game_states (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, game_name TEXT NOT NULL, game_state TEXT NOT NULL)")
+                started = time.perf_counter()
+                conn.executemany("INSERT INTO game_states (user_id, game_name, game_state) VALUES (?, 'autosave', ?)",
+                                 [(user_id, pack(game_state)) for user_id, game_state in enumerate(measured)])
+                write = (time.perf_counter() - started) / saves
+                conn.commit()
+                conn.execute("VACUUM")
+                rows = [row[0] for row in conn.execute("SELECT game_state FROM game_states")]
+            conn.close()
+            db_size = os.path.getsize(path)
+        latencies = []
+        for _ in range(runs):
+            for stored in rows:
+                started = time.perf_counter()
+                decode_game_state(state_store.unpack_value(stored))
+                latencies.append(time.perf_counter() - started)
+        stored_bytes = sum(len(stored.encode('utf-8') if isinstance(stored, str) else stored) for stored in rows)
+        print(f"STATE_STORAGE: {label}: saves={saves} stored={stored_bytes / 1024:.0f}KB db/upload={db_size / 1024:.0f}KB "
+              f"pack={write * 1e3:.2f}ms load p50={percentile(latencies, 0.5) * 1e3:.2f}ms p95={percentile(latencies, 0.95) * 1e3:.2f}ms")
+
+
+def bench_save_slots(sizes=(100, 1000, 10000), slots=5, runs=20):
+    """Cost of a turn's autosave, a slot save and a slot load, and the storage of an autosave plus
+    5 slots of the same game, as full copies vs. heads sharing history chunks."""
+    import state_store
+    from state_model import decode_game_state
+
+    with tempfile.TemporaryDirectory() as directory:
+        state_store.DB_PATH = os.path.join(directory, 'users.db')
+        with sqlite3.connect(state_store.DB_PATH) as conn:
+            conn.execute("CREATE TABLE game_states (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, game_name TEXT NOT NULL, game_state TEXT NOT NULL, created_at TIMESTAMP, UNIQUE(user_id, game_name))")
+        state_store.init_state_store()
+        rng = random.Random(0)
+        state_store.use_dictionary(1, state_store.build_dictionary([sample_game_state(rng.randint(20, 400), rng) for _ in range(60)], dict_id=1))
+
+        def timed(function):
+            started = time.perf_counter()
+            for _ in range(runs):
+                function()
+            return (time.perf_counter() - started) / runs * 1e3
+
+        for user_id, turns in enumerate(sizes):
+            game_state = sample_game_state(turns, random.Random(100 + user_id))
+            with sqlite3.connect(state_store.DB_PATH) as conn:
+                c = conn.cursor()
+                full = lambda name: c.execute("INSERT OR REPLACE INTO game_states (user_id, game_name, game_state) VALUES (?, ?, ?)",
+                                              (-1 - user_id, name, state_store.pack_value(game_state)))
+                copy_autosave = timed(lambda: full('autosave'))
+                copy_save = timed(lambda: full('slot'))
+                stored = c.execute("SELECT game_state FROM game_states WHERE user_id = ? AND game_name = 'slot'", (-1 - user_id,)).fetchone()[0]
+                copy_load = timed(lambda: decode_game_state(state_store.unpack_value(stored)))
+                copy_size = len(stored) * (slots + 1)
+
+                chunk_bytes = lambda: c.execute("SELECT COALESCE(SUM(LENGTH(data)), 0) FROM history_chunks").fetchone()[0]
+                chunks_before = chunk_bytes()
+                state_store.store_game_state(c, user_id, 'autosave', game_state)
+                cow_autosave = timed(lambda: state_store.store_game_state(c, user_id, 'autosave', game_state))
+                cow_save = timed(lambda: [state_store.copy_game_state(c, user_id, 'autosave', f"slot{slot}") for slot in range(slots)]) / slots
+                conn.commit()
+                stored = c.execute("SELECT game_state FROM game_states WHERE user_id = ? AND game_name = 'slot0'", (user_id,)).fetchone()[0]
+                cow_load = timed(lambda: state_store.read_game_state(stored))
+                cow_size = c.execute("SELECT SUM(LENGTH(game_state)) FROM game_states WHERE user_id = ?", (user_id,)).fetchone()[0]
+                cow_size += chunk_bytes() - chunks_before
+            print(f"SAVE_SLOTS: turns={turns} full copies: autosave={copy_autosave:.2f}ms save={copy_save:.2f}ms load={copy_load:.2f}ms storage={copy_size / 1024:.0f}KB | "
+                  f"shared chunks: autosave={cow_autosave:.2f}ms save={cow_save:.3f}ms load={cow_load:.2f}ms head={len(stored) / 1024:.1f}KB storage={cow_size / 1024:.0f}KB")
+
+
+BENCHMARKS = {
+    'turn_modes': bench_turn_modes,
+    'clue_evaluator': bench_clue_evaluator,
+    'puzzle_judge': bench_puzzle_judge,
+    'objective_fallback': bench_objective_fallback,
+    'model_routes': bench_model_routes,
+    'prompt_templates': bench_prompt_templates,
+    'world_index': bench_world_index,
+    'history_dedup': bench_history_dedup,
+    'state_codec': bench_state_codec,
+    'state_storage': bench_state_storage,
+    'save_slots': bench_save_slots,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or list(BENCHMARKS):
+        BENCHMARKS[name]()
@@ -0,0 +1,152 @@
+import re
+import random
+import unicodedata
+from functools import lru_cache
+
+from config import WORLD_DIGEST_WORDS, WORLD_NPC_DIGEST_WORDS, WORLD_OBJECTIVE_NPCS
+from create_log import create_log
+from world import world_with_npcs
+
+# Read-only world store built once at import (and shared by workers forked after it):
+# - digests of the world (world.py): the game objective prompt gets the digest of a starting town
+#   and its surroundings instead of every description in the world;
+# - name indexes over kingdoms, towns and NPCs, so names typed by the player (or echoed by the
+#   interpreter) resolve without accents, case or the full name: "eira", "Luminária", "shadowglo".
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+def digest(description, max_words=WORLD_DIGEST_WORDS):
+    """First sentence of a description, cut to max_words."""
+    first = SENTENCE_END.split((description or "").strip(), maxsplit=1)[0]
+    words = first.split()
+    return " ".join(words[:max_words]) + ("…" if len(words) > max_words else "")
+
+def build_world_index(world):
+    index = {'name': world['name'], 'digest': digest(world.get('description')), 'kingdoms': {}, 'towns': {}, 'npcs': {}}
+    for kingdom_name, kingdom in world.get('kingdoms', {}).items():
+        index['kingdoms'][kingdom_name] = {
+            'name': kingdom_name,
+            'digest': digest(kingdom.get('description')),
+            'towns': list(kingdom.get('towns', {}))
+        }
+        for town_name, town in kingdom.get('towns', {}).items():
+            npcs = town.get('npcs') or {}
+            index['towns'][town_name] = {
+                'name': town_name,
+                'kingdom': kingdom_name,
+                'digest': digest(town.get('description')),
+                'npcs': list(npcs)
+            }
+            for npc_name, npc in npcs.items():
+                # NPCs listed in more than one town keep the first description
+                index['npcs'].setdefault(npc_name, {
+                    'name': npc_name,
+                    'town': town_name,
+                    'kingdom': kingdom_name,
+                    'digest': digest(npc.get('description'), WORLD_NPC_DIGEST_WORDS)
+                })
+    return index
+
+world_index = build_world_index(world_with_npcs)
+
+def get_objective_world(town=None):
+    """Text of the world subset for the game objective prompt: the starting town (random if not
+    given), its kingdom, the other towns as possible exits and the NPCs of the kingdom.
+    Returns (town, text).
+    """
+    if town not in world_index['towns']:
+        town = random.choice(list(world_index['towns']))
+    start = world_index['towns'][town]
+    kingdom = world_index['kingdoms'][start['kingdom']]
+    exits = [f"{name} ({data['kingdom']})" for name, data in world_index['towns'].items() if name != town]
+    npcs = list(dict.fromkeys(start['npcs'] + [npc for name in kingdom['towns'] for npc in world_index['towns'][name]['npcs']]))
+    lines = [
+        f"Mundo: {world_index['name']}. {world_index['digest']}",
+        f"Reino: {kingdom['name']}. {kingdom['digest']}",
+        f"Cidade inicial: {town}. {start['digest']}",
+        f"Outras cidades: {', '.join(exits)}",
+        "NPCs: " + "; ".join(f"{npc} ({world_index['npcs'][npc]['town']}): {world_index['npcs'][npc]['digest']}" for npc in npcs[:WORLD_OBJECTIVE_NPCS])
+    ]
+    create_log(f"WORLD_INDEX: GET_OBJECTIVE_WORLD: Starting town {town}, {min(len(npcs), WORLD_OBJECTIVE_NPCS)} NPCs")
+    return town, "\n".join(lines)
+
+MIN_PREFIX = 3  # Shortest partial word matched as the start of a name
+MIN_FUZZY = 4  # Shortest word matched with one typo
+
+def fold_name(text):
+    text = unicodedata.normalize('NFKD', text or "")
+    text = "".join(ch for ch in text if not unicodedata.combining(ch)).lower()
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+def one_edit_variants(token):
+    """The token and every way of deleting one of its letters. Two words share a variant when
+    they are one insertion, deletion or substitution apart.
+    """
+    return {token} | {token[:i] + token[i + 1:] for i in range(len(token))}
+
+def build_name_index(names):
+    index = {'names': {}, 'tokens': {}, 'prefixes': {}, 'variants': {}}
+    for name in names:
+        folded = fold_name(name)
+        index['names'][folded] = name
+        for token in folded.split():
+            index['tokens'].setdefault(token, set()).add(name)
+            for end in range(MIN_PREFIX, len(token)):
+                index['prefixes'].setdefault(token[:end], set()).add(name)
+            if len(token) >= MIN_FUZZY:
+                for variant in one_edit_variants(token):
+                    index['variants'].setdefault(variant, set()).add(name)
+    return index
+
+def token_candidates(index, token):
+    if token in index['tokens']:
+        return index['tokens'][token]
+    if token in index['prefixes']:
+        return index['prefixes'][token]
+    if len(token) < MIN_FUZZY:
+        return set()
+    return set().union(*(index['variants'].get(variant, set()) for variant in one_edit_variants(token)))
+
+def lookup_name(index, query):
+    """Name matching the query exactly (after folding), by its words, by word prefixes or with
+    one typo per word. Words matching nothing ("rainha" in "rainha Lyra") are ignored.
+    Returns None when nothing or more than one name matches.
+    """
+    folded = fold_name(query)
+    if folded in index['names']:
+        return index['names'][folded]
+    matches = None
+    for token in folded.split():
+        found = token_candidates(index, token)
+        if found:
+            matches = found if matches is None else matches & found
+    if matches and len(matches) == 1:
+        return next(iter(matches))
+    return None
+
+world_store = {
+    'kingdoms': build_name_index(world_index['kingdoms']),
+    'towns': build_name_index(world_index['towns']),
+    'npcs': build_name_index(world_index['npcs'])
+}
+
+def find_world_name(kind, query):
+    """Canonical name of a kingdom, town or NPC of the world ('kingdoms', 'towns', 'npcs'), or None."""
+    return lookup_name(world_store[kind], query)
+
+@lru_cache(maxsize=256)
+def game_name_index(names):
+    return build_name_index(names)
+
+def resolve_npc(query, npc_names):
+    """NPC of the game (npc_status keys) the query refers to, or the query unchanged."""
+    name = lookup_name(game_name_index(tuple(sorted(npc_names))), query)
+    return name or query
+
+def resolve_location(query, known_map):
+    """Place of the known map (towns and their exits) or town of the world the query refers to,
+    or the query unchanged (places inside a town, like "a taverna", are not indexed).
+    """
+    known = {name for place, data in known_map.items() for name in [place, *data.get('exits', [])]}
+    name = lookup_name(game_name_index(tuple(sorted(known))), query) or find_world_name('towns', query)
+    return name or query